@@ -0,0 +1,228 @@
+import math
+import threading
+from collections import defaultdict
+from itertools import islice
+
+import numpy as np
+
+from config import Config
+from experiment_registry import registry
+from models import ComparisonResult
+
+# Two-sided 95% normal quantile
+Z_95 = 1.959963984540054
+
+
+def wilson_interval(successes, n, z=Z_95):
+    """Wilson score interval of a binomial proportion"""
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    denominator = 1 + z ** 2 / n
+    center = (p + z ** 2 / (2 * n)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def log_bayes_factor(successes, n):
+    """
+    Log Bayes factor of a uniform prior on the win rate against no preference (p = 0.5).
+
+    By Ville's inequality, stopping as soon as it exceeds log(1 / alpha) keeps
+    the false positive rate under alpha however often it is checked.
+    """
+    failures = n - successes
+    log_beta = math.lgamma(successes + 1) + math.lgamma(failures + 1) - math.lgamma(n + 2)
+    return log_beta + n * math.log(2)
+
+
+class ExperimentStats:
+    """Running vote counts of one experiment, per rater and per rated pair"""
+
+    def __init__(self):
+        self.user_votes = defaultdict(int)
+        self.user_wins = defaultdict(int)
+        self.item_votes = defaultdict(int)
+        self.item_wins = defaultdict(int)
+
+    def update(self, usernames, items, finetuned):
+        """
+        Add a chunk of votes.
+
+        Args:
+            usernames: Rater of each vote
+            items: Key of the prompt and completions each vote is on
+            finetuned: Whether each vote preferred the finetuned model
+        """
+        finetuned = np.asarray(finetuned, dtype=np.int64)
+        for counts_votes, counts_wins, keys in (
+            (self.user_votes, self.user_wins, usernames),
+            (self.item_votes, self.item_wins, items),
+        ):
+            unique, inverse = np.unique(np.asarray(keys, dtype=object), return_inverse=True)
+            votes = np.bincount(inverse, minlength=len(unique))
+            wins = np.bincount(inverse, weights=finetuned, minlength=len(unique)).astype(np.int64)
+            for key, key_votes, key_wins in zip(unique, votes, wins):
+                counts_votes[key] += int(key_votes)
+                counts_wins[key] += int(key_wins)
+
+    def summary(self, alpha, bootstrap_samples, min_rater_votes, rng):
+        user_names = list(self.user_votes)
+        user_votes = np.array([self.user_votes[u] for u in user_names], dtype=np.int64)
+        user_wins = np.array([self.user_wins[u] for u in user_names], dtype=np.int64)
+
+        n = int(user_votes.sum())
+        successes = int(user_wins.sum())
+        win_rate = successes / n if n else 0.0
+
+        summary = {
+            "total_votes": n,
+            "finetuned_wins": successes,
+            "finetuned_win_rate": round(win_rate, 4),
+            "wilson_interval": [round(x, 4) for x in wilson_interval(successes, n)],
+            "bootstrap_interval": self._bootstrap_interval(user_votes, user_wins, bootstrap_samples, rng),
+            "sequential_test": self._sequential_test(successes, n, alpha),
+            "rater_bias": self._rater_bias(user_names, user_votes, user_wins, win_rate, min_rater_votes),
+            "agreement": self._agreement(win_rate),
+        }
+        return summary
+
+    @staticmethod
+    def _bootstrap_interval(user_votes, user_wins, samples, rng):
+        """
+        Percentile interval of the win rate, resampling raters rather than
+        votes since the votes of one rater are correlated.
+        """
+        if len(user_votes) < 2:
+            return None
+        picks = rng.integers(0, len(user_votes), size=(samples, len(user_votes)))
+        rates = user_wins[picks].sum(axis=1) / user_votes[picks].sum(axis=1)
+        low, high = np.percentile(rates, [2.5, 97.5])
+        return [round(float(low), 4), round(float(high), 4)]
+
+    @staticmethod
+    def _sequential_test(successes, n, alpha):
+        log_bf = log_bayes_factor(successes, n)
+        threshold = math.log(1 / alpha)
+        if log_bf < threshold:
+            decision = "continue"
+        elif successes * 2 > n:
+            decision = "stop_finetuned_better"
+        else:
+            decision = "stop_base_better"
+        return {
+            "log_bayes_factor": round(log_bf, 3),
+            "threshold": round(threshold, 3),
+            "decision": decision,
+        }
+
+    @staticmethod
+    def _rater_bias(user_names, user_votes, user_wins, win_rate, min_votes):
+        """Deviation of each rater's win rate from the experiment's, as a z-score"""
+        mask = user_votes >= min_votes
+        if not mask.any():
+            return []
+        votes = user_votes[mask]
+        rates = user_wins[mask] / votes
+        variance = max(win_rate * (1 - win_rate), 1e-12)
+        z = (rates - win_rate) / np.sqrt(variance / votes)
+        names = np.array(user_names, dtype=object)[mask]
+        order = np.argsort(-np.abs(z))
+        return [
+            {
+                "github_username": names[i],
+                "votes": int(votes[i]),
+                "finetuned_win_rate": round(float(rates[i]), 4),
+                "bias": round(float(rates[i] - win_rate), 4),
+                "z_score": round(float(z[i]), 3),
+            }
+            for i in order
+        ]
+
+    def _agreement(self, win_rate):
+        """Pairwise agreement of raters who voted on the same prompt and completions"""
+        votes = np.array(list(self.item_votes.values()), dtype=np.int64)
+        wins = np.array([self.item_wins[k] for k in self.item_votes], dtype=np.int64)
+        shared = votes >= 2
+        if not shared.any():
+            return {"items": 0, "observed": None, "expected": None, "kappa": None}
+
+        votes, wins = votes[shared], wins[shared]
+        losses = votes - wins
+        pairs = votes * (votes - 1) / 2
+        agreeing = wins * (wins - 1) / 2 + losses * (losses - 1) / 2
+        observed = float(agreeing.sum() / pairs.sum())
+        expected = win_rate ** 2 + (1 - win_rate) ** 2
+        kappa = (observed - expected) / (1 - expected) if expected < 1 else None
+        return {
+            "items": int(shared.sum()),
+            "observed": round(observed, 4),
+            "expected": round(expected, 4),
+            "kappa": round(kappa, 4) if kappa is not None else None,
+        }
+
+
+class PreferenceAnalysis:
+    """
+    Statistics over all comparison results, updated incrementally.
+
+    Comparison results are only ever appended, so each refresh streams just
+    the rows added since the previous one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_id = 0
+        self._experiments = defaultdict(ExperimentStats)
+
+    def refresh(self, db_session, chunk_size=5000):
+        with self._lock:
+            rows = iter(
+                db_session.query(
+                    ComparisonResult.id,
+                    ComparisonResult.experiment_id,
+                    ComparisonResult.github_username,
+                    ComparisonResult.preferred_model,
+                    ComparisonResult.code_prefix_hash,
+                    ComparisonResult.base_completion_hash,
+                    ComparisonResult.finetuned_completion_hash,
+                )
+                .filter(ComparisonResult.id > self._last_id)
+                .order_by(ComparisonResult.id)
+                .yield_per(chunk_size)
+            )
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+
+                by_experiment = defaultdict(list)
+                for row in chunk:
+                    by_experiment[registry.get_name(row.experiment_id) or "none"].append(row)
+                for experiment_id, experiment_rows in by_experiment.items():
+                    self._experiments[experiment_id].update(
+                        [r.github_username for r in experiment_rows],
+                        [
+                            f"{r.code_prefix_hash}:{r.base_completion_hash}:{r.finetuned_completion_hash}"
+                            for r in experiment_rows
+                        ],
+                        [r.preferred_model == "finetuned" for r in experiment_rows],
+                    )
+                self._last_id = chunk[-1].id
+
+    def report(self, experiment_id=None):
+        rng = np.random.default_rng()
+        with self._lock:
+            return {
+                name: stats.summary(
+                    Config.ANALYSIS_ALPHA,
+                    Config.ANALYSIS_BOOTSTRAP_SAMPLES,
+                    Config.ANALYSIS_MIN_RATER_VOTES,
+                    rng,
+                )
+                for name, stats in self._experiments.items()
+                if experiment_id is None or name == experiment_id
+            }
+
+
+analysis = PreferenceAnalysis()
@@ -0,0 +1,319 @@
+"""
+Benchmarks for the model loading and generation paths.
+
+Usage:
+    python benchmark.py profiles --model Qwen/Qwen2.5-Coder-0.5B --profiles fp32 int8_dynamic
+    python benchmark.py profiles --model Qwen/Qwen2.5-Coder-0.5B \
+        --adapter stacklok/Qwen2.5-Coder-0.5B-curriculum-codegate
+    python benchmark.py --cpu adapters --model Qwen/Qwen2.5-Coder-0.5B \
+        --adapter stacklok/Qwen2.5-Coder-0.5B-curriculum-codegate
+    python benchmark.py lookup --model Qwen/Qwen2.5-Coder-0.5B --tokens 0 3 10
+    python benchmark.py --cpu compile --model Qwen/Qwen2.5-Coder-0.5B
+    python benchmark.py --cpu onnx --model Qwen/Qwen2.5-Coder-0.5B --profiles fp32 int8_dynamic
+    python benchmark.py --cpu replicas --model Qwen/Qwen2.5-Coder-0.5B --replicas 1 2 4 --concurrency 8
+"""
+import argparse
+import gc
+import multiprocessing
+import os
+import time
+
+import psutil
+
+FIM_PROMPT = (
+    "<|fim_prefix|>def fibonacci(n):\n    \"\"\"Return the n-th Fibonacci number.\"\"\"\n"
+    "<|fim_suffix|>\n\nprint(fibonacci(10))<|fim_middle|>"
+)
+
+# Refactoring-style prompt, the completion mostly repeats code around the cursor
+REFACTOR_FIM_PROMPT = (
+    "<|fim_prefix|>class UserRepository:\n"
+    "    def __init__(self, session):\n        self.session = session\n\n"
+    "    def get_user_by_id(self, user_id):\n"
+    "        user = self.session.query(User).filter(User.id == user_id).first()\n"
+    "        if user is None:\n            raise UserNotFoundError(user_id)\n        return user\n\n"
+    "    def get_user_by_email(self, email):\n"
+    "<|fim_suffix|>\n\n    def get_user_by_username(self, username):\n"
+    "        user = self.session.query(User).filter(User.username == username).first()\n"
+    "        if user is None:\n            raise UserNotFoundError(username)\n        return user\n"
+    "<|fim_middle|>"
+)
+
+
+def measure_generation(model, tokenizer, device, max_new_tokens=128, runs=3, prompt=FIM_PROMPT, generate=None,
+                       **generate_kwargs):
+    """Average greedy decoding speed in tokens per second over a few runs, through generate (model.generate by default)"""
+    import torch
+
+    generate = generate or model.generate
+    inputs = tokenizer([prompt], return_tensors="pt").to(device)
+
+    # Warmup run, not measured
+    with torch.inference_mode():
+        generate(**inputs, max_new_tokens=8, do_sample=False, **generate_kwargs)
+
+    tokens, elapsed = 0, 0.0
+    for _ in range(runs):
+        start = time.perf_counter()
+        with torch.inference_mode():
+            outputs = generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                do_sample=False,
+                **generate_kwargs,
+            )
+        elapsed += time.perf_counter() - start
+        tokens += outputs.shape[-1] - inputs["input_ids"].shape[-1]
+    return tokens / elapsed
+
+
+def _load(model_name, adapter_name=None, profile_name=None, merge=None):
+    from model_loader import load_base_model, load_peft_model
+
+    if adapter_name:
+        return load_peft_model(model_name, adapter_name, profile_name=profile_name, merge=merge)
+    return load_base_model(model_name, profile_name=profile_name)
+
+
+def _load_onnx(model_name):
+    from onnx_backend import load_onnx_model
+
+    return load_onnx_model(model_name)
+
+
+def _cold_load_time(load, *args):
+    """
+    Seconds of a first load, which prepares and caches the weights (or the merged
+    copy, or the ONNX export) when they aren't cached yet. Run isolated before the
+    benchmark, so the loads it measures are warm and comparable across rows.
+    """
+    start = time.perf_counter()
+    load(*args)
+    return round(time.perf_counter() - start, 2)
+
+
+def _benchmark_profile(model_name, adapter_name, profile_name):
+    import torch
+    from model_loader import device
+
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time.perf_counter()
+    model, tokenizer = _load(model_name, adapter_name, profile_name)
+    load_time = time.perf_counter() - start
+
+    result = {
+        "profile": profile_name,
+        "warm_load_s": round(load_time, 2),
+        "rss_mb": round((process.memory_info().rss - rss_before) / 2**20, 1),
+        "cuda_peak_mb": round(torch.cuda.max_memory_allocated() / 2**20, 1) if device == "cuda" else 0,
+        "tokens_per_s": round(measure_generation(model, tokenizer, device), 2),
+    }
+
+    del model
+    gc.collect()
+    return result
+
+
+def _benchmark_adapter(model_name, adapter_name, profile_name, merge):
+    from model_loader import device
+
+    start = time.perf_counter()
+    model, tokenizer = _load(model_name, adapter_name, profile_name, merge)
+    load_time = time.perf_counter() - start
+
+    return {
+        "merge": merge,
+        "model_class": type(model).__name__,
+        "warm_load_s": round(load_time, 2),
+        "tokens_per_s": round(measure_generation(model, tokenizer, device), 2),
+    }
+
+
+def _run_isolated(fn, *args):
+    """Run fn in a fresh process so memory numbers aren't skewed by earlier runs"""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def benchmark_profiles(args):
+    rows = []
+    for profile_name in args.profiles:
+        try:
+            cold_load = _run_isolated(_cold_load_time, _load, args.model, args.adapter, profile_name)
+            result = _run_isolated(_benchmark_profile, args.model, args.adapter, profile_name)
+            rows.append({**result, "cold_load_s": cold_load})
+        except Exception as e:
+            print(f"Profile '{profile_name}' failed: {e}")
+    print_table(rows, ["profile", "cold_load_s", "warm_load_s", "rss_mb", "cuda_peak_mb", "tokens_per_s"])
+
+
+def benchmark_adapters(args):
+    rows = []
+    for merge in ("never", "always"):
+        cold_load = _run_isolated(_cold_load_time, _load, args.model, args.adapter, args.profile, merge)
+        result = _run_isolated(_benchmark_adapter, args.model, args.adapter, args.profile, merge)
+        rows.append({**result, "cold_load_s": cold_load})
+    print_table(rows, ["merge", "model_class", "cold_load_s", "warm_load_s", "tokens_per_s"])
+
+
+def benchmark_lookup(args):
+    from model_loader import device, load_base_model
+
+    model, tokenizer = load_base_model(args.model)
+    rows = []
+    for num_tokens in args.tokens:
+        generate_kwargs = {"prompt_lookup_num_tokens": num_tokens} if num_tokens else {}
+        rows.append({
+            "lookup_tokens": num_tokens,
+            "tokens_per_s": round(
+                measure_generation(model, tokenizer, device, prompt=REFACTOR_FIM_PROMPT, **generate_kwargs), 2
+            ),
+        })
+    print_table(rows, ["lookup_tokens", "tokens_per_s"])
+
+
+def benchmark_compile(args):
+    import torch
+    from compiled_decoding import CompiledDecoder
+    from model_loader import device, load_base_model
+
+    model, tokenizer = load_base_model(args.model)
+    rows = [{
+        "path": "eager",
+        "compile_s": 0,
+        "tokens_per_s": round(measure_generation(model, tokenizer, device), 2),
+    }]
+
+    start = time.perf_counter()
+    decoder = CompiledDecoder(model, tokenizer)
+    decoder.warm_up()
+    compile_time = time.perf_counter() - start
+
+    def generate(input_ids, attention_mask, **kwargs):
+        # Same grad mode as the warmup, or the step would be compiled again
+        with torch.inference_mode(False):
+            return decoder.generate(input_ids, **kwargs)
+
+    rows.append({
+        "path": "compiled",
+        "compile_s": round(compile_time, 1),
+        "tokens_per_s": round(measure_generation(model, tokenizer, device, generate=generate), 2),
+    })
+    print_table(rows, ["path", "compile_s", "tokens_per_s"])
+
+
+def _benchmark_onnx(model_name):
+    start = time.perf_counter()
+    model, tokenizer = _load_onnx(model_name)
+    return {
+        "backend": "onnx int8",
+        "warm_load_s": round(time.perf_counter() - start, 2),
+        "tokens_per_s": round(measure_generation(model, tokenizer, "cpu"), 2),
+    }
+
+
+def benchmark_onnx(args):
+    rows = []
+    for profile_name in args.profiles:
+        cold_load = _run_isolated(_cold_load_time, _load, args.model, None, profile_name)
+        result = _run_isolated(_benchmark_profile, args.model, None, profile_name)
+        rows.append({**result, "backend": f"torch {profile_name}", "cold_load_s": cold_load})
+    cold_load = _run_isolated(_cold_load_time, _load_onnx, args.model)
+    rows.append({**_run_isolated(_benchmark_onnx, args.model), "cold_load_s": cold_load})
+    print_table(rows, ["backend", "cold_load_s", "warm_load_s", "tokens_per_s"])
+
+
+def benchmark_replicas(args):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from cpu_replicas import ReplicatedModel, numa_nodes, partition_cores
+
+    rows = []
+    for count in args.replicas:
+        core_sets = partition_cores(count, numa_nodes())
+        model = ReplicatedModel("FIM_CODEGATE", "base", args.model, core_sets)
+        try:
+            inputs = model.tokenizer([FIM_PROMPT], return_tensors="pt")
+
+            def generate(max_new_tokens):
+                outputs = model.generate(
+                    **inputs, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False
+                )
+                return outputs.shape[-1] - inputs["input_ids"].shape[-1]
+
+            # Warmup run on every replica, not measured
+            with ThreadPoolExecutor(count) as pool:
+                list(pool.map(generate, [8] * count))
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                tokens = sum(pool.map(generate, [128] * args.concurrency * 2))
+            rows.append({
+                "replicas": count,
+                "cores_per_replica": len(core_sets[0]),
+                "tokens_per_s": round(tokens / (time.perf_counter() - start), 2),
+            })
+        finally:
+            model.close()
+    print_table(rows, ["replicas", "cores_per_replica", "tokens_per_s"])
+
+
+def print_table(rows, columns):
+    widths = [max([len(c)] + [len(str(r[c])) for r in rows]) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cpu", action="store_true", help="Hide CUDA devices from the benchmark")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    profiles = subparsers.add_parser("profiles", help="Compare load profiles of a model")
+    profiles.add_argument("--model", default="Qwen/Qwen2.5-Coder-0.5B")
+    profiles.add_argument("--adapter", default=None, help="Optional LoRA adapter loaded on top of --model")
+    profiles.add_argument("--profiles", nargs="+", default=["fp32", "fp16", "bf16", "int8_dynamic"])
+    profiles.set_defaults(func=benchmark_profiles)
+
+    adapters = subparsers.add_parser("adapters", help="Compare merged and unmerged LoRA adapters")
+    adapters.add_argument("--model", default="Qwen/Qwen2.5-Coder-0.5B")
+    adapters.add_argument("--adapter", default="stacklok/Qwen2.5-Coder-0.5B-curriculum-codegate")
+    adapters.add_argument("--profile", default="fp32")
+    adapters.set_defaults(func=benchmark_adapters)
+
+    lookup = subparsers.add_parser("lookup", help="Compare prompt lookup decoding settings on a FIM prompt")
+    lookup.add_argument("--model", default="Qwen/Qwen2.5-Coder-0.5B")
+    lookup.add_argument("--tokens", nargs="+", type=int, default=[0, 3, 10],
+                        help="Candidate tokens per step, 0 decodes without prompt lookup")
+    lookup.set_defaults(func=benchmark_lookup)
+
+    compile_parser = subparsers.add_parser("compile", help="Compare eager and compiled static cache decoding")
+    compile_parser.add_argument("--model", default="Qwen/Qwen2.5-Coder-0.5B")
+    compile_parser.set_defaults(func=benchmark_compile)
+
+    onnx = subparsers.add_parser("onnx", help="Compare the ONNX Runtime backend with torch load profiles")
+    onnx.add_argument("--model", default="Qwen/Qwen2.5-Coder-0.5B")
+    onnx.add_argument("--profiles", nargs="+", default=["fp32", "int8_dynamic"])
+    onnx.set_defaults(func=benchmark_onnx)
+
+    replicas = subparsers.add_parser("replicas", help="Compare CPU replica counts under concurrent generations")
+    replicas.add_argument("--model", default="Qwen/Qwen2.5-Coder-0.5B")
+    replicas.add_argument("--replicas", nargs="+", type=int, default=[1, 2, 4])
+    replicas.add_argument("--concurrency", type=int, default=8, help="Generations running at the same time")
+    replicas.set_defaults(func=benchmark_replicas)
+
+    args = parser.parse_args()
+    if args.cpu:
+        # Inherited by the spawned benchmark processes
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import logging
+import secrets
+import threading
+import time
+from datetime import datetime
+
+from config import Config
+from preference_batch import insert_batch
+from stream_buffer import StreamBuffer
+
+logger = logging.getLogger(__name__)
+
+MODEL_LETTERS = ("A", "B")
+
+
+class SessionStream(StreamBuffer):
+    """
+    Stream of a session. Keeps the text of both completions apart from the
+    bounded event buffer, so votes store them whole.
+    """
+
+    def __init__(self, session_id, owner):
+        super().__init__(session_id, owner, Config.STREAM_BUFFER_EVENTS)
+        self.texts = {letter: [] for letter in MODEL_LETTERS}
+
+    def append(self, event):
+        if event["type"] == "token":
+            self.texts[event["model"]].append(event["text"])
+        super().append(event)
+
+
+class CollaborationSession:
+    """
+    A comparison reviewed by several participants. Its completions are
+    generated once into a stream every participant follows, and each
+    participant votes once, without knowing which model is the base one.
+    """
+
+    def __init__(self, session_id, owner, experiment_id):
+        self.session_id = session_id
+        self.owner = owner
+        self.experiment_id = experiment_id
+        # Prompt the completions are generated from, set once the generation starts
+        self.code_prefix = None
+        # Participants joining late replay it from the start, as long as the
+        # buffer still holds the first events
+        self.stream = SessionStream(session_id, owner)
+        self.model_a_is_base = None
+        self.participants = {owner}
+        self.votes = {}
+        self.created = time.monotonic()
+
+    def completions(self):
+        """Text streamed by model A and model B"""
+        return {letter: "".join(parts) for letter, parts in self.stream.texts.items()}
+
+    def completed(self):
+        """Whether the generation ran to the end"""
+        if not self.stream.events:
+            return False
+        _, event = self.stream.events[-1]
+        return event["type"] == "complete"
+
+    def tally(self):
+        return {
+            "participants": len(self.participants),
+            "votes": {letter: sum(v == letter for v in self.votes.values()) for letter in MODEL_LETTERS},
+            "complete": self.stream.done,
+        }
+
+
+class Collaborations:
+    """
+    Active collaboration sessions and the votes cast in them.
+
+    Votes are kept in memory and written to comparison_results in batches by
+    flush(), one row per participant, instead of a transaction per vote.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._pending = []
+
+    def _prune(self):
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            if session.stream.done and now - session.created > self.ttl:
+                del self._sessions[session_id]
+
+    def create(self, owner, experiment_id):
+        with self._lock:
+            self._prune()
+            session = CollaborationSession(secrets.token_urlsafe(16), owner, experiment_id)
+            self._sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._prune()
+            return self._sessions.get(session_id)
+
+    def join(self, session, username):
+        with self._lock:
+            session.participants.add(username)
+
+    def vote(self, session, username, model_letter):
+        """
+        Record a participant's vote for model A or B.
+
+        Raises:
+            ValueError: If the generation is still running or failed, or the participant already voted
+        """
+        if not session.stream.done:
+            raise ValueError("The completions are still being generated")
+        if not session.completed():
+            raise ValueError("The generation failed, there is nothing to vote on")
+        completions = session.completions()
+        with self._lock:
+            if username in session.votes:
+                raise ValueError("You already voted in this session")
+            session.participants.add(username)
+            session.votes[username] = model_letter
+
+            base, finetuned = ("A", "B") if session.model_a_is_base else ("B", "A")
+            self._pending.append({
+                "githubUsername": username,
+                "preferredModel": "base" if model_letter == base else "finetuned",
+                "codePrefix": session.code_prefix,
+                "baseCompletion": completions[base],
+                "finetunedCompletion": completions[finetuned],
+                "experimentId": session.experiment_id,
+                "createdAt": datetime.utcnow().isoformat(),
+            })
+
+    def flush(self, db_session):
+        """
+        Write the votes cast since the last flush to comparison_results.
+
+        Returns:
+            Number of votes written, votes are kept for the next flush if it fails
+        """
+        with self._lock:
+            items, self._pending = self._pending, []
+        if not items:
+            return 0
+
+        try:
+            inserted, errors = insert_batch(db_session, [(item, None) for item in items], None, allow_username=True)
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            with self._lock:
+                self._pending = items + self._pending
+            raise
+
+        for error in errors:
+            logger.warning(f"Dropped collaboration vote {items[error['index']]['githubUsername']}: {error['error']}")
+        return inserted
+
+
+collaborations = Collaborations(Config.COLLABORATION_SESSION_TTL_SECONDS)
@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+
+import torch
+from peft import PeftModel
+from transformers import StaticCache
+
+from inference_backends import sample_token
+from model_loader import max_seq_length
+
+logger = logging.getLogger(__name__)
+
+# Prompt lengths the prefill is compiled for, prompts are right-padded to the next one
+PROMPT_BUCKETS = (128, 256, 512, 1024, 1536)
+
+# generate() arguments the compiled path handles, others fall back to generate()
+SUPPORTED_KWARGS = {"input_ids", "attention_mask", "max_new_tokens", "temperature", "do_sample", "streamer", "use_cache"}
+
+
+class CompiledDecoder:
+    """
+    Fast decode path for small models, where per-token Python and dispatch
+    overhead dominates: a KV cache preallocated to max_seq_length and a
+    torch.compile'd forward step.
+
+    Shapes never depend on the request: the prefill is padded to a prompt
+    length bucket and every decode step feeds one token into the same cache,
+    so the step is compiled once per bucket plus once for decoding, all during
+    warmup. Right padding is safe without a mask, since padded cache slots are
+    always overwritten by decode steps before a later position attends to them.
+
+    One generation runs at a time. Requests that arrive while it is busy, or
+    don't fit a bucket, use the eager generate() instead.
+    """
+
+    def __init__(self, model, tokenizer, buckets=PROMPT_BUCKETS, max_cache_len=max_seq_length):
+        causal_lm = model.get_base_model() if isinstance(model, PeftModel) else model
+        self.body = causal_lm.model
+        self.lm_head = causal_lm.lm_head
+        self.config = causal_lm.config
+        self.generation_config = causal_lm.generation_config
+        self.device = causal_lm.device
+        self.buckets = tuple(b for b in buckets if b < max_cache_len)
+        self.max_cache_len = max_cache_len
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+        eos = self.generation_config.eos_token_id
+        eos = eos if isinstance(eos, list) else [eos]
+        self.eos_token_ids = {i for i in eos + [tokenizer.eos_token_id] if i is not None}
+
+        self.cache = StaticCache(
+            config=self.config,
+            max_batch_size=1,
+            max_cache_len=max_cache_len,
+            device=self.device,
+            dtype=causal_lm.dtype,
+        )
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, len(self.buckets) + 2
+        )
+        mode = "reduce-overhead" if self.device.type == "cuda" else None
+        self._step = torch.compile(self._forward, mode=mode, fullgraph=True, dynamic=False)
+        self._lock = threading.Lock()
+
+    def _forward(self, input_ids, cache_position, last_index):
+        hidden = self.body(
+            input_ids=input_ids,
+            position_ids=cache_position.unsqueeze(0),
+            cache_position=cache_position,
+            past_key_values=self.cache,
+            use_cache=True,
+        ).last_hidden_state
+        return self.lm_head(hidden.index_select(1, last_index))[:, -1, :].float()
+
+    def _bucket(self, length):
+        for bucket in self.buckets:
+            if length <= bucket:
+                return bucket
+        return None
+
+    def _prefill(self, input_ids):
+        length = input_ids.shape[-1]
+        bucket = self._bucket(length)
+        padded = torch.nn.functional.pad(input_ids, (0, bucket - length), value=self.pad_token_id)
+        positions = torch.arange(bucket, device=self.device)
+        return self._step(padded, positions, torch.tensor([length - 1], device=self.device))
+
+    def _decode(self, token, position):
+        return self._step(
+            token.view(1, 1),
+            torch.tensor([position], device=self.device),
+            torch.tensor([0], device=self.device),
+        )
+
+    def accepts(self, input_ids, max_new_tokens):
+        return (
+            input_ids.shape[0] == 1
+            and self._bucket(input_ids.shape[-1]) is not None
+            and input_ids.shape[-1] + max_new_tokens <= self.max_cache_len
+        )
+
+    @torch.no_grad()
+    def generate(self, input_ids, max_new_tokens, temperature=1.0, do_sample=False, streamer=None, min_new_tokens=0):
+        """
+        Generate like model.generate() for a single prompt, EOS is ignored
+        before min_new_tokens.
+
+        Returns:
+            Tensor of the prompt and generated ids, or None when the decoder is
+            busy or the request doesn't fit, to fall back to model.generate()
+        """
+        if not self.accepts(input_ids, max_new_tokens) or not self._lock.acquire(blocking=False):
+            return None
+
+        try:
+            if streamer is not None:
+                streamer.put(input_ids.cpu())
+
+            generated = []
+            position = input_ids.shape[-1]
+            logits = self._prefill(input_ids)
+            for step in range(max_new_tokens):
+                token = sample_token(logits, self.generation_config, temperature, do_sample)
+                generated.append(token)
+                if streamer is not None:
+                    streamer.put(token.cpu())
+                if step + 1 >= min_new_tokens and token.item() in self.eos_token_ids:
+                    break
+                logits = self._decode(token, position)
+                position += 1
+        finally:
+            self._lock.release()
+            if streamer is not None:
+                streamer.end()
+
+        return torch.cat([input_ids, torch.stack(generated, dim=1)], dim=-1)
+
+    @torch.no_grad()
+    def warm_up(self, decode_steps=2):
+        """Compile the step for every prompt bucket and for decoding"""
+        start = time.perf_counter()
+        with self._lock:
+            for bucket in self.buckets:
+                input_ids = torch.full((1, bucket), self.pad_token_id, device=self.device)
+                logits = self._prefill(input_ids)
+                # Decode regardless of EOS, the decode graph must be compiled too
+                for position in range(bucket, bucket + decode_steps):
+                    logits = self._decode(logits.argmax(dim=-1), position)
+        logger.info(
+            f"Compiled decoding for {len(self.buckets)} prompt buckets in {time.perf_counter() - start:.1f}s"
+        )
+
+
+def enable_compiled_decoding(model, tokenizer):
+    """
+    Attach a warmed up CompiledDecoder to model, used by compiled_generate().
+
+    Returns:
+        Whether compiled decoding is enabled, models it fails to compile keep
+        the eager path
+    """
+    try:
+        decoder = CompiledDecoder(model, tokenizer)
+        decoder.warm_up()
+    except Exception as e:
+        logger.warning(f"Compiled decoding unavailable, using eager generation: {e}")
+        return False
+    model.compiled_decoder = decoder
+    return True
+
+
+def compiled_generate(model, **kwargs):
+    """
+    Run the compiled decode path of model when it has one and can serve the request.
+
+    Returns:
+        The generated ids like model.generate(), or None to fall back to it
+    """
+    decoder = getattr(model, "compiled_decoder", None)
+    if decoder is None or "max_new_tokens" not in kwargs or not set(kwargs) <= SUPPORTED_KWARGS:
+        return None
+    attention_mask = kwargs.get("attention_mask")
+    if attention_mask is not None and not bool(attention_mask.all()):
+        return None
+    return decoder.generate(
+        kwargs["input_ids"],
+        kwargs["max_new_tokens"],
+        temperature=kwargs.get("temperature", 1.0),
+        do_sample=kwargs.get("do_sample", False),
+        streamer=kwargs.get("streamer"),
+    )
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import logging
+
+from sqlalchemy import exists, func, update
+from sqlalchemy.exc import IntegrityError
+
+from config import Config
+from experiment_registry import registry
+from models import PoolAssignment, PoolItem, Session as DBSession
+
+logger = logging.getLogger(__name__)
+
+
+def load_corpus(path):
+    """
+    Read prompts from a JSONL corpus.
+
+    FIM lines carry "prefix" and optionally "suffix". Chat lines carry "prompt",
+    or a "title"/"body" pair as in a backlog of requests.
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping malformed corpus line: {line[:80]}")
+
+
+def corpus_prompt(item, mode):
+    """Turn a corpus line into a prompt for mode, or None if it doesn't fit that mode"""
+    if mode == "fim":
+        if "prefix" not in item:
+            return None
+        return {"prefix": item["prefix"], "suffix": item.get("suffix", "")}
+
+    prompt = item.get("prompt")
+    if prompt is None and "body" in item:
+        prompt = f"{item['title']}\n\n{item['body']}" if item.get("title") else item["body"]
+    if not prompt or not prompt.strip():
+        return None
+    return {"prefix": prompt, "suffix": ""}
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(json.dumps(prompt, sort_keys=True).encode()).hexdigest()
+
+
+# Attempts at claiming a pool item before giving up, when concurrent requests
+# take the picked items first
+CLAIM_ATTEMPTS = 3
+
+
+def has_capacity():
+    """Filter on pool items handed out to fewer than POOL_RATINGS_PER_ITEM raters"""
+    return PoolItem.assignment_count < Config.POOL_RATINGS_PER_ITEM
+
+
+def fill_pool(experiment_id, generate_pair, target_size=None):
+    """
+    Generate completions for corpus prompts until the experiment's pool holds
+    target_size items that can still be handed out. Items raters used up are
+    replaced by new prompts of the corpus.
+
+    Args:
+        experiment_id: Experiment the pool is filled for
+        generate_pair: Callable (experiment_id, prompt) -> (prompt used, base completion,
+            finetuned completion), or None to skip the prompt. The prompt used is the
+            one the completions were generated from, e.g. trimmed to the context budget
+        target_size: Number of unused items to keep in the pool, defaults to Config.POOL_TARGET_SIZE
+
+    Returns:
+        Number of items added
+    """
+    target_size = target_size or Config.POOL_TARGET_SIZE
+    experiment_config = Config.EXPERIMENTS[experiment_id]
+    db_session = DBSession()
+    added = 0
+
+    try:
+        experiment_row_id = registry.get_or_create_id(experiment_id)
+        known = {
+            h for (h,) in db_session.query(PoolItem.prompt_hash).filter(
+                PoolItem.experiment_id == experiment_row_id
+            )
+        }
+        available = (
+            db_session.query(PoolItem)
+            .filter(PoolItem.experiment_id == experiment_row_id)
+            .filter(has_capacity())
+            .count()
+        )
+
+        for item in load_corpus(Config.POOL_CORPUS_PATH):
+            if available >= target_size:
+                break
+            prompt = corpus_prompt(item, experiment_config["mode"])
+            if prompt is None:
+                continue
+            key = prompt_hash(prompt)
+            if key in known:
+                continue
+
+            pair = generate_pair(experiment_id, prompt)
+            if pair is None:
+                continue
+            used_prompt, base_completion, finetuned_completion = pair
+            db_session.add(
+                PoolItem(
+                    experiment_id=experiment_row_id,
+                    prompt_hash=key,
+                    code_prefix=used_prompt["prefix"],
+                    code_suffix=used_prompt["suffix"],
+                    base_model_name=experiment_config["base"],
+                    finetuned_model_name=experiment_config["fineTuned"],
+                    base_completion=base_completion,
+                    finetuned_completion=finetuned_completion,
+                )
+            )
+            # Commit every item, so raters can use the pool while it is being filled
+            db_session.commit()
+            known.add(key)
+            available += 1
+            added += 1
+    except Exception as e:
+        db_session.rollback()
+        logger.error(f"Error filling completion pool for {experiment_id}: {e}")
+    finally:
+        db_session.close()
+
+    logger.info(f"Added {added} items to the completion pool of {experiment_id}")
+    return added
+
+
+def next_pool_item(db_session, experiment_id, username):
+    """
+    Hand out a random pool item the user hasn't been given yet, among those
+    not used up.
+
+    Returns:
+        The PoolItem, or None when the user has seen the whole pool
+    """
+    already_assigned = exists().where(
+        PoolAssignment.pool_item_id == PoolItem.id,
+        PoolAssignment.github_username == username,
+    )
+    experiment_row_id = registry.get_id(experiment_id)
+    if experiment_row_id is None:
+        return None
+
+    for _ in range(CLAIM_ATTEMPTS):
+        item = (
+            db_session.query(PoolItem)
+            .filter(PoolItem.experiment_id == experiment_row_id)
+            .filter(~already_assigned)
+            .filter(has_capacity())
+            .order_by(func.random())
+            .first()
+        )
+        if item is None:
+            return None
+
+        # The capacity check and the claim are one statement, so concurrent
+        # raters can't push an item past POOL_RATINGS_PER_ITEM
+        claimed = db_session.execute(
+            update(PoolItem)
+            .where(PoolItem.id == item.id, has_capacity())
+            .values(assignment_count=PoolItem.assignment_count + 1)
+        ).rowcount
+        if not claimed:
+            db_session.rollback()
+            continue
+
+        db_session.add(PoolAssignment(pool_item_id=item.id, github_username=username))
+        try:
+            db_session.commit()
+        except IntegrityError:
+            # A concurrent request of the same user got the item first
+            db_session.rollback()
+            continue
+        return item
+    return None
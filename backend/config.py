@@ -16,9 +16,16 @@ class Config:
     GITHUB_TOKEN_URL = 'https://github.com/login/oauth/access_token'
     GITHUB_API_BASE_URL = 'https://api.github.com/'
 
+    # Prepared model weights, set MODEL_CACHE_DIR to an empty string to disable the cache
+    MODEL_CACHE_DIR = os.getenv('MODEL_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'model_cache'))
+
     # Database
     SQLITE_DB_PATH = os.getenv('SQLITE_DB_PATH', 'comparisons.db')
 
+    # Stored completions: set to "zstd" to compress those of at least BLOB_COMPRESSION_MIN_SIZE characters
+    BLOB_COMPRESSION = os.getenv('BLOB_COMPRESSION', 'none')
+    BLOB_COMPRESSION_MIN_SIZE = int(os.getenv('BLOB_COMPRESSION_MIN_SIZE', 512))
+
     # Model configs
     FIM_BASE_MODEL_NAME = "Qwen/Qwen2.5-Coder-0.5B"
     FIM_FINETUNED_MODEL_NAME = "stacklok/Qwen2.5-Coder-0.5B-curriculum-codegate"
@@ -46,19 +53,112 @@ class Config:
     # Active Experiments
     EXPERIMENTS = {
         "FIM_CODEGATE": {
+            "mode": "fim",
             "base": FIM_BASE_MODEL_NAME,
-            "fineTuned": FIM_FINETUNED_MODEL_NAME
+            "fineTuned": FIM_FINETUNED_MODEL_NAME,
+            # Serve both arms from one unmerged adapter model, decoding them as a batch of two
+            "mixed_batching": os.getenv('FIM_MIXED_BATCHING', 'false').lower() == 'true',
+            # Prompt lookup decoding: candidate tokens copied from the prompt and
+            # verified in one forward pass, up to this many per step (0 disables)
+            "prompt_lookup_tokens": int(os.getenv('FIM_PROMPT_LOOKUP_TOKENS', 0)),
+            # Decode single prompts with a static KV cache and a torch.compile'd
+            # forward, compiled for every prompt length bucket at startup
+            "compile": os.getenv('FIM_COMPILE', 'false').lower() == 'true',
+            # "torch", or "onnx" for int8 ONNX Runtime models on CPU
+            "inference_backend": os.getenv('FIM_INFERENCE_BACKEND', 'torch'),
+            # On CPU: model replicas per arm, each a process pinned to its own cores (0 disables)
+            "replicas": int(os.getenv('FIM_REPLICAS', 0))
         },
         "CHAT_CODEGATE": {
+            "mode": "chat",
             "base": CHAT_BASE_MODEL_NAME,
-            "fineTuned": CHAT_FINETUNED_MODEL_NAME
+            "fineTuned": CHAT_FINETUNED_MODEL_NAME,
+            "mixed_batching": os.getenv('CHAT_MIXED_BATCHING', 'false').lower() == 'true',
+            # Small same-tokenizer model used as draft for assisted generation,
+            # set CHAT_DRAFT_MODEL_NAME to an empty string to disable it
+            "draft": os.getenv('CHAT_DRAFT_MODEL_NAME', FIM_BASE_MODEL_NAME)
         }
     }
     
     OLD_EXPERIMENTS = {
         #Before we introduce the experiments id and the chat models
         "FIM_LEGACY_CODEGATE": {
+            "mode": "fim",
             "base": "Qwen/Qwen2.5-Coder-0.5B",
             "fineTuned": "stacklok/Qwen2.5-Coder-0.5B-curriculum-codegate"
         }
     }
+
+    # Load profiles: quantization and dtype a model is loaded with
+    LOAD_PROFILES = {
+        "4bit": {"load_in_4bit": True},
+        "8bit": {"load_in_8bit": True},
+        "bf16": {"dtype": "bfloat16"},
+        "fp16": {"dtype": "float16"},
+        "fp32": {"dtype": "float32"},
+        # CPU only: float32 weights with Linear layers dynamically quantized to int8
+        "int8_dynamic": {"dtype": "float32", "dynamic_quantization": True},
+    }
+
+    # Load profile per model (finetunes are keyed by their adapter name).
+    # Models without a profile use the platform default: 4bit on CUDA, fp32 on MPS and CPU
+    MODEL_LOAD_PROFILES = {
+        FIM_BASE_MODEL_NAME: os.getenv('FIM_LOAD_PROFILE'),
+        FIM_FINETUNED_MODEL_NAME: os.getenv('FIM_LOAD_PROFILE'),
+        CHAT_BASE_MODEL_NAME: os.getenv('CHAT_LOAD_PROFILE'),
+        CHAT_FINETUNED_MODEL_NAME: os.getenv('CHAT_LOAD_PROFILE'),
+    }
+
+    # Fold LoRA adapters into a dedicated copy of the base weights: always, never,
+    # or auto. LoRA can't be folded into 4/8-bit weights, so on quantized profiles
+    # (the CUDA default) "always" merges into a bf16/fp16 copy: the finetuned arm then
+    # differs from the still quantized base arm in precision too, and a 7B arm takes
+    # about 15 GB. "auto" only merges adapters whose profile isn't quantized.
+    MERGE_ADAPTERS = os.getenv('MERGE_ADAPTERS', 'auto')
+
+    # Threads per ONNX Runtime model, 0 lets ONNX Runtime use every core
+    ONNX_NUM_THREADS = int(os.getenv('ONNX_NUM_THREADS', 0))
+
+    # Chat prompts over the context budget are rejected, or trimmed when set to "trim"
+    CHAT_PROMPT_OVERFLOW = os.getenv('CHAT_PROMPT_OVERFLOW', 'reject')
+
+    # Pre-generated completion pool, filled from a JSONL prompt corpus when one is configured
+    POOL_CORPUS_PATH = os.getenv('POOL_CORPUS_PATH')
+    POOL_TARGET_SIZE = int(os.getenv('POOL_TARGET_SIZE', 500))
+    # Raters a pool item is handed out to, after that it is used up
+    POOL_RATINGS_PER_ITEM = int(os.getenv('POOL_RATINGS_PER_ITEM', 5))
+    POOL_FILL_INTERVAL_MINUTES = int(os.getenv('POOL_FILL_INTERVAL_MINUTES', 30))
+
+    # Hourly preference rollups are kept this long, daily ones forever
+    ROLLUP_HOURLY_RETENTION_DAYS = int(os.getenv('ROLLUP_HOURLY_RETENTION_DAYS', 14))
+
+    # Statistical analysis: significance level of the sequential test, bootstrap
+    # resamples, and votes a rater needs before their bias is reported
+    ANALYSIS_ALPHA = float(os.getenv('ANALYSIS_ALPHA', 0.05))
+    ANALYSIS_BOOTSTRAP_SAMPLES = int(os.getenv('ANALYSIS_BOOTSTRAP_SAMPLES', 2000))
+    ANALYSIS_MIN_RATER_VOTES = int(os.getenv('ANALYSIS_MIN_RATER_VOTES', 5))
+
+    # Most items accepted by one /api/submit-preferences batch
+    BATCH_SUBMIT_MAX_ITEMS = int(os.getenv('BATCH_SUBMIT_MAX_ITEMS', 10000))
+
+    # How long a swapped out model waits for its in-flight generations before it is released
+    MODEL_DRAIN_TIMEOUT_SECONDS = int(os.getenv('MODEL_DRAIN_TIMEOUT_SECONDS', 300))
+
+    # Fair-share admission: generations running at a time, and the rate (with
+    # bursts) at which each user can start interactive generations
+    GENERATION_CONCURRENCY = int(os.getenv('GENERATION_CONCURRENCY', 4))
+    USER_REQUESTS_PER_MINUTE = float(os.getenv('USER_REQUESTS_PER_MINUTE', 20))
+    USER_REQUEST_BURST = int(os.getenv('USER_REQUEST_BURST', 5))
+
+    # Resumable streams: how long a finished stream can still be replayed, and
+    # how many streams and events per stream are kept
+    STREAM_RESUME_TTL_SECONDS = int(os.getenv('STREAM_RESUME_TTL_SECONDS', 60))
+    MAX_RESUMABLE_STREAMS = int(os.getenv('MAX_RESUMABLE_STREAMS', 1000))
+    STREAM_BUFFER_EVENTS = int(os.getenv('STREAM_BUFFER_EVENTS', 4096))
+    # A generation no client has followed for this long is cancelled
+    STREAM_ABANDON_GRACE_SECONDS = float(os.getenv('STREAM_ABANDON_GRACE_SECONDS', 10))
+
+    # Collaboration sessions: how long a finished session stays open for votes,
+    # and how often the votes cast are written to the database
+    COLLABORATION_SESSION_TTL_SECONDS = int(os.getenv('COLLABORATION_SESSION_TTL_SECONDS', 3600))
+    COLLABORATION_FLUSH_SECONDS = int(os.getenv('COLLABORATION_FLUSH_SECONDS', 10))
@@ -0,0 +1,109 @@
+def _offsets(tokenizer, text):
+    """Character span of every token of text"""
+    if not text:
+        return []
+    return tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)[
+        "offset_mapping"
+    ]
+
+
+def _keep_last_tokens(text, offsets, n):
+    """Keep at most the last n tokens of text, dropping the partial line at the cut"""
+    if n >= len(offsets):
+        return text
+    if n <= 0:
+        return ""
+
+    cut = offsets[-n][0]
+    if cut > 0 and text[cut - 1] != "\n":
+        newline = text.find("\n", cut)
+        if newline != -1:
+            cut = newline + 1
+    return text[cut:]
+
+
+def _keep_first_tokens(text, offsets, n):
+    """Keep at most the first n tokens of text, dropping the partial line at the cut"""
+    if n >= len(offsets):
+        return text
+    if n <= 0:
+        return ""
+
+    cut = offsets[n][0]
+    newline = text.rfind("\n", 0, cut)
+    if newline != -1:
+        cut = newline + 1
+    return text[:cut]
+
+
+def _count_kept(offsets, start, end):
+    return sum(1 for token_start, _ in offsets if start <= token_start < end)
+
+
+def fit_fim_prompt(tokenizer, prefix, suffix, budget):
+    """
+    Trim the FIM prefix and suffix around the cursor to fit in budget tokens.
+
+    The lines nearest to the cursor are kept: the end of the prefix and the
+    start of the suffix. The prefix gets at least three quarters of the budget.
+
+    Args:
+        tokenizer: Tokenizer of the models the prompt is sent to
+        prefix: Code before the cursor
+        suffix: Code after the cursor
+        budget: Maximum number of prefix and suffix tokens
+
+    Returns:
+        Tuple of (prefix, suffix, token counts)
+    """
+    prefix_offsets = _offsets(tokenizer, prefix)
+    suffix_offsets = _offsets(tokenizer, suffix)
+    counts = {
+        "prefix": len(prefix_offsets),
+        "suffix": len(suffix_offsets),
+        "truncated": False,
+    }
+    if len(prefix_offsets) + len(suffix_offsets) <= budget:
+        return prefix, suffix, counts
+
+    suffix_budget = min(len(suffix_offsets), budget // 4)
+    prefix_budget = min(len(prefix_offsets), budget - suffix_budget)
+    suffix_budget = budget - prefix_budget
+
+    trimmed_prefix = _keep_last_tokens(prefix, prefix_offsets, prefix_budget)
+    trimmed_suffix = _keep_first_tokens(suffix, suffix_offsets, suffix_budget)
+    counts.update(
+        {
+            "prefix_kept": _count_kept(prefix_offsets, len(prefix) - len(trimmed_prefix), len(prefix)),
+            "suffix_kept": _count_kept(suffix_offsets, 0, len(trimmed_suffix)),
+            "truncated": True,
+        }
+    )
+    return trimmed_prefix, trimmed_suffix, counts
+
+
+def fit_chat_prompt(tokenizer, prompt, budget):
+    """
+    Trim a chat prompt to fit in budget tokens, keeping its beginning.
+
+    Args:
+        tokenizer: Tokenizer of the models the prompt is sent to
+        prompt: The user's message
+        budget: Maximum number of prompt tokens
+
+    Returns:
+        Tuple of (prompt, token counts), counts["prompt"] is the untrimmed size
+    """
+    offsets = _offsets(tokenizer, prompt)
+    counts = {"prompt": len(offsets), "truncated": False}
+    if len(offsets) <= budget:
+        return prompt, counts
+
+    trimmed = _keep_first_tokens(prompt, offsets, budget)
+    counts.update(
+        {
+            "prompt_kept": _count_kept(offsets, 0, len(trimmed)),
+            "truncated": True,
+        }
+    )
+    return trimmed, counts
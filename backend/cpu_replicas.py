@@ -0,0 +1,342 @@
+import glob
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import threading
+
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+from config import Config
+from detokenizer import GenerationCancelled
+from model_loader import device
+
+logger = logging.getLogger(__name__)
+
+# How often a waiting generation checks that its replica is still alive
+LIVENESS_CHECK_SECONDS = 1.0
+
+# Responses that end a request
+FINAL_RESPONSES = ("done", "error")
+
+
+def replica_count(experiment_id):
+    """Replicas per arm an experiment is served with, 0 when it isn't replicated (or not on CPU)"""
+    if device != "cpu":
+        return 0
+    return Config.EXPERIMENTS[experiment_id].get("replicas", 0)
+
+
+def parse_cpulist(text):
+    """CPUs of a sysfs cpulist such as "0-3,8-11" """
+    cpus = set()
+    for part in text.strip().split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.update(range(int(start), int(end) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+
+def numa_nodes():
+    """CPUs this process may run on, grouped by NUMA node"""
+    allowed = os.sched_getaffinity(0)
+    paths = sorted(
+        glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"),
+        key=lambda path: int(re.search(r"node(\d+)/", path).group(1)),
+    )
+    nodes = []
+    for path in paths:
+        with open(path) as f:
+            cpus = parse_cpulist(f.read()) & allowed
+        if cpus:
+            nodes.append(sorted(cpus))
+    return nodes or [sorted(allowed)]
+
+
+def partition_cores(count, nodes):
+    """
+    Split CPUs into count disjoint sets of equal size. A set only spans NUMA
+    nodes when the cores left on the nodes can't fill it otherwise.
+
+    Raises:
+        ValueError: If there are fewer CPUs than sets
+    """
+    per_replica = sum(len(cpus) for cpus in nodes) // count
+    if per_replica == 0:
+        raise ValueError(f"{count} CPU replicas need at least {count} cores")
+
+    core_sets, leftover = [], []
+    for cpus in nodes:
+        while len(cpus) >= per_replica and len(core_sets) < count:
+            core_sets.append(cpus[:per_replica])
+            cpus = cpus[per_replica:]
+        leftover.extend(cpus)
+    while len(core_sets) < count:
+        core_sets.append(leftover[:per_replica])
+        leftover = leftover[per_replica:]
+    return core_sets
+
+
+class _ResponseStreamer(BaseStreamer):
+    """
+    Sends the generated ids of a request to the serving process as they come
+    (when it streams), and stops the generation once the request is cancelled.
+    """
+
+    def __init__(self, responses, request_id, cancelled, stream):
+        self.responses = responses
+        self.request_id = request_id
+        self.cancelled = cancelled
+        self.stream = stream
+        self.next_tokens_are_prompt = True
+
+    def put(self, value):
+        if self.request_id in self.cancelled:
+            raise GenerationCancelled()
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        if self.stream:
+            self.responses.put((self.request_id, "tokens", value.reshape(-1).tolist()))
+
+    def end(self):
+        pass
+
+
+def load_arm(experiment_id, arm, model_name):
+    """Load one arm of an experiment through its inference backend"""
+    from inference_backends import get_backend
+
+    backend = get_backend(experiment_id)
+    if arm == "base":
+        return backend.load_base(model_name)
+    return backend.load_finetuned(Config.EXPERIMENTS[experiment_id]["base"], model_name)
+
+
+def _read_requests(requests, queued, cancelled):
+    """Replica thread: queue the generation requests, and record cancellations as they come"""
+    while True:
+        item = requests.get()
+        if item is not None and item[0] == "cancel":
+            cancelled.add(item[1])
+            continue
+        queued.put(item)
+        if item is None:
+            return
+
+
+def _serve_replica(index, experiment_id, arm, model_name, cores, requests, responses):
+    """
+    Replica process: load the model pinned to its cores and run the requests
+    sent to it one at a time. A request cancelled while queued or running is
+    ended with an error response.
+
+    The affinity is set before loading, so the weights are first touched, and
+    allocated, on the NUMA node of the cores.
+    """
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+
+    from compiled_decoding import compiled_generate, enable_compiled_decoding
+    from inference_backends import get_backend
+
+    try:
+        model, tokenizer = load_arm(experiment_id, arm, model_name)
+        if Config.EXPERIMENTS[experiment_id].get("compile") and get_backend(experiment_id).torch_models:
+            enable_compiled_decoding(model, tokenizer)
+    except Exception as e:
+        responses.put((index, "failed", str(e)))
+        return
+    responses.put((index, "ready", tokenizer if index == 0 else None))
+
+    queued, cancelled = queue.Queue(), set()
+    threading.Thread(target=_read_requests, args=(requests, queued, cancelled), daemon=True).start()
+    while True:
+        item = queued.get()
+        if item is None:
+            return
+        _, request_id, kwargs = item
+        try:
+            kwargs["input_ids"] = torch.tensor(kwargs["input_ids"])
+            if kwargs.get("attention_mask") is not None:
+                kwargs["attention_mask"] = torch.tensor(kwargs["attention_mask"])
+            # Also passed to requests that don't stream, it's where cancellation is checked
+            kwargs["streamer"] = _ResponseStreamer(responses, request_id, cancelled, kwargs.pop("stream"))
+            with torch.no_grad():
+                outputs = compiled_generate(model, **kwargs)
+                if outputs is None:
+                    outputs = model.generate(**kwargs)
+            responses.put((request_id, "done", outputs.tolist()))
+        except GenerationCancelled:
+            responses.put((request_id, "error", "cancelled"))
+        except Exception as e:
+            responses.put((request_id, "error", str(e)))
+        finally:
+            cancelled.discard(request_id)
+
+
+class _Replica:
+    def __init__(self, index, cores, process, requests):
+        self.index = index
+        self.cores = cores
+        self.process = process
+        self.requests = requests
+        self.in_flight = 0
+
+
+class ReplicatedModel:
+    """
+    One experiment arm served by several model replicas on CPU, each in its own
+    process pinned to a disjoint set of cores with as many torch threads.
+
+    Concurrent generations on one model share torch's thread pool and
+    oversubscribe the cores; replicas each own their cores and run one
+    generation at a time, so throughput scales with the replicas. generate()
+    dispatches to the replica with the fewest queued and running requests and
+    streams its tokens back.
+    """
+
+    def __init__(self, experiment_id, arm, model_name, core_sets):
+        self.core_sets = core_sets
+        context = multiprocessing.get_context("spawn")
+        self._responses = context.Queue()
+        self._replicas = []
+        for index, cores in enumerate(core_sets):
+            requests = context.Queue()
+            process = context.Process(
+                target=_serve_replica,
+                args=(index, experiment_id, arm, model_name, cores, requests, self._responses),
+                daemon=True,
+            )
+            process.start()
+            self._replicas.append(_Replica(index, cores, process, requests))
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        # Requests given up on by their caller, and the replica still running them
+        self._abandoned = {}
+        self._request_ids = itertools.count()
+        try:
+            self.tokenizer = self._wait_ready()
+        except Exception:
+            self.close()
+            raise
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
+        logger.info(
+            f"Serving {model_name} with {len(core_sets)} CPU replicas on cores "
+            + "; ".join(f"{cores[0]}-{cores[-1]}" for cores in core_sets)
+        )
+
+    def _wait_ready(self):
+        tokenizer, ready = None, 0
+        while ready < len(self._replicas):
+            try:
+                index, state, value = self._responses.get(timeout=LIVENESS_CHECK_SECONDS)
+            except queue.Empty:
+                if not all(replica.process.is_alive() for replica in self._replicas):
+                    raise RuntimeError("A CPU replica exited while loading its model")
+                continue
+            if state == "failed":
+                raise RuntimeError(f"CPU replica {index} failed to load its model: {value}")
+            tokenizer = tokenizer or value
+            ready += 1
+        return tokenizer
+
+    def _read_responses(self):
+        while True:
+            message = self._responses.get()
+            if message is None:
+                return
+            request_id, kind, value = message
+            with self._lock:
+                results = self._pending.get(request_id)
+                if results is not None:
+                    results.put((kind, value))
+                elif kind in FINAL_RESPONSES and request_id in self._abandoned:
+                    self._abandoned.pop(request_id).in_flight -= 1
+
+    def _acquire(self):
+        with self._lock:
+            replica = min(self._replicas, key=lambda r: r.in_flight)
+            replica.in_flight += 1
+        return replica
+
+    def _finish(self, replica, request_id, results, finished):
+        """
+        Stop tracking a request. One its caller gave up on (e.g. a cancelled
+        stream) is cancelled on the replica, and counts as in flight until the
+        replica reports it ended, so no new work is routed to a busy replica.
+        """
+        with self._lock:
+            self._pending.pop(request_id, None)
+            while not finished and not results.empty():
+                finished = results.get()[0] in FINAL_RESPONSES
+            if finished or not replica.process.is_alive():
+                replica.in_flight -= 1
+            else:
+                self._abandoned[request_id] = replica
+                replica.requests.put(("cancel", request_id))
+
+    def generate(self, input_ids, attention_mask=None, streamer=None, **kwargs):
+        """Run model.generate() on the least loaded replica"""
+        replica = self._acquire()
+        request_id = next(self._request_ids)
+        results = queue.Queue()
+        self._pending[request_id] = results
+        finished = False
+        try:
+            if streamer is not None:
+                streamer.put(input_ids.cpu())
+            replica.requests.put(("generate", request_id, {
+                **kwargs,
+                "input_ids": input_ids.tolist(),
+                "attention_mask": attention_mask.tolist() if attention_mask is not None else None,
+                "stream": streamer is not None,
+            }))
+
+            while True:
+                try:
+                    kind, value = results.get(timeout=LIVENESS_CHECK_SECONDS)
+                except queue.Empty:
+                    if not replica.process.is_alive():
+                        raise RuntimeError(f"CPU replica {replica.index} exited")
+                    continue
+                if kind == "tokens":
+                    streamer.put(torch.tensor(value))
+                    continue
+                finished = True
+                if kind == "done":
+                    return torch.tensor(value)
+                raise RuntimeError(f"CPU replica {replica.index} failed: {value}")
+        finally:
+            if streamer is not None:
+                streamer.end()
+            self._finish(replica, request_id, results, finished)
+
+    def replicas(self):
+        return [
+            {
+                "index": replica.index,
+                "cores": replica.cores,
+                "in_flight": replica.in_flight,
+                "alive": replica.process.is_alive(),
+            }
+            for replica in self._replicas
+        ]
+
+    def close(self):
+        """Stop the replica processes"""
+        for replica in self._replicas:
+            replica.requests.put(None)
+        for replica in self._replicas:
+            replica.process.join(timeout=10)
+            if replica.process.is_alive():
+                replica.process.terminate()
+        self._responses.put(None)
@@ -0,0 +1,152 @@
+import asyncio
+import threading
+
+from transformers.generation.streamers import BaseStreamer
+
+# Tokens decoded again with every new token, so multi-byte characters split
+# over several byte-level tokens and merges across token boundaries come out right
+LOOKBACK_TOKENS = 6
+
+
+class GenerationCancelled(Exception):
+    """Raised in the generation thread by a streamer whose consumer cancelled it"""
+
+
+class IncrementalDetokenizer:
+    """
+    Turn generated token ids into text deltas, decoding only a small window
+    around the new ids instead of the whole sequence.
+
+    The window starts at prefix_offset, which trails read_offset (the end of
+    the text emitted so far) by up to lookback emitted tokens. Decoding the window
+    with and without the new ids gives the new text, unless it ends in an
+    incomplete character, in which case it is held back until the next ids.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True, lookback=LOOKBACK_TOKENS):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.lookback = lookback
+        self.ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def _decode(self, ids):
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+
+    def prime(self, prompt_ids):
+        """Use the end of the prompt as context for the first generated tokens, without emitting it"""
+        self.ids = list(prompt_ids[-self.lookback:])
+        self.prefix_offset = 0
+        self.read_offset = len(self.ids)
+
+    def add(self, token_ids):
+        """Add generated ids and return the text they complete, possibly empty"""
+        self.ids.extend(token_ids)
+        prefix_text = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+
+        # Everything is emitted, the last lookback ids stay as context for the next ones
+        self.ids = self.ids[-self.lookback:]
+        self.prefix_offset = 0
+        self.read_offset = len(self.ids)
+        return new_text[len(prefix_text):]
+
+    def flush(self):
+        """Text of ids held back at the end of generation"""
+        if self.read_offset == len(self.ids):
+            return ""
+        prefix_text = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.ids[self.prefix_offset:])
+        self.read_offset = len(self.ids)
+        return new_text[len(prefix_text):]
+
+
+class IncrementalTextStreamer(BaseStreamer):
+    """
+    Async counterpart of TextIteratorStreamer that detokenizes incrementally and
+    never emits the prompt. Supports a batch size of one.
+
+    Created on the event loop and iterated there with async for: the generation
+    thread hands the text over with call_soon_threadsafe, so waiting for the
+    next token never blocks the loop.
+
+    cancel() stops the generation: the next put() raises GenerationCancelled
+    out of generate().
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True, timeout=None):
+        self.detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens)
+        self.loop = asyncio.get_running_loop()
+        self.text_queue = asyncio.Queue()
+        self.stop_signal = None
+        self.timeout = timeout
+        self.next_tokens_are_prompt = True
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def put(self, value):
+        if self.cancelled.is_set():
+            raise GenerationCancelled()
+        if len(value.shape) > 1:
+            if value.shape[0] > 1:
+                raise ValueError("IncrementalTextStreamer only supports batch size 1")
+            value = value[0]
+
+        if self.next_tokens_are_prompt:
+            self.detokenizer.prime(value.tolist())
+            self.next_tokens_are_prompt = False
+            return
+
+        text = self.detokenizer.add(value.tolist())
+        if text:
+            self._send(text)
+
+    def end(self):
+        text = self.detokenizer.flush()
+        if text:
+            self._send(text)
+        self.next_tokens_are_prompt = True
+        self._send(self.stop_signal)
+
+    def _send(self, value):
+        self.loop.call_soon_threadsafe(self.text_queue.put_nowait, value)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        value = await asyncio.wait_for(self.text_queue.get(), self.timeout)
+        if value is self.stop_signal:
+            raise StopAsyncIteration()
+        return value
+
+
+class BatchTextStreamer(BaseStreamer):
+    """
+    Streamer for a batched generation that feeds every row to its own
+    IncrementalTextStreamer, iterated through rows[i].
+
+    Rows are buffered independently, so one can be consumed while the others
+    keep filling up.
+    """
+
+    def __init__(self, tokenizer, batch_size, skip_special_tokens=True, timeout=None):
+        self.rows = [
+            IncrementalTextStreamer(tokenizer, skip_special_tokens, timeout)
+            for _ in range(batch_size)
+        ]
+
+    def put(self, value):
+        # The prompt comes as (batch, length), each step as (batch,)
+        value = value.reshape(len(self.rows), -1)
+        for row, ids in zip(self.rows, value):
+            row.put(ids)
+
+    def end(self):
+        for row in self.rows:
+            row.end()
@@ -0,0 +1,120 @@
+import logging
+import threading
+
+from config import Config
+from models import Experiment, Session as DBSession
+
+logger = logging.getLogger(__name__)
+
+
+class ExperimentRegistry:
+    """
+    In-memory map between experiment_id strings and experiments table ids,
+    with the configuration of each experiment.
+
+    Synced with the experiments table at startup, after which the table is
+    only read again when an experiment is created.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._names = {}
+
+    def sync(self):
+        """Create rows for configured experiments that have none and load all rows"""
+        db_session = DBSession()
+        try:
+            known = {e.experiment_id for e in db_session.query(Experiment)}
+            configured = list(Config.OLD_EXPERIMENTS) + list(Config.EXPERIMENTS)
+            created = [Experiment(experiment_id=name) for name in configured if name not in known]
+            if created:
+                db_session.add_all(created)
+                db_session.commit()
+                logger.info(f"Registered experiments: {', '.join(e.experiment_id for e in created)}")
+
+            with self._lock:
+                self._ids.clear()
+                self._names.clear()
+                for experiment in db_session.query(Experiment).order_by(Experiment.id):
+                    self._add(experiment)
+        finally:
+            db_session.close()
+
+    def _add(self, experiment):
+        self._ids[experiment.experiment_id] = experiment.id
+        self._names[experiment.id] = experiment.experiment_id
+
+    def get_id(self, name):
+        """experiments table id of an experiment_id string, None if it isn't registered"""
+        return self._ids.get(name)
+
+    def get_name(self, experiment_id):
+        """experiment_id string of an experiments table id, None if it isn't registered"""
+        return self._names.get(experiment_id)
+
+    def get_or_create_id(self, name):
+        """experiments table id of name, creating the experiment when it has no row yet"""
+        experiment_id = self._ids.get(name)
+        if experiment_id is not None:
+            return experiment_id
+
+        with self._lock:
+            if name in self._ids:
+                return self._ids[name]
+            db_session = DBSession()
+            try:
+                experiment = db_session.query(Experiment).filter(Experiment.experiment_id == name).first()
+                if experiment is None:
+                    experiment = Experiment(experiment_id=name)
+                    db_session.add(experiment)
+                    db_session.commit()
+                    logger.info(f"Registered experiment {name}")
+                self._add(experiment)
+                return experiment.id
+            finally:
+                db_session.close()
+
+    def items(self):
+        """(experiment_id string, table id) of every registered experiment, oldest first"""
+        return sorted(self._ids.items(), key=lambda item: item[1])
+
+    @staticmethod
+    def config(name):
+        """Configuration of a current or old experiment, None if it isn't configured"""
+        return Config.EXPERIMENTS.get(name) or Config.OLD_EXPERIMENTS.get(name)
+
+    def model_names(self, name):
+        """
+        Base and finetuned model names of a configured experiment.
+
+        Returns:
+            Tuple of (base model name, finetuned model name), or None
+        """
+        config = self.config(name)
+        if config is None:
+            return None
+        return config["base"], config["fineTuned"]
+
+    def resolve(self, name):
+        """
+        Experiment preferences are submitted for, with the models it compares.
+
+        Only configured experiments (current or old) are accepted, registered on
+        their first use; submissions without an experiment compare the FIM models.
+
+        Returns:
+            Tuple of (experiments table id or None, base model name, finetuned model name)
+
+        Raises:
+            ValueError: If the experiment isn't configured
+        """
+        if not name:
+            return None, Config.FIM_BASE_MODEL_NAME, Config.FIM_FINETUNED_MODEL_NAME
+        model_names = self.model_names(name)
+        if model_names is None:
+            raise ValueError(f"Unknown experiment: {name}")
+        return (self.get_or_create_id(name), *model_names)
+
+
+registry = ExperimentRegistry()
@@ -0,0 +1,182 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from config import Config
+from metrics import metrics
+
+# Priority classes, in dispatch order: batch requests only get a generation
+# slot when no interactive request is waiting
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+
+
+class RateLimited(Exception):
+    """The user has no request tokens left, retry_after is the seconds until the next one"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Allows burst requests at once, refilled at rate requests per second"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take a token, returns 0 on success or the seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Waiter:
+    def __init__(self, username, priority):
+        self.username = username
+        self.priority = priority
+        self.future = Future()
+        self.enqueued = time.monotonic()
+
+
+class FairShareScheduler:
+    """
+    Admission to the generation slots, shared fairly between users.
+
+    Interactive requests are rate limited per user with a token bucket. Up to
+    concurrency generations run at a time; the others wait in a FIFO queue per
+    user, and freed slots go to the waiting users in turn, so a user with many
+    queued requests delays everyone else by at most one generation. Batch
+    traffic (e.g. filling the completion pool) isn't rate limited and only gets
+    slots no interactive request is waiting for.
+
+    Queue waits are recorded per user and per priority class under fair_share.wait.
+    """
+
+    def __init__(self, concurrency, rate_per_minute, burst):
+        self.concurrency = concurrency
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._running = 0
+        self._buckets = {}
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+
+    def submit(self, username, priority=INTERACTIVE):
+        """
+        Queue a request for a generation slot.
+
+        Returns:
+            Future resolved once the slot is granted, the caller must release() it
+
+        Raises:
+            RateLimited: If an interactive request is over the user's rate
+        """
+        waiter = _Waiter(username, priority)
+        with self._lock:
+            if priority == INTERACTIVE:
+                bucket = self._buckets.setdefault(username, TokenBucket(self.rate, self.burst))
+                retry_after = bucket.take()
+                if retry_after:
+                    metrics.incr(f"fair_share.rejected.{username}")
+                    raise RateLimited(retry_after)
+            self._queues[priority].setdefault(username, deque()).append(waiter)
+            self._dispatch()
+        return waiter.future
+
+    def _next_waiter(self):
+        for priority in PRIORITIES:
+            users = self._queues[priority]
+            if users:
+                # The user served goes to the back of the line
+                username, waiters = users.popitem(last=False)
+                waiter = waiters.popleft()
+                if waiters:
+                    users[username] = waiters
+                return waiter
+        return None
+
+    def _dispatch(self):
+        while self._running < self.concurrency:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            # The request was abandoned while waiting (e.g. the client disconnected)
+            if not waiter.future.set_running_or_notify_cancel():
+                continue
+
+            self._running += 1
+            wait = time.monotonic() - waiter.enqueued
+            metrics.observe(f"fair_share.wait.{waiter.priority}", wait)
+            metrics.observe(f"fair_share.wait.user.{waiter.username}", wait)
+            waiter.future.set_result(None)
+
+    def release(self):
+        """Free a granted slot for the next waiting request"""
+        with self._lock:
+            self._running -= 1
+            self._dispatch()
+
+    async def acquire(self, username, priority=INTERACTIVE):
+        """Wait for a generation slot from a request handler, the caller must release() it"""
+        future = self.submit(username, priority)
+        try:
+            await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Granted just as the request was cancelled
+            if not future.cancel():
+                self.release()
+            raise
+
+    @contextmanager
+    def lease(self, username, priority=BATCH):
+        """Hold a generation slot from a worker thread"""
+        self.submit(username, priority).result()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def status(self):
+        with self._lock:
+            return {
+                "running": self._running,
+                "concurrency": self.concurrency,
+                "waiting": {
+                    priority: {username: len(waiters) for username, waiters in users.items()}
+                    for priority, users in self._queues.items()
+                },
+            }
+
+
+def queue_wait_stats():
+    """Queue wait summaries per priority class and per user, in seconds."""
+    summaries = metrics.snapshot()["summaries"]
+    stats = {"classes": {}, "users": {}}
+    for name, summary in summaries.items():
+        if not name.startswith("fair_share.wait."):
+            continue
+        key = name[len("fair_share.wait."):]
+        summary = {k: round(v, 3) for k, v in summary.items()}
+        if key.startswith("user."):
+            stats["users"][key[len("user."):]] = summary
+        else:
+            stats["classes"][key] = summary
+    return stats
+
+
+fair_share = FairShareScheduler(
+    Config.GENERATION_CONCURRENCY, Config.USER_REQUESTS_PER_MINUTE, Config.USER_REQUEST_BURST
+)
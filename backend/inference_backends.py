@@ -0,0 +1,100 @@
+from abc import ABC, abstractmethod
+
+import torch
+
+from config import Config
+from model_loader import load_base_model, load_peft_model
+
+
+class InferenceBackend(ABC):
+    """
+    How the models of an experiment are loaded and run.
+
+    Backends return (model, tokenizer) pairs. The model only has to implement
+    the subset of model.generate() the app uses: input_ids, attention_mask,
+    max_new_tokens, min_new_tokens, temperature, do_sample and streamer,
+    returning the prompt and generated ids.
+    """
+
+    name = None
+
+    # Whether models are transformers models, as assisted generation, prompt
+    # lookup, compiled decoding and mixed-adapter batching require
+    torch_models = False
+
+    @abstractmethod
+    def load_base(self, model_name):
+        """Load a base model"""
+
+    @abstractmethod
+    def load_finetuned(self, base_model, adapter_name):
+        """Load a finetuned model from its LoRA adapter on base_model"""
+
+
+class TorchBackend(InferenceBackend):
+    """transformers (or unsloth) models, loaded with their load profile"""
+
+    name = "torch"
+    torch_models = True
+
+    def load_base(self, model_name):
+        return load_base_model(model_name)
+
+    def load_finetuned(self, base_model, adapter_name):
+        return load_peft_model(base_model, adapter_name)
+
+
+class OnnxBackend(InferenceBackend):
+    """int8 ONNX Runtime models on CPU, exported on first use"""
+
+    name = "onnx"
+
+    def load_base(self, model_name):
+        from onnx_backend import load_onnx_model
+
+        return load_onnx_model(model_name)
+
+    def load_finetuned(self, base_model, adapter_name):
+        from onnx_backend import load_onnx_model
+
+        return load_onnx_model(adapter_name, base_model=base_model)
+
+
+BACKENDS = {backend.name: backend for backend in (TorchBackend(), OnnxBackend())}
+
+
+def get_backend(experiment_id):
+    """
+    Inference backend configured for an experiment.
+
+    Raises:
+        ValueError: If the configured backend doesn't exist
+    """
+    name = Config.EXPERIMENTS[experiment_id].get("inference_backend", "torch")
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown inference backend '{name}' for {experiment_id}. Use one of: {', '.join(BACKENDS)}"
+        )
+    return BACKENDS[name]
+
+
+def sample_token(logits, generation_config, temperature=1.0, do_sample=False):
+    """
+    Pick the next token of each row from its logits, like generate() does with
+    the temperature, top_k and top_p of generation_config.
+    """
+    if not do_sample:
+        return logits.argmax(dim=-1)
+
+    logits = logits / max(temperature, 1e-5)
+    top_k = generation_config.top_k
+    if top_k:
+        threshold = torch.topk(logits, min(top_k, logits.shape[-1])).values[..., -1, None]
+        logits = logits.masked_fill(logits < threshold, float("-inf"))
+    top_p = generation_config.top_p
+    if top_p is not None and top_p < 1.0:
+        sorted_logits, sorted_ids = torch.sort(logits, descending=True)
+        probs = sorted_logits.softmax(dim=-1)
+        remove = probs.cumsum(dim=-1) - probs > top_p
+        logits = logits.masked_fill(remove.scatter(-1, sorted_ids, remove), float("-inf"))
+    return torch.multinomial(logits.softmax(dim=-1), num_samples=1)[:, 0]
@@ -1,30 +1,52 @@
 import asyncio
 from enum import Enum
 import threading
-from peft import PeftModel
 import torch
-from fastapi import FastAPI, Request, HTTPException, Form, Query
+from fastapi import FastAPI, Request, HTTPException, Form, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import (
     RedirectResponse,
     JSONResponse,
     StreamingResponse,
 )
-import platform
 from authlib.integrations.starlette_client import OAuth
 from user_management import Session as UsersDBSession, User
-from models import Experiment, Session as DBSession, ComparisonResult, Mode
+from models import Blob, Experiment, Session as DBSession, ComparisonResult, Mode
 import random
 from config import Config
 import secrets
 from starlette.middleware.sessions import SessionMiddleware
 from typing import Optional
-from sqlalchemy import or_, select, case
-from migration import migrate_database
-from transformers import TextIteratorStreamer
+from sqlalchemy import or_, select, case, func
+from sqlalchemy.orm import aliased
+from migration import run_migrations
+from speculative import attach_draft_model, generate_with_draft, generate_with_prompt_lookup, speculative_stats
+from model_loader import device, load_base_model, load_peft_model, max_seq_length, prepare_for_inference
+from model_slots import ARMS, ModelVersion, model_slots
+from mixed_batching import AdapterView, is_mixed_pair, load_mixed_model
+from compiled_decoding import compiled_generate, enable_compiled_decoding
+from inference_backends import get_backend
+import weights_cache
+from fair_share import BATCH, INTERACTIVE, PRIORITIES, RateLimited, fair_share, queue_wait_stats
+from stream_buffer import StreamBuffer, stream_registry
+from ws_protocol import Cancelled, Error, Generate, decode_frame, encode_frame, event_frame
+from collaboration import MODEL_LETTERS, collaborations
+from cpu_replicas import ReplicatedModel, load_arm, numa_nodes, partition_cores, replica_count
+from context_budget import fit_chat_prompt, fit_fim_prompt
+from completion_pool import fill_pool, next_pool_item
+from rollups import PREFERRED_MODELS, get_trends, prune_rollups, record_preference
+from analysis import analysis
+from preference_batch import insert_batch, parse_batch
+from experiment_registry import registry
+from apscheduler.schedulers.background import BackgroundScheduler
+from detokenizer import BatchTextStreamer, GenerationCancelled, IncrementalTextStreamer
 import csv
 import io
 import json
+import math
+import textwrap
+import msgspec
+from datetime import datetime, timedelta
 
 import logging
 
@@ -37,8 +59,10 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-# TODO: remove this and implement a migration system
-migrate_database()
+# Bring the database schema up to date, a no-op once it is current
+run_migrations()
+# Register configured experiments and load the experiment_id <-> id map
+registry.sync()
 
 # Session configuration
 app.add_middleware(
@@ -75,75 +99,206 @@ oauth.register(
 )
 
 
-def get_device():
-    if torch.cuda.is_available():
-        return "cuda"
-    elif torch.backends.mps.is_available():
-        return "mps"
-    return "cpu"
+max_new_tokens = 512
 
+# Tokens left for the prompt once room for the completion is reserved
+prompt_token_budget = max_seq_length - max_new_tokens
 
-device = get_device()
-IS_MACOS = platform.system() == "Darwin"
+def load_draft_model(experiment_id, model, tokenizer):
+    """
+    Load the draft model configured for an experiment, reusing the FIM base model when possible.
 
-max_seq_length = 2048
-dtype = None
-load_in_4bit = True and not IS_MACOS
+    Returns:
+        Tuple of (draft model, draft tokenizer), (None, None) without a usable draft
+    """
+    draft_model_name = Config.EXPERIMENTS[experiment_id].get("draft")
+    if not draft_model_name:
+        return None, None
+
+    # Only a transformers model of its own can be a draft model, not an adapter view or an ONNX model
+    fim_base = model_slots.current("FIM_CODEGATE", "base")
+    if draft_model_name == fim_base.name and isinstance(fim_base.model, torch.nn.Module):
+        draft_model, draft_tokenizer = fim_base.model, fim_base.tokenizer
+    else:
+        draft_model, draft_tokenizer = load_base_model(draft_model_name)
 
+    logger.info(f"Using {draft_model_name} as draft model for {experiment_id}")
+    draft_model = attach_draft_model(model, tokenizer, draft_model, draft_tokenizer)
+    return (draft_model, draft_tokenizer) if draft_model is not None else (None, None)
 
-def load_base_model(model_name):
-    global load_in_4bit
 
-    if IS_MACOS:
-        from transformers import AutoModelForCausalLM, AutoTokenizer
+def pair_draft_models(old, new, versions):
+    """
+    Keep draft models paired when a reload swaps old for new: the new version
+    inherits the old one's draft, re-checked against its tokenizer, and arms
+    drafting with the old model (e.g. the FIM base model) draft with the new
+    one instead, so the old model can be released.
+    """
+    if old.draft_model is not None:
+        new.draft_model = attach_draft_model(new.model, new.tokenizer, old.draft_model, old.draft_tokenizer)
+        new.draft_tokenizer = old.draft_tokenizer if new.draft_model is not None else None
 
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            device_map="auto",
-            torch_dtype=torch.float32 if device == "mps" else torch.float16,
+    for version in versions:
+        if version.draft_model is None or version.draft_model is not old.model:
+            continue
+        # Only a transformers model of its own can be a draft model, not an adapter view or an ONNX model
+        draft_model = None
+        if isinstance(new.model, torch.nn.Module):
+            draft_model = attach_draft_model(version.model, version.tokenizer, new.model, new.tokenizer)
+        version.draft_model = draft_model
+        version.draft_tokenizer = new.tokenizer if draft_model is not None else None
+        logger.info(
+            f"Paired {version.name} with draft model {new.name}" if draft_model is not None
+            else f"Disabled assisted generation for {version.name}, {new.name} can't be its draft model"
         )
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-    else:
-        from unsloth import FastLanguageModel
 
-        model, tokenizer = FastLanguageModel.from_pretrained(
-            model_name=model_name,
-            max_seq_length=max_seq_length,
-            dtype=dtype,
-            load_in_4bit=load_in_4bit,
-        )
+model_slots.on_swap(pair_draft_models)
+
+
+# The models serving each arm of every active experiment live in model_slots,
+# so they can be swapped at runtime. No other reference to them is kept, or
+# swapped out models could never be released.
+
+def load_mixed_arms(experiment_id):
+    """
+    Serve both arms of an experiment from one adapter model when it has mixed
+    batching enabled, so comparisons decode as a single batch of two.
+
+    Returns:
+        Whether the arms were registered
+    """
+    config = Config.EXPERIMENTS[experiment_id]
+    if not config.get("mixed_batching") or not serves_torch_models(experiment_id):
+        return False
+    loaded = load_mixed_model(config["base"], config["fineTuned"])
+    if loaded is None:
+        return False
+
+    base_view, finetuned_view, tokenizer = loaded
+    model_slots.register(experiment_id, "base", ModelVersion(config["base"], base_view, tokenizer))
+    model_slots.register(experiment_id, "fineTuned", ModelVersion(config["fineTuned"], finetuned_view, tokenizer))
+    return True
+
+
+def load_replicated_arms(experiment_id):
+    """
+    Serve each arm of an experiment from CPU replicas when it has replicas
+    configured. The cores are split between all replicas of both arms, which
+    alternate so every NUMA node serves both arms.
+
+    Returns:
+        Whether the arms were registered
+    """
+    count = replica_count(experiment_id)
+    if not count:
+        return False
+
+    core_sets = partition_cores(count * len(ARMS), numa_nodes())
+    for i, arm in enumerate(ARMS):
+        model_name = Config.EXPERIMENTS[experiment_id][arm]
+        model = ReplicatedModel(experiment_id, arm, model_name, core_sets[i::len(ARMS)])
+        model_slots.register(experiment_id, arm, ModelVersion(model_name, model, model.tokenizer))
+    return True
+
+
+def serves_torch_models(experiment_id):
+    """
+    Whether the arms of an experiment are transformers models in this process,
+    as assisted generation, prompt lookup and mixed batching require
+    """
+    return get_backend(experiment_id).torch_models and not replica_count(experiment_id)
+
+
+def compile_if_enabled(experiment_id, model, tokenizer):
+    """Set up compiled decoding for a model when its experiment enables it (replicas compile their own)"""
+    if (
+        Config.EXPERIMENTS[experiment_id].get("compile")
+        and serves_torch_models(experiment_id)
+        and not isinstance(model, AdapterView)
+    ):
+        enable_compiled_decoding(model, tokenizer)
     return model, tokenizer
 
 
-def load_peft_model(base_model, peft_model):
-    if IS_MACOS:
-        model, tokenizer = load_base_model(base_model)
-        model = PeftModel.from_pretrained(model, peft_model)
+# Load FIM models, through the inference backend of the experiment
+if not load_replicated_arms("FIM_CODEGATE") and not load_mixed_arms("FIM_CODEGATE"):
+    model_slots.register(
+        "FIM_CODEGATE", "base",
+        ModelVersion(
+            Config.FIM_BASE_MODEL_NAME,
+            *compile_if_enabled("FIM_CODEGATE", *load_arm("FIM_CODEGATE", "base", Config.FIM_BASE_MODEL_NAME)),
+        ),
+    )
+    model_slots.register(
+        "FIM_CODEGATE", "fineTuned",
+        ModelVersion(
+            Config.FIM_FINETUNED_MODEL_NAME,
+            *compile_if_enabled(
+                "FIM_CODEGATE", *load_arm("FIM_CODEGATE", "fineTuned", Config.FIM_FINETUNED_MODEL_NAME)
+            ),
+        ),
+    )
+
+# Load CHAT models, with a draft model shared by both arms so they stay comparable.
+# Assisted generation doesn't support mixed-adapter batches, so those have no draft.
+if not load_mixed_arms("CHAT_CODEGATE"):
+    chat_base_model, chat_base_tokenizer = load_base_model(Config.CHAT_BASE_MODEL_NAME)
+    chat_draft_model, chat_draft_tokenizer = load_draft_model(
+        "CHAT_CODEGATE", chat_base_model, chat_base_tokenizer
+    )
+    model_slots.register(
+        "CHAT_CODEGATE", "base",
+        ModelVersion(
+            Config.CHAT_BASE_MODEL_NAME, chat_base_model, chat_base_tokenizer,
+            draft_model=chat_draft_model, draft_tokenizer=chat_draft_tokenizer,
+        ),
+    )
+    model_slots.register(
+        "CHAT_CODEGATE", "fineTuned",
+        ModelVersion(
+            Config.CHAT_FINETUNED_MODEL_NAME,
+            *load_peft_model(Config.CHAT_BASE_MODEL_NAME, Config.CHAT_FINETUNED_MODEL_NAME),
+            draft_model=chat_draft_model,
+            draft_tokenizer=chat_draft_tokenizer,
+        ),
+    )
+    del chat_base_model, chat_base_tokenizer, chat_draft_model, chat_draft_tokenizer
+
+
+def load_experiment_model(experiment_id, arm, model_name):
+    """
+    Load a new version of an experiment arm and warm it up, for ModelSlots.reload().
+
+    Draft models are paired with it by pair_draft_models() when it is swapped in.
+    """
+    # Prepared weights are rebuilt if the hub has a newer revision by now
+    weights_cache.forget_revisions()
+    current = model_slots.current(experiment_id, arm)
+    if isinstance(current.model, ReplicatedModel):
+        # The old replicas keep their cores until they are drained
+        model = ReplicatedModel(experiment_id, arm, model_name, current.model.core_sets)
+        tokenizer = model.tokenizer
     else:
-        from unsloth import FastLanguageModel
+        model, tokenizer = load_arm(experiment_id, arm, model_name)
+        compile_if_enabled(experiment_id, model, tokenizer)
 
-        model, tokenizer = FastLanguageModel.from_pretrained(
-            model_name=peft_model,
-            max_seq_length=max_seq_length,
-            dtype=dtype,
-            load_in_4bit=load_in_4bit,
-        )
+    # One short generation, so the first request doesn't pay for lazy initialization
+    mode = Config.EXPERIMENTS[experiment_id]["mode"]
+    warm_up_prompt = {"prefix": "def add(a, b):\n", "suffix": ""} if mode == "fim" else "Hello"
+    test_completion(model, tokenizer, [warm_up_prompt], mode=mode, max_tokens=8)
     return model, tokenizer
 
 
-# Load FIM models
-fim_base_model, fim_base_tokenizer = load_base_model(Config.FIM_BASE_MODEL_NAME)
-fim_finetuned_model, fim_finetuned_tokenizer = load_peft_model(
-    Config.FIM_BASE_MODEL_NAME, Config.FIM_FINETUNED_MODEL_NAME
-)
+# Background jobs, started with the app
+scheduler = BackgroundScheduler()
 
-# Load CHAT models
-chat_base_model, chat_base_tokenizer = load_base_model(Config.CHAT_BASE_MODEL_NAME)
-chat_finetuned_model, chat_finetuned_tokenizer = load_peft_model(
-    Config.CHAT_BASE_MODEL_NAME, Config.CHAT_FINETUNED_MODEL_NAME
-)
+def prompt_lookup_tokens(experiment_id):
+    """Candidate tokens prompt lookup decoding proposes per step for an experiment, 0 when it is off"""
+    if experiment_id not in Config.EXPERIMENTS or not serves_torch_models(experiment_id):
+        return 0
+    return Config.EXPERIMENTS[experiment_id].get("prompt_lookup_tokens", 0)
 
-def test_completion(model, tokenizer, prompt, mode="fim"):
+def test_completion(model, tokenizer, prompt, mode="fim", draft_model=None, experiment_id=None, max_tokens=None, adapter_names=None):
     """
     Generate completions with proper preservation of whitespace and indentation.
     
@@ -152,6 +307,10 @@ def test_completion(model, tokenizer, prompt, mode="fim"):
         tokenizer: The tokenizer corresponding to the model
         prompt: List of input prompts
         mode: Either "fim" (Fill-in-Middle) or "chat"
+        draft_model: Optional draft model for assisted generation (single prompt only)
+        experiment_id: Experiment the assisted generation metrics are recorded under
+        max_tokens: Maximum number of new tokens, defaults to max_new_tokens
+        adapter_names: LoRA adapter of each prompt, for a model serving both arms of an experiment
         
     Returns:
         List of generated completions
@@ -167,15 +326,25 @@ def test_completion(model, tokenizer, prompt, mode="fim"):
             for x in prompt
         ]
 
-    if not IS_MACOS:
-        from unsloth import FastLanguageModel
-        FastLanguageModel.for_inference(model)
+    prepare_for_inference(model)
 
     inputs = tokenizer(prompt, return_tensors="pt").to(device)
 
-    outputs = model.generate(
-        **inputs, max_new_tokens=512, use_cache=True, temperature=0.1, do_sample=True
+    generation_kwargs = dict(
+        **inputs, max_new_tokens=max_tokens or max_new_tokens, use_cache=True, temperature=0.1, do_sample=True
     )
+    if adapter_names is not None:
+        generation_kwargs["adapter_names"] = adapter_names
+
+    lookup_tokens = prompt_lookup_tokens(experiment_id)
+    if draft_model is not None and len(prompt) == 1:
+        outputs = generate_with_draft(model, draft_model, experiment_id, **generation_kwargs)
+    elif lookup_tokens and len(prompt) == 1 and adapter_names is None:
+        outputs = generate_with_prompt_lookup(model, lookup_tokens, experiment_id, **generation_kwargs)
+    else:
+        outputs = compiled_generate(model, **generation_kwargs)
+        if outputs is None:
+            outputs = model.generate(**generation_kwargs)
 
     outputs = tokenizer.batch_decode(outputs)
 
@@ -198,14 +367,69 @@ def test_completion(model, tokenizer, prompt, mode="fim"):
 
     return outputs
 
+def complete_pair(base, finetuned, prompts, mode, experiment_id):
+    """
+    Base and finetuned completions of prompts. Arms served by one adapter
+    model are decoded together, as a single batch with the adapter applied
+    to the finetuned rows only.
+
+    Args:
+        base: Leased ModelVersion of the base arm
+        finetuned: Leased ModelVersion of the finetuned arm
+
+    Returns:
+        Tuple of (base completions, finetuned completions)
+    """
+    if prompts and is_mixed_pair(base.model, finetuned.model):
+        outputs = test_completion(
+            finetuned.model, finetuned.tokenizer, prompts * 2, mode=mode,
+            adapter_names=[base.model.adapter_name] * len(prompts) + [finetuned.model.adapter_name] * len(prompts),
+        )
+        return outputs[:len(prompts)], outputs[len(prompts):]
+
+    base_response = test_completion(
+        base.model, base.tokenizer, prompts, mode=mode,
+        draft_model=base.draft_model, experiment_id=experiment_id,
+    )
+    peft_response = test_completion(
+        finetuned.model, finetuned.tokenizer, prompts, mode=mode,
+        draft_model=finetuned.draft_model, experiment_id=experiment_id,
+    )
+    return base_response, peft_response
+
 @app.get("/")
 async def home():
     return {"message": "API is running"}
 
+@app.on_event("startup")
+async def start_scheduler():
+    if Config.POOL_CORPUS_PATH:
+        scheduler.add_job(
+            fill_completion_pools,
+            "interval",
+            minutes=Config.POOL_FILL_INTERVAL_MINUTES,
+            max_instances=1,
+            next_run_time=datetime.now(),
+        )
+    scheduler.add_job(prune_rollups, "interval", hours=1, max_instances=1)
+    scheduler.add_job(
+        flush_collaboration_votes, "interval", seconds=Config.COLLABORATION_FLUSH_SECONDS, max_instances=1
+    )
+    scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    scheduler.shutdown(wait=False)
+    # Votes still in memory would be lost
+    flush_collaboration_votes()
+
 class Mode(str, Enum):
     FIM = "fim"
     CHAT = "chat"
 
+# Experiment served for each generation mode
+MODE_EXPERIMENTS = {Mode.FIM: "FIM_CODEGATE", Mode.CHAT: "CHAT_CODEGATE"}
+
 def prepare_prompt(text, mode, prefix=None, suffix=None):
     """Create prompt based on generation mode with proper FIM formatting"""
     if mode == Mode.FIM:
@@ -216,296 +440,554 @@ def prepare_prompt(text, mode, prefix=None, suffix=None):
     elif mode == Mode.CHAT:
         return f"""<|im_start|>system\nYou are an expert on the Codegate project. Answer user's questions accurately.<|im_end|>\n<|im_start|>user\n{text.strip()}<|im_end|>\n<|im_start|>assistant\n"""
 
-async def process_fim(model, tokenizer, inputs, model_letter):
+def fit_prompt(tokenizer, mode, prefix=None, suffix=None, prompt=None):
+    """
+    Enforce the context budget on user input before it reaches the models.
+
+    FIM prefix and suffix are trimmed around the cursor. Chat prompts over the
+    budget are rejected, or trimmed when CHAT_PROMPT_OVERFLOW is "trim".
+
+    Returns:
+        Tuple of (prefix, suffix, prompt, token counts)
+    """
+    template_tokens = len(tokenizer(prepare_prompt("", mode, "", ""))["input_ids"])
+    budget = prompt_token_budget - template_tokens
+
+    if mode == Mode.FIM:
+        prefix, suffix, counts = fit_fim_prompt(tokenizer, prefix or "", suffix or "", budget)
+    else:
+        prompt, counts = fit_chat_prompt(tokenizer, prompt, budget)
+        if counts["truncated"] and Config.CHAT_PROMPT_OVERFLOW != "trim":
+            raise HTTPException(
+                status_code=413,
+                detail=f"Prompt is {counts['prompt']} tokens long, the limit is {budget} tokens",
+            )
+    return prefix, suffix, prompt, counts
+
+async def process_fim(model, tokenizer, inputs, model_letter, tokens=None, experiment_id=None):
     """
     Process streaming of FIM completions with proper newline placement.
     Ensures the first token has a newline at the beginning, not within the indentation.
+
+    tokens streams the text of a generation that is already running (e.g. a row
+    of a mixed-adapter batch) instead of starting one.
     """
-    # Create the streamer
-    streamer = TextIteratorStreamer(
-        tokenizer, 
-        skip_special_tokens=True,
-        timeout=10.0
-    )
-    
-    # Start generation thread
-    thread = threading.Thread(
-        target=lambda: model.generate(
-            **inputs,
-            streamer=streamer,
-            max_new_tokens=512,
-            temperature=0.1,
-            do_sample=True
+    if tokens is None:
+        # Create the streamer, it only emits the generated tokens
+        tokens = IncrementalTextStreamer(
+            tokenizer,
+            skip_special_tokens=True,
+            timeout=10.0
         )
-    )
-    thread.daemon = True
-    thread.start()
+
+        # Start generation thread
+        thread = threading.Thread(
+            target=lambda: run_cancellable(
+                run_generation,
+                model,
+                inputs,
+                experiment_id=experiment_id,
+                streamer=tokens,
+                max_new_tokens=max_new_tokens,
+                temperature=0.1,
+                do_sample=True
+            )
+        )
+        thread.daemon = True
+        thread.start()
     
-    # Variables to track generation state
-    in_special_tokens = True
-    accumulated_text = ""
-    last_sent_pos = 0
-    is_first_real_token = True
+    try:
+        # Variables to track generation state
+        accumulated_text = ""
+        last_sent_pos = 0
+        is_first_real_token = True
     
-    # Initially send a newline as the very first token
-    if is_first_real_token:
-        yield "data: " + json.dumps({
-            "type": "token",
-            "model": model_letter,
-            "text": "\n"
-        }) + "\n\n"
-        is_first_real_token = False
+        # Initially send a newline as the very first token
+        if is_first_real_token:
+            yield {
+                "type": "token",
+                "model": model_letter,
+                "text": "\n"
+            }
+            is_first_real_token = False
     
-    # Process tokens
-    for token in streamer:
-        # Skip special tokens at the beginning
-        if in_special_tokens:
-            if "<|" in token or token.strip() in ["system", "user", "assistant"]:
-                continue
-            in_special_tokens = False
+        # Process tokens
+        async for token in tokens:
+            # Clean any FIM markers
+            clean_token = token.replace("<|fim_suffix|>", "").replace("<|fim_middle|>", "")
         
-        # Clean any FIM markers
-        clean_token = token.replace("<|fim_suffix|>", "").replace("<|fim_middle|>", "")
-        
-        # Only process if the token has content
-        if not clean_token:
-            continue
+            # Only process if the token has content
+            if not clean_token:
+                continue
         
-        # Add to accumulated text
-        accumulated_text += clean_token
+            # Add to accumulated text
+            accumulated_text += clean_token
         
-        # Send updates at reasonable intervals
-        current_pos = len(accumulated_text)
-        if current_pos > last_sent_pos + 5:  # Send after accumulating 5+ characters
-            new_content = accumulated_text[last_sent_pos:]
+            # Send updates at reasonable intervals
+            current_pos = len(accumulated_text)
+            if current_pos > last_sent_pos + 5:  # Send after accumulating 5+ characters
+                new_content = accumulated_text[last_sent_pos:]
             
-            # Only send if there's meaningful content
-            if new_content:
-                yield "data: " + json.dumps({
+                # Only send if there's meaningful content
+                if new_content:
+                    yield {
+                        "type": "token",
+                        "model": model_letter,
+                        "text": new_content
+                    }
+                
+                    last_sent_pos = current_pos
+                    await asyncio.sleep(0)  # Force flush
+    
+        # Send any remaining content
+        if len(accumulated_text) > last_sent_pos:
+            remaining = accumulated_text[last_sent_pos:]
+            if remaining:
+                yield {
                     "type": "token",
                     "model": model_letter,
-                    "text": new_content
-                }) + "\n\n"
-                
-                last_sent_pos = current_pos
-                await asyncio.sleep(0)  # Force flush
+                    "text": remaining
+                }
+    except BaseException:
+        # The events aren't consumed anymore (e.g. the client cancelled the
+        # stream), stop the generation instead of letting it run to the end
+        tokens.cancel()
+        raise
+
+def run_generation(model, inputs, draft_model=None, experiment_id=None, **kwargs):
+    """
+    Run model.generate(), through assisted generation when a draft model is
+    given, prompt lookup decoding when the experiment enables it, or the
+    compiled decode path when the model has one and can serve the request
+    """
+    if draft_model is not None:
+        return generate_with_draft(model, draft_model, experiment_id, **inputs, **kwargs)
+    lookup_tokens = prompt_lookup_tokens(experiment_id)
+    if lookup_tokens:
+        return generate_with_prompt_lookup(model, lookup_tokens, experiment_id, **inputs, **kwargs)
+    outputs = compiled_generate(model, **inputs, **kwargs)
+    if outputs is not None:
+        return outputs
+    return model.generate(**inputs, **kwargs)
+
+def run_cancellable(generate, *args, **kwargs):
+    """Generation thread target, a generation cancelled through its streamer ends quietly"""
+    try:
+        return generate(*args, **kwargs)
+    except GenerationCancelled:
+        logger.info("Generation cancelled")
+
+async def process_chat(model, tokenizer, inputs, model_letter, draft_model=None, experiment_id=None, tokens=None):
+    """
+    Process streaming for chat mode, handling code blocks.
+
+    tokens streams the text of a generation that is already running (e.g. a row
+    of a mixed-adapter batch) instead of starting one.
+    """
+    if tokens is None:
+        # The streamer only emits the generated tokens, never the prompt
+        tokens = IncrementalTextStreamer(
+            tokenizer,
+            skip_special_tokens=True,
+            timeout=10.0
+        )
+
+        thread = threading.Thread(
+            target=lambda: run_cancellable(
+                run_generation,
+                model,
+                inputs,
+                draft_model=draft_model,
+                experiment_id=experiment_id,
+                streamer=tokens,
+                max_new_tokens=max_new_tokens,
+                temperature=0.1,
+                do_sample=True
+            )
+        )
+        thread.daemon = True
+        thread.start()
+
+    try:
+        # Variables for code block handling.
+        in_code_block = False
+        code_content = ""
+
+        async for token in tokens:
+            # Check for code block markers.
+            if "```" in token:
+                if not in_code_block:
+                    # Starting a code block.
+                    in_code_block = True
+                    parts = token.split("```", 1)
+                    # Yield any text before the code block marker.
+                    if parts[0]:
+                        yield {
+                            "type": "token",
+                            "model": model_letter,
+                            "text": parts[0]
+                        }
+                    # Begin code accumulation with the opening fence.
+                    code_content = "```"
+                    if len(parts) > 1:
+                        code_content += parts[1]
+                else:
+                    # Ending a code block.
+                    code_content += token
+                    yield {
+                        "type": "token",
+                        "model": model_letter,
+                        "text": code_content,
+                        "is_code_block": True
+                    }
+                    in_code_block = False
+                    code_content = ""
+                continue
+
+            # If we are inside a code block, keep accumulating tokens.
+            if in_code_block:
+                code_content += token
+                continue
+
+            # Otherwise, yield tokens normally. Deltas can be whitespace only,
+            # e.g. a newline, which has to reach the client too.
+            if token:
+                yield {
+                    "type": "token",
+                    "model": model_letter,
+                    "text": token
+                }
+                await asyncio.sleep(0) 
     
-    # Send any remaining content
-    if len(accumulated_text) > last_sent_pos:
-        remaining = accumulated_text[last_sent_pos:]
-        if remaining:
-            yield "data: " + json.dumps({
+        # Send any remaining code block at the end
+        if in_code_block and code_content:
+            # If code block wasn't closed, add closing backticks
+            if not code_content.endswith("```"):
+                code_content += "```"
+            
+            yield {
                 "type": "token",
                 "model": model_letter,
-                "text": remaining
-            }) + "\n\n"
+                "text": code_content,
+                "is_code_block": True
+            }
+    except BaseException:
+        # The events aren't consumed anymore (e.g. the client cancelled the
+        # stream), stop the generation instead of letting it run to the end
+        tokens.cancel()
+        raise
 
-async def process_chat(model, tokenizer, inputs, model_letter):
+def start_mixed_generation(arm_a, arm_b, inputs):
     """
-    Process streaming for chat mode while filtering out the system prompt and handling code blocks.
+    Decode both arms of a comparison as one batch of two over their shared
+    base weights, with each arm's adapter applied to its own row.
+
+    Returns:
+        Tuple of the text streams of arm A and arm B
     """
-    streamer = TextIteratorStreamer(
-        tokenizer, 
-        skip_special_tokens=True,
-        timeout=10.0
-    )
-    
+    streamer = BatchTextStreamer(arm_a.tokenizer, 2, skip_special_tokens=True, timeout=10.0)
+    batch = {key: value.repeat(2, 1) for key, value in inputs.items()}
     thread = threading.Thread(
-        target=lambda: model.generate(
-            **inputs,
+        target=lambda: run_cancellable(
+            arm_a.model.peft_model.generate,
+            **batch,
+            adapter_names=[arm_a.model.adapter_name, arm_b.model.adapter_name],
             streamer=streamer,
-            max_new_tokens=512,
+            max_new_tokens=max_new_tokens,
             temperature=0.1,
             do_sample=True
         )
     )
     thread.daemon = True
     thread.start()
+    return streamer.rows[0], streamer.rows[1]
 
-    # Variables for filtering out the system prompt.
-    buffer = ""
-    system_prompt_removed = False
-    marker = "assistant\n"
-
-    # Variables for code block handling.
-    in_code_block = False
-    code_content = ""
-
-    for token in streamer:
-        # Remove system prompt until marker is found.
-        if not system_prompt_removed:
-            buffer += token
-            if marker in buffer:
-                # Once marker is found, split and yield the remaining text (if any).
-                _, remainder = buffer.split(marker, 1)
-                if remainder.strip():
-                    yield "data: " + json.dumps({
-                        "type": "token",
-                        "model": model_letter,
-                        "text": remainder
-                    }) + "\n\n"
-                system_prompt_removed = True
-                buffer = ""
-            continue
+async def acquire_generation_slot(username, priority=INTERACTIVE):
+    """Wait for a fair-share generation slot for a user, 429 when over their rate"""
+    try:
+        await fair_share.acquire(username, priority)
+    except RateLimited as e:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many generation requests, try again later",
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
 
-        # Now process tokens normally.
-        # Check for code block markers.
-        if "```" in token:
-            if not in_code_block:
-                # Starting a code block.
-                in_code_block = True
-                parts = token.split("```", 1)
-                # Yield any text before the code block marker.
-                if parts[0]:
-                    yield "data: " + json.dumps({
-                        "type": "token",
-                        "model": model_letter,
-                        "text": parts[0]
-                    }) + "\n\n"
-                # Begin code accumulation with the opening fence.
-                code_content = "```"
-                if len(parts) > 1:
-                    code_content += parts[1]
-            else:
-                # Ending a code block.
-                code_content += token
-                yield "data: " + json.dumps({
-                    "type": "token",
-                    "model": model_letter,
-                    "text": code_content,
-                    "is_code_block": True
-                }) + "\n\n"
-                in_code_block = False
-                code_content = ""
-            continue
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+    "Content-Encoding": "identity"  # Disable compression
+}
+
+def sse_event(event):
+    return "data: " + json.dumps(event) + "\n\n"
+
+def stream_response(stream, after_seq=0):
+    """SSE response following a generation stream, each event with its resumable id"""
+    async def events():
+        async for seq, event in stream.follow(after_seq):
+            yield f"id: {stream.stream_id}:{seq}\n" + sse_event(event)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+def resume_stream(request, last_event_id):
+    """Replay the events of a running or recently finished stream after Last-Event-ID, then follow it"""
+    stream_id, _, seq = last_event_id.partition(":")
+    if not seq.isdigit():
+        raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    stream = stream_registry.get(stream_id)
+    if (
+        stream is None
+        or stream.username != request.session["user"]["username"]
+        or not stream.can_resume(int(seq))
+    ):
+        raise HTTPException(status_code=410, detail="The stream can't be resumed anymore")
+    return stream_response(stream, int(seq))
 
-        # If we are inside a code block, keep accumulating tokens.
-        if in_code_block:
-            code_content += token
-            continue
+async def start_comparison(stream, username, mode, prefix=None, suffix=None, prompt=None, reveal_arms=True):
+    """
+    Generate the completions of both arms into stream, from a task that runs
+    independently of the clients following the stream.
 
-        # Otherwise, yield tokens normally.
-        if token.strip():
-            yield "data: " + json.dumps({
-                "type": "token",
-                "model": model_letter,
-                "text": token
-            }) + "\n\n"
-            await asyncio.sleep(0) 
-    
-    # Send any remaining code block at the end
-    if in_code_block and code_content:
-        # If code block wasn't closed, add closing backticks
-        if not code_content.endswith("```"):
-            code_content += "```"
-            
-        yield "data: " + json.dumps({
-            "type": "token",
-            "model": model_letter,
-            "text": code_content,
-            "is_code_block": True
-        }) + "\n\n"
+    Args:
+        stream: StreamBuffer the events are appended to
+        username: User the generation slot is held for
+        mode: Mode.FIM (prefix and suffix) or Mode.CHAT (prompt)
+        reveal_arms: Whether the header event tells which model is the base one
 
-@app.post("/api/generate-stream")
-async def generate_stream(
-    request: Request,
-    mode: Mode = Form(...),
-    prefix: Optional[str] = Form(None),
-    suffix: Optional[str] = Form(None),
-    prompt: Optional[str] = Form(None),
-    experiment_id: Optional[str] = Form(None),
-):
-    """
-    Streaming endpoint with fixed code block handling.
+    Returns:
+        Tuple of (whether model A is the base model, prompt used as {"prefix", "suffix"}),
+        the prompt being trimmed to the context budget
     """
-    # Authentication check
-    if "user" not in request.session:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    # Input validation
-    if mode == Mode.FIM and prefix is None:
-        raise HTTPException(status_code=400, detail="Prefix is required for FIM mode")
-    if mode == Mode.CHAT and (not prompt or prompt.strip() == ""):
-        raise HTTPException(status_code=400, detail="Prompt is required for CHAT mode")
-    
     # Select which model is base vs finetuned
     model_a_is_base = random.choice([True, False])
     
-    # Select models based on mode
-    if mode == Mode.FIM:
-        model_a = fim_base_model if model_a_is_base else fim_finetuned_model
-        tokenizer_a = fim_base_tokenizer if model_a_is_base else fim_finetuned_tokenizer
-        model_b = fim_finetuned_model if model_a_is_base else fim_base_model
-        tokenizer_b = fim_finetuned_tokenizer if model_a_is_base else fim_base_tokenizer
-        prepared_prompt = prepare_prompt(None, mode, prefix, suffix or "")
-    else:  # CHAT mode
-        model_a = chat_base_model if model_a_is_base else chat_finetuned_model
-        tokenizer_a = chat_base_tokenizer if model_a_is_base else chat_finetuned_tokenizer
-        model_b = chat_finetuned_model if model_a_is_base else chat_base_model
-        tokenizer_b = chat_finetuned_tokenizer if model_a_is_base else chat_base_tokenizer
-        prepared_prompt = prepare_prompt(prompt, mode)
-    
-    # Tokenize inputs
-    inputs_a = tokenizer_a([prepared_prompt], return_tensors="pt").to(device)
-    inputs_b = tokenizer_b([prepared_prompt], return_tensors="pt").to(device)
-    
-    # True streaming generator
-    async def token_stream():
+    # Hold a generation slot and lease both arms for the whole stream, so a
+    # model reload waits for it
+    try:
+        await acquire_generation_slot(username)
+    except (HTTPException, asyncio.CancelledError):
+        stream.finish()
+        raise
+    experiment_id = MODE_EXPERIMENTS[mode]
+    base = model_slots.acquire(experiment_id, "base")
+    finetuned = model_slots.acquire(experiment_id, "fineTuned")
+
+    def release_models():
+        base.release()
+        finetuned.release()
+        fair_share.release()
+
+    try:
+        arm_a, arm_b = (base, finetuned) if model_a_is_base else (finetuned, base)
+        model_a, tokenizer_a = arm_a.model, arm_a.tokenizer
+        model_b, tokenizer_b = arm_b.model, arm_b.tokenizer
+        if mode == Mode.FIM:
+            prefix, suffix, _, prompt_tokens = fit_prompt(tokenizer_a, mode, prefix=prefix, suffix=suffix)
+            prepared_prompt = prepare_prompt(None, mode, prefix, suffix)
+            used_prompt = {"prefix": prefix, "suffix": suffix}
+        else:  # CHAT mode
+            _, _, prompt, prompt_tokens = fit_prompt(tokenizer_a, mode, prompt=prompt)
+            prepared_prompt = prepare_prompt(prompt, mode)
+            used_prompt = {"prefix": prompt, "suffix": ""}
+
+        # Tokenize inputs once, both arms share the base model's tokenizer
+        inputs_a = tokenizer_a([prepared_prompt], return_tensors="pt").to(device)
+        inputs_b = inputs_a
+    except Exception:
+        release_models()
+        stream.finish()
+        raise
+
+    # The generation runs in its own task and fills the stream's buffer, so it
+    # outlives a dropped connection and the client can resume it. The stream
+    # cancels the task when no client comes back within its abandon grace
+    async def generate_events():
+        try:
+            async for event in model_events():
+                stream.append(event)
+        except Exception as e:
+            logger.error(f"Error generating stream {stream.stream_id}: {e}")
+        finally:
+            release_models()
+            stream.finish()
+
+    async def model_events():
         # Send header first with immediate flush
-        yield "data: " + json.dumps({
-            "type": "header",
-            "modelAIsBase": model_a_is_base
-        }) + "\n\n"
+        header = {"type": "header", "streamId": stream.stream_id, "promptTokens": prompt_tokens}
+        if reveal_arms:
+            header["modelAIsBase"] = model_a_is_base
+        yield header
         
+        # Arms served by one adapter model are decoded together, model B's
+        # text is buffered while model A's is streamed
+        tokens_a = tokens_b = None
+        if is_mixed_pair(base.model, finetuned.model):
+            tokens_a, tokens_b = start_mixed_generation(arm_a, arm_b, inputs_a)
+
         # Model A streaming
-        yield "data: " + json.dumps({"type": "model_start", "model": "A"}) + "\n\n"
+        yield {"type": "model_start", "model": "A"}
         
         # Handle based on mode
         if mode == Mode.FIM:
             # Process FIM mode with improved newline placement
-            async for event in process_fim(model_a, tokenizer_a, inputs_a, "A"):
+            async for event in process_fim(model_a, tokenizer_a, inputs_a, "A", tokens=tokens_a, experiment_id=experiment_id):
                 yield event
         else:
             # Use the improved chat processing function
-            async for event in process_chat(model_a, tokenizer_a, inputs_a, "A"):
+            async for event in process_chat(
+                model_a, tokenizer_a, inputs_a, "A",
+                draft_model=arm_a.draft_model, experiment_id=experiment_id, tokens=tokens_a
+            ):
                 yield event
         
         # End Model A
-        yield "data: " + json.dumps({"type": "model_end", "model": "A"}) + "\n\n"
+        yield {"type": "model_end", "model": "A"}
         
         # Short pause between models
         await asyncio.sleep(0.2)
         
         # Model B streaming
-        yield "data: " + json.dumps({"type": "model_start", "model": "B"}) + "\n\n"
+        yield {"type": "model_start", "model": "B"}
         
         # Handle based on mode
         if mode == Mode.FIM:
             # Process FIM mode with improved newline placement
-            async for event in process_fim(model_b, tokenizer_b, inputs_b, "B"):
+            async for event in process_fim(model_b, tokenizer_b, inputs_b, "B", tokens=tokens_b, experiment_id=experiment_id):
                 yield event
         else:
             # Use the improved chat processing function
-            async for event in process_chat(model_b, tokenizer_b, inputs_b, "B"):
+            async for event in process_chat(
+                model_b, tokenizer_b, inputs_b, "B",
+                draft_model=arm_b.draft_model, experiment_id=experiment_id, tokens=tokens_b
+            ):
                 yield event
         
         # End Model B
-        yield "data: " + json.dumps({"type": "model_end", "model": "B"}) + "\n\n"
+        yield {"type": "model_end", "model": "B"}
         
         # Complete the stream
-        yield "data: " + json.dumps({"type": "complete"}) + "\n\n"
+        yield {"type": "complete"}
+    
+    stream.start(asyncio.create_task(generate_events()))
+    return model_a_is_base, used_prompt
+
+@app.post("/api/generate-stream")
+async def generate_stream(
+    request: Request,
+    mode: Mode = Form(...),
+    prefix: Optional[str] = Form(None),
+    suffix: Optional[str] = Form(None),
+    prompt: Optional[str] = Form(None),
+    experiment_id: Optional[str] = Form(None),
+):
+    """
+    Streaming endpoint with fixed code block handling.
+    """
+    # Authentication check
+    if "user" not in request.session:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    # A client reconnecting to a dropped stream picks it up where it left off
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id:
+        return resume_stream(request, last_event_id)
     
+    # Input validation
+    if mode == Mode.FIM and prefix is None:
+        raise HTTPException(status_code=400, detail="Prefix is required for FIM mode")
+    if mode == Mode.CHAT and (not prompt or prompt.strip() == ""):
+        raise HTTPException(status_code=400, detail="Prompt is required for CHAT mode")
+    
+    stream = stream_registry.create(request.session["user"]["username"])
+    await start_comparison(stream, request.session["user"]["username"], mode, prefix, suffix, prompt)
+
     # Return streaming response with specific settings to prevent buffering
-    return StreamingResponse(
-        token_stream(), 
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-            "Content-Encoding": "identity"  # Disable compression
-        }
-    )
+    return stream_response(stream)
+
+@app.websocket("/api/ws")
+async def generation_socket(websocket: WebSocket):
+    """
+    WebSocket alternative to /api/generate-stream: one connection per client
+    carries any number of comparisons, multiplexed by stream id, in compact
+    msgpack frames (see ws_protocol). A comparison stops, generation thread
+    included, when the client cancels it or disconnects.
+    """
+    # Browsers send the session cookie along from any site, and CORS doesn't apply
+    origin = websocket.headers.get("origin")
+    if "user" not in websocket.session or origin not in (None, Config.FRONTEND_URL):
+        await websocket.close(code=1008)
+        return
+    username = websocket.session["user"]["username"]
+    await websocket.accept()
+
+    tasks = {}
+    send_lock = asyncio.Lock()
+
+    async def send(frame):
+        async with send_lock:
+            await websocket.send_bytes(encode_frame(frame))
+
+    async def run_comparison(frame):
+        stream = StreamBuffer(str(frame.stream), username, Config.STREAM_BUFFER_EVENTS)
+        try:
+            try:
+                mode = Mode(frame.mode)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid mode. Use 'fim' or 'chat'.")
+            if mode == Mode.FIM and frame.prefix is None:
+                raise HTTPException(status_code=400, detail="Prefix is required for FIM mode")
+            if mode == Mode.CHAT and (not frame.prompt or frame.prompt.strip() == ""):
+                raise HTTPException(status_code=400, detail="Prompt is required for CHAT mode")
+
+            await start_comparison(stream, username, mode, frame.prefix, frame.suffix, frame.prompt)
+            async for _, event in stream.follow():
+                await send(event_frame(frame.stream, event))
+            if not stream.events or stream.events[-1][1]["type"] != "complete":
+                await send(Error(frame.stream, 500, "Generation failed"))
+        except HTTPException as e:
+            await send(Error(frame.stream, e.status_code, str(e.detail)))
+        except asyncio.CancelledError:
+            if stream.task is not None:
+                # Wait for the generation to let go of its slot and models
+                stream.task.cancel()
+                await asyncio.gather(stream.task, return_exceptions=True)
+            raise
+        except Exception as e:
+            logger.error(f"Error in WebSocket stream {frame.stream}: {e}")
+            await send(Error(frame.stream, 500, "Generation failed"))
+        finally:
+            if tasks.get(frame.stream) is asyncio.current_task():
+                del tasks[frame.stream]
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            try:
+                frame = decode_frame(message.get("bytes") or b"")
+            except msgspec.DecodeError as e:
+                await websocket.close(code=1003, reason=str(e))
+                return
+            if isinstance(frame, Generate):
+                if frame.stream in tasks:
+                    await send(Error(frame.stream, 409, "The stream id is already in use"))
+                else:
+                    tasks[frame.stream] = asyncio.create_task(run_comparison(frame))
+            elif frame.stream in tasks:
+                # Generation tasks wait for tokens off the loop, so this is
+                # read, and the task cancelled, while a token is pending
+                task = tasks.pop(frame.stream)
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await send(Cancelled(frame.stream))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in tasks.values():
+            task.cancel()
 
 @app.post("/api/generate")
 async def generate(
@@ -514,54 +996,55 @@ async def generate(
     prefix: Optional[str] = Form(None),
     suffix: Optional[str] = Form(None),
     prompt: Optional[str] = Form(None),
+    priority: str = Form(INTERACTIVE),
 ):
     """
-    Endpoint that generate code from the model
+    Endpoint that generate code from the model, admin scripts (e.g. evaluations)
+    should send priority=batch
     """
 
     if "user" not in request.session:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
-    if mode == "fim":
+    if mode not in MODE_EXPERIMENTS:
+        raise HTTPException(
+            status_code=400, detail="Invalid mode. Use 'fim' or 'chat'."
+        )
+    if priority not in PRIORITIES:
+        raise HTTPException(
+            status_code=400, detail=f"Invalid priority. Use one of: {', '.join(PRIORITIES)}"
+        )
+    # Batch requests aren't rate limited, only admins may send them
+    if priority == BATCH and not is_admin(request.session["user"]["username"]):
+        priority = INTERACTIVE
+    experiment_id = MODE_EXPERIMENTS[mode]
+    tokenizer = model_slots.current(experiment_id, "base").tokenizer
+
+    if mode == Mode.FIM:
         if prefix is None:
             raise HTTPException(
                 status_code=400, detail="Prefix is required for FIM mode"
             )
-
-    elif mode == "chat":
+        prefix, suffix, _, _ = fit_prompt(tokenizer, Mode.FIM, prefix=prefix, suffix=suffix)
+        prompts = [{"prefix": prefix, "suffix": suffix}]
+    else:
         if not prompt or prompt.strip() == "":
-            chat_prompt = []
+            prompts = []
         else:
-            chat_prompt = [prompt]
-
-    else:
-        raise HTTPException(
-            status_code=400, detail="Invalid mode. Use 'fim' or 'chat'."
-        )
+            _, _, prompt, _ = fit_prompt(tokenizer, Mode.CHAT, prompt=prompt)
+            prompts = [prompt]
 
     model_a_is_base = random.choice([True, False])
 
-    if mode == "fim":
-        base_response = test_completion(
-            fim_base_model,
-            fim_base_tokenizer,
-            [{"prefix": prefix, "suffix": suffix}],
-            mode="fim",
-        )
-        peft_response = test_completion(
-            fim_finetuned_model,
-            fim_finetuned_tokenizer,
-            [{"prefix": prefix, "suffix": suffix}],
-            mode="fim",
-        )
-
-    elif mode == "chat":
-        base_response = test_completion(
-            chat_base_model, chat_base_tokenizer, chat_prompt, mode="chat"
-        )
-        peft_response = test_completion(
-            chat_finetuned_model, chat_finetuned_tokenizer, chat_prompt, mode="chat"
-        )
+    await acquire_generation_slot(request.session["user"]["username"], priority)
+    try:
+        with model_slots.lease(experiment_id, "base") as base, model_slots.lease(experiment_id, "fineTuned") as finetuned:
+            # Off the event loop, so other requests can queue for a slot meanwhile
+            base_response, peft_response = await asyncio.to_thread(
+                complete_pair, base, finetuned, prompts, mode.value, experiment_id
+            )
+    finally:
+        fair_share.release()
 
     print(f"Model A is {'base' if model_a_is_base else 'finetuned'} model")
 
@@ -572,45 +1055,198 @@ async def generate(
     }
 
 
+def generate_pool_pair(experiment_id, prompt):
+    """
+    Generate the base and finetuned completions of a pool item, from the prompt
+    trimmed to the context budget. None if the prompt is too long.
+    """
+    mode = Mode(Config.EXPERIMENTS[experiment_id]["mode"])
+    tokenizer = model_slots.current(experiment_id, "base").tokenizer
+
+    try:
+        if mode == Mode.FIM:
+            prefix, suffix, _, _ = fit_prompt(tokenizer, mode, prefix=prompt["prefix"], suffix=prompt["suffix"])
+            prompts = [{"prefix": prefix, "suffix": suffix}]
+            used_prompt = prompts[0]
+        else:
+            _, _, chat_prompt, _ = fit_prompt(tokenizer, mode, prompt=prompt["prefix"])
+            prompts = [chat_prompt]
+            used_prompt = {"prefix": chat_prompt, "suffix": ""}
+    except HTTPException as e:
+        logger.warning(f"Skipping pool prompt for {experiment_id}: {e.detail}")
+        return None
+
+    # Pool filling is batch traffic, it only runs when no user is waiting
+    with fair_share.lease("completion-pool", BATCH), \
+            model_slots.lease(experiment_id, "base") as base, \
+            model_slots.lease(experiment_id, "fineTuned") as finetuned:
+        base_completions, finetuned_completions = complete_pair(base, finetuned, prompts, mode.value, experiment_id)
+    return used_prompt, base_completions[0], finetuned_completions[0]
+
+
+def fill_completion_pools():
+    for experiment_id in model_slots.experiments():
+        fill_pool(experiment_id, generate_pool_pair)
+
+
+@app.get("/api/pool/next")
+async def get_next_pool_item(request: Request, experiment_id: str):
+    """
+    Hand out a pre-generated pair of completions the user hasn't rated yet.
+    """
+    if "user" not in request.session:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if experiment_id not in Config.EXPERIMENTS:
+        raise HTTPException(status_code=404, detail=f"Unknown experiment '{experiment_id}'")
+
+    db_session = DBSession()
+    try:
+        item = next_pool_item(db_session, experiment_id, request.session["user"]["username"])
+        if item is None:
+            raise HTTPException(status_code=404, detail="No unrated completions left in the pool")
+
+        model_a_is_base = random.choice([True, False])
+        return {
+            "id": item.id,
+            "experimentId": experiment_id,
+            "mode": Config.EXPERIMENTS[experiment_id]["mode"],
+            "prefix": item.code_prefix,
+            "suffix": item.code_suffix,
+            "baseModelName": item.base_model_name,
+            "finetunedModelName": item.finetuned_model_name,
+            "modelA": item.base_completion if model_a_is_base else item.finetuned_completion,
+            "modelB": item.finetuned_completion if model_a_is_base else item.base_completion,
+            "modelAIsBase": model_a_is_base,
+        }
+    finally:
+        db_session.close()
+
+
+@app.post("/api/admin/pool/fill")
+async def trigger_pool_fill(request: Request):
+    """Fill the completion pools now instead of waiting for the scheduled job"""
+    if "user" not in request.session or not is_admin(
+        request.session["user"]["username"]
+    ):
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if not Config.POOL_CORPUS_PATH:
+        raise HTTPException(status_code=400, detail="POOL_CORPUS_PATH is not configured")
+
+    scheduler.add_job(fill_completion_pools, max_instances=1)
+    return {"success": True}
+
+
+@app.get("/api/admin/models")
+async def get_served_models(request: Request):
+    """Model versions serving every experiment arm and the state of their last reload"""
+    if "user" not in request.session or not is_admin(
+        request.session["user"]["username"]
+    ):
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return {"models": model_slots.status()}
+
+
+@app.post("/api/admin/models/reload", status_code=202)
+async def reload_model(request: Request):
+    """
+    Load a new model version for an experiment arm without downtime.
+
+    Takes {"experimentId", "arm": "base" | "fineTuned", "modelName"}, where
+    modelName is an adapter for the finetuned arm. The model is loaded and
+    warmed up in the background, then swapped in; streams already running on
+    the old version finish on it before it is released. Progress is reported
+    by GET /api/admin/models.
+    """
+    if "user" not in request.session or not is_admin(
+        request.session["user"]["username"]
+    ):
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    data = await request.json()
+    experiment_id = data.get("experimentId")
+    arm = data.get("arm", "fineTuned")
+    model_name = data.get("modelName")
+    if arm not in ARMS:
+        raise HTTPException(status_code=400, detail="arm must be 'base' or 'fineTuned'")
+    if not model_name:
+        raise HTTPException(status_code=400, detail="modelName is required")
+
+    try:
+        model_slots.reload(experiment_id, arm, model_name, load_experiment_model)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=e.args[0])
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"success": True, "models": model_slots.status()}
+
+
 @app.post("/api/submit-preference")
 async def submit_preference(request: Request):
     if "user" not in request.session:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
     data = await request.json()
-    db_session = DBSession()
+    if data.get("preferredModel") not in PREFERRED_MODELS:
+        raise HTTPException(status_code=400, detail="preferredModel must be 'base' or 'finetuned'")
+    experiment_id_str = data.get("experimentId", None)
+    try:
+        experiment_id, base_model_name, finetuned_model_name = registry.resolve(experiment_id_str)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
+    db_session = DBSession()
     try:
-        # Get the experiment_id string from the request
-        experiment_id_str = data.get("experimentId", None)
-        experiment = None
-        
-        if experiment_id_str:
-            # Look up the experiment in the database
-            experiment = db_session.query(Experiment).filter(
-                Experiment.experiment_id == experiment_id_str
-            ).first()
-            
-            # If it doesn't exist, create it
-            if not experiment:
-                experiment = Experiment(experiment_id=experiment_id_str)
-                db_session.add(experiment)
-                db_session.flush()  # Get the ID without committing
-        
+        created_at = datetime.utcnow()
         result = ComparisonResult(
             github_username=request.session["user"]["username"],
-            base_model_name=data.get("baseModelName", Config.FIM_BASE_MODEL_NAME),
-            finetuned_model_name=data.get("finetunedModelName", Config.FIM_FINETUNED_MODEL_NAME),
+            base_model_name=base_model_name,
+            finetuned_model_name=finetuned_model_name,
             preferred_model=data["preferredModel"],
-            code_prefix=data.get("codePrefix", ""),
-            base_completion=data["baseCompletion"],
-            finetuned_completion=data["finetunedCompletion"],
-            experiment_id=experiment.id if experiment else None
+            code_prefix_hash=Blob.put(db_session, data.get("codePrefix", "")),
+            base_completion_hash=Blob.put(db_session, data["baseCompletion"], compress=True),
+            finetuned_completion_hash=Blob.put(db_session, data["finetunedCompletion"], compress=True),
+            experiment_id=experiment_id,
+            created_at=created_at
         )
 
         db_session.add(result)
+        record_preference(db_session, experiment_id_str, result.preferred_model, created_at)
+        db_session.commit()
+        return {"success": True}
+    except Exception as e:
+        db_session.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        db_session.close()
+
+
+@app.post("/api/submit-preferences")
+async def submit_preferences(request: Request):
+    """
+    Submit many preferences at once, as a JSON array or NDJSON (one object per line).
+
+    Items take the fields of /api/submit-preference. Valid items are inserted in
+    one transaction, invalid ones are reported by their position in the batch.
+    """
+    if "user" not in request.session:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    username = request.session["user"]["username"]
+    try:
+        parsed = parse_batch(await request.body(), request.headers.get("content-type", ""))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(parsed) > Config.BATCH_SUBMIT_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch has {len(parsed)} items, the limit is {Config.BATCH_SUBMIT_MAX_ITEMS}",
+        )
+
+    db_session = DBSession()
+    try:
+        inserted, errors = insert_batch(db_session, parsed, username, allow_username=is_admin(username))
         db_session.commit()
-        return {"success": True}
+        return {"success": not errors, "inserted": inserted, "errors": errors}
     except Exception as e:
         db_session.rollback()
         raise HTTPException(status_code=500, detail=str(e))
@@ -710,32 +1346,92 @@ def is_admin(username: str) -> bool:
     finally:
         db_session.close()
 
-@app.get("/api/admin/results")
-async def get_results(
-    request: Request,
-    page: int = Query(1, ge=1),
-    per_page: int = Query(10, ge=1, le=100),
-    search: Optional[str] = None,
-    experiment_id: Optional[str] = None,
-):
-    if "user" not in request.session or not is_admin(
-        request.session["user"]["username"]
-    ):
-        raise HTTPException(status_code=403, detail="Not authorized")
+# Length of the prompt and completion previews in the compact results listing
+RESULT_PREVIEW_LENGTH = 100
 
-    db_session = DBSession()
-    
-    # Join the ComparisonResult and Experiment tables
-    query = db_session.query(ComparisonResult, Experiment).outerjoin(
-        Experiment, ComparisonResult.experiment_id == Experiment.id
-    )
 
+def result_to_dict(r, exp):
+    """Full representation of a comparison result, completions included"""
+    return {
+        "id": r.id,
+        "github_username": r.github_username,
+        "preferred_model": r.preferred_model,
+        "code_prefix": r.code_prefix,
+        "base_completion": r.base_completion,
+        "finetuned_completion": r.finetuned_completion,
+        "created_at": r.created_at.isoformat(),
+        "base_model_name": r.base_model_name,
+        "finetuned_model_name": r.finetuned_model_name,
+        "experiment_id": exp.experiment_id if exp else None,
+        "completions": [
+            {
+                "model": "base",
+                "completion": r.base_completion,
+                "is_selected": r.preferred_model == "base",
+            },
+            {
+                "model": "finetuned",
+                "completion": r.finetuned_completion,
+                "is_selected": r.preferred_model == "finetuned",
+            },
+        ],
+    }
+
+
+def compact_result_columns():
+    """
+    Columns of the compact results listing by name, with the blob each one
+    needs joined as (alias, hash column). Previews are truncated in SQL, those
+    of compressed completions are filled in by add_compressed_previews().
+    """
+    prefix_blob, base_blob, finetuned_blob = aliased(Blob), aliased(Blob), aliased(Blob)
+    return {
+        "id": (ComparisonResult.id, None),
+        "github_username": (ComparisonResult.github_username, None),
+        "preferred_model": (ComparisonResult.preferred_model, None),
+        "created_at": (ComparisonResult.created_at, None),
+        "base_model_name": (ComparisonResult.base_model_name, None),
+        "finetuned_model_name": (ComparisonResult.finetuned_model_name, None),
+        "experiment_id": (Experiment.experiment_id, None),
+        "code_prefix_preview": (
+            func.substr(prefix_blob.text, 1, RESULT_PREVIEW_LENGTH),
+            (prefix_blob, ComparisonResult.code_prefix_hash),
+        ),
+        "base_completion_preview": (
+            func.substr(base_blob.text, 1, RESULT_PREVIEW_LENGTH),
+            (base_blob, ComparisonResult.base_completion_hash),
+        ),
+        "finetuned_completion_preview": (
+            func.substr(finetuned_blob.text, 1, RESULT_PREVIEW_LENGTH),
+            (finetuned_blob, ComparisonResult.finetuned_completion_hash),
+        ),
+    }
+
+
+def add_compressed_previews(db_session, results):
+    """Fill in the previews of compressed blobs, from the hash and encoding columns selected with them"""
+    compressed = [
+        (result, name)
+        for result in results
+        for name in list(result)
+        if name.endswith("_preview") and result.pop(f"{name}_encoding") not in ("text", None)
+    ]
+    texts = Blob.texts(db_session, [result[f"{name}_hash"] for result, name in compressed])
+    for result, name in compressed:
+        result[name] = texts[result[f"{name}_hash"]][:RESULT_PREVIEW_LENGTH]
+    for result in results:
+        for name in list(result):
+            if name.endswith("_preview_hash"):
+                del result[name]
+
+
+def filter_results(query, search, experiment_id):
     if search:
         search = f"%{search}%"
         query = query.filter(
             or_(
                 ComparisonResult.github_username.ilike(search),
-                ComparisonResult.code_prefix.ilike(search),
+                ComparisonResult.code_prefix_blob.has(Blob.text.ilike(search)),
                 ComparisonResult.preferred_model.ilike(search),
             )
         )
@@ -743,46 +1439,101 @@ async def get_results(
     # Filter by experiment if specified
     if experiment_id:
         query = query.filter(Experiment.experiment_id == experiment_id)
+    return query
+
+
+@app.get("/api/admin/results")
+async def get_results(
+    request: Request,
+    page: int = Query(1, ge=1),
+    per_page: int = Query(10, ge=1, le=100),
+    search: Optional[str] = None,
+    experiment_id: Optional[str] = None,
+    view: str = Query("full", pattern="^(full|compact)$"),
+    fields: Optional[str] = None,
+):
+    """
+    List comparison results.
+
+    Args:
+        view: "full" returns every result with its prompt and completions,
+            "compact" only the listing columns with truncated previews
+        fields: Comma separated compact columns to return, implies the compact view
+    """
+    if "user" not in request.session or not is_admin(
+        request.session["user"]["username"]
+    ):
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    columns = compact_result_columns()
+    if fields:
+        selected = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in selected if f not in columns]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown fields: {', '.join(unknown)}. Use any of: {', '.join(columns)}",
+            )
+        view = "compact"
+    else:
+        selected = list(columns)
+
+    db_session = DBSession()
 
     # Get total count for pagination
-    total = query.count()
+    total = filter_results(
+        db_session.query(func.count(ComparisonResult.id)).outerjoin(
+            Experiment, ComparisonResult.experiment_id == Experiment.id
+        ),
+        search,
+        experiment_id,
+    ).scalar()
+
+    if view == "compact":
+        selected_columns = [columns[name][0].label(name) for name in selected]
+        for name in selected:
+            if columns[name][1] is not None:
+                blob, _ = columns[name][1]
+                selected_columns += [blob.encoding.label(f"{name}_encoding"), blob.hash.label(f"{name}_hash")]
+        query = db_session.query(*selected_columns).select_from(ComparisonResult).outerjoin(
+            Experiment, ComparisonResult.experiment_id == Experiment.id
+        )
+        for name in selected:
+            if columns[name][1] is not None:
+                blob, hash_column = columns[name][1]
+                query = query.outerjoin(blob, hash_column == blob.hash)
+
+        rows = (
+            filter_results(query, search, experiment_id)
+            .order_by(ComparisonResult.created_at.desc())
+            .offset((page - 1) * per_page)
+            .limit(per_page)
+            .all()
+        )
+        results = []
+        for row in rows:
+            result_dict = row._asdict()
+            if result_dict.get("created_at"):
+                result_dict["created_at"] = result_dict["created_at"].isoformat()
+            results.append(result_dict)
+        add_compressed_previews(db_session, results)
+    else:
+        # Join the ComparisonResult and Experiment tables
+        query = db_session.query(ComparisonResult, Experiment).outerjoin(
+            Experiment, ComparisonResult.experiment_id == Experiment.id
+        )
 
-    # Get paginated results
-    query_results = (
-        query.order_by(ComparisonResult.created_at.desc())
-        .offset((page - 1) * per_page)
-        .limit(per_page)
-        .all()
-    )
+        # Get paginated results
+        query_results = (
+            filter_results(query, search, experiment_id)
+            .order_by(ComparisonResult.created_at.desc())
+            .offset((page - 1) * per_page)
+            .limit(per_page)
+            .all()
+        )
 
-    # Convert results to dict with both completions
-    results = []
-    for r, exp in query_results:
-        result_dict = {
-            "id": r.id,
-            "github_username": r.github_username,
-            "preferred_model": r.preferred_model,
-            "code_prefix": r.code_prefix,
-            "base_completion": r.base_completion,
-            "finetuned_completion": r.finetuned_completion,
-            "created_at": r.created_at.isoformat(),
-            "base_model_name": r.base_model_name,
-            "finetuned_model_name": r.finetuned_model_name,
-            "experiment_id": exp.experiment_id if exp else None,
-            "completions": [
-                {
-                    "model": "base",
-                    "completion": r.base_completion,
-                    "is_selected": r.preferred_model == "base",
-                },
-                {
-                    "model": "finetuned",
-                    "completion": r.finetuned_completion,
-                    "is_selected": r.preferred_model == "finetuned",
-                },
-            ],
-        }
-        results.append(result_dict)
+        # Convert results to dict with both completions
+        results = [result_to_dict(r, exp) for r, exp in query_results]
 
     db_session.close()
 
@@ -795,6 +1546,29 @@ async def get_results(
     }
 
 
+@app.get("/api/admin/results/{result_id}")
+async def get_result(request: Request, result_id: int):
+    """Full comparison result, for the rows of the compact listing"""
+    if "user" not in request.session or not is_admin(
+        request.session["user"]["username"]
+    ):
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    db_session = DBSession()
+    try:
+        row = (
+            db_session.query(ComparisonResult, Experiment)
+            .outerjoin(Experiment, ComparisonResult.experiment_id == Experiment.id)
+            .filter(ComparisonResult.id == result_id)
+            .first()
+        )
+        if row is None:
+            raise HTTPException(status_code=404, detail="Result not found")
+        return result_to_dict(*row)
+    finally:
+        db_session.close()
+
+
 @app.get("/auth/error")
 async def auth_error(request: Request, type: str = None, message: str = None):
     return JSONResponse(
@@ -813,100 +1587,110 @@ async def get_stats(request: Request):
         raise HTTPException(status_code=403, detail="Not authorized")
 
     db_session = DBSession()
+    try:
+        counts = {}
+        for experiment_id, preferred_model, count in (
+            db_session.query(
+                ComparisonResult.experiment_id,
+                ComparisonResult.preferred_model,
+                func.count(ComparisonResult.id),
+            )
+            .group_by(ComparisonResult.experiment_id, ComparisonResult.preferred_model)
+        ):
+            counts[(experiment_id, preferred_model)] = count
+    finally:
+        db_session.close()
 
-    # Get list of all experiments that have been used
-    experiment_records = db_session.query(Experiment).all()
-    
-    stats = []
-    
-    # Overall stats (across all experiments)
-    base_count = (
-        db_session.query(ComparisonResult)
-        .filter(ComparisonResult.preferred_model == "base")
-        .count()
-    )
-
-    finetuned_count = (
-        db_session.query(ComparisonResult)
-        .filter(ComparisonResult.preferred_model == "finetuned")
-        .count()
-    )
-
-    total_comparisons = base_count + finetuned_count
-
-    # Calculate percentages
-    base_percentage = (
-        (base_count / total_comparisons * 100) if total_comparisons > 0 else 0
-    )
-    finetuned_percentage = (
-        (finetuned_count / total_comparisons * 100) if total_comparisons > 0 else 0
-    )
-    
-    stats.append({
-        "experiment_id": "all",
-        "total_comparisons": total_comparisons,
-        "model_preferences": [
-            {
-                "model": "base",
-                "count": base_count,
-                "percentage": round(base_percentage, 1),
-            },
-            {
-                "model": "finetuned",
-                "count": finetuned_count,
-                "percentage": round(finetuned_percentage, 1),
-            },
-        ],
-    })
-    
-    # Get stats for each experiment
-    for experiment in experiment_records:
-        exp_base_count = (
-            db_session.query(ComparisonResult)
-            .filter(ComparisonResult.preferred_model == "base")
-            .filter(ComparisonResult.experiment_id == experiment.id)
-            .count()
-        )
-
-        exp_finetuned_count = (
-            db_session.query(ComparisonResult)
-            .filter(ComparisonResult.preferred_model == "finetuned")
-            .filter(ComparisonResult.experiment_id == experiment.id)
-            .count()
-        )
-
-        exp_total = exp_base_count + exp_finetuned_count
-
-        # Calculate percentages
-        exp_base_percentage = (
-            (exp_base_count / exp_total * 100) if exp_total > 0 else 0
-        )
-        exp_finetuned_percentage = (
-            (exp_finetuned_count / exp_total * 100) if exp_total > 0 else 0
-        )
-        
-        stats.append({
-            "experiment_id": experiment.experiment_id,  # Use the string ID from the experiment table
-            "total_comparisons": exp_total,
+    def preference_stats(experiment_id, base_count, finetuned_count):
+        total = base_count + finetuned_count
+        return {
+            "experiment_id": experiment_id,
+            "total_comparisons": total,
             "model_preferences": [
                 {
                     "model": "base",
-                    "count": exp_base_count,
-                    "percentage": round(exp_base_percentage, 1),
+                    "count": base_count,
+                    "percentage": round(base_count / total * 100, 1) if total > 0 else 0,
                 },
                 {
                     "model": "finetuned",
-                    "count": exp_finetuned_count,
-                    "percentage": round(exp_finetuned_percentage, 1),
+                    "count": finetuned_count,
+                    "percentage": round(finetuned_count / total * 100, 1) if total > 0 else 0,
                 },
             ],
-        })
+        }
 
-    db_session.close()
+    # Overall stats (across all experiments), then stats for each experiment
+    stats = [
+        preference_stats(
+            "all",
+            sum(c for (_, model), c in counts.items() if model == "base"),
+            sum(c for (_, model), c in counts.items() if model == "finetuned"),
+        )
+    ]
+    for name, experiment_id in registry.items():
+        stats.append(
+            preference_stats(
+                name,
+                counts.get((experiment_id, "base"), 0),
+                counts.get((experiment_id, "finetuned"), 0),
+            )
+        )
 
     return {"stats": stats}
 
 
+@app.get("/api/admin/trends")
+async def get_preference_trends(
+    request: Request,
+    granularity: str = Query("day", pattern="^(hour|day)$"),
+    days: int = Query(90, ge=1, le=3650),
+    experiment_id: Optional[str] = None,
+):
+    """
+    Preference counts and finetuned win rate over time, per experiment.
+
+    Served from the hourly/daily rollups, hourly ones only cover the last
+    ROLLUP_HOURLY_RETENTION_DAYS days.
+    """
+    if "user" not in request.session or not is_admin(
+        request.session["user"]["username"]
+    ):
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    db_session = DBSession()
+    try:
+        since = datetime.utcnow() - timedelta(days=days)
+        return {
+            "granularity": granularity,
+            "trends": get_trends(db_session, granularity, since, experiment_id),
+        }
+    finally:
+        db_session.close()
+
+
+@app.get("/api/admin/analysis")
+async def get_preference_analysis(request: Request, experiment_id: Optional[str] = None):
+    """
+    Finetuned win rate per experiment with Wilson and rater-bootstrap confidence
+    intervals, a sequential test stop signal, rater bias and agreement on
+    prompts rated more than once.
+
+    Only the comparison results added since the previous call are read.
+    """
+    if "user" not in request.session or not is_admin(
+        request.session["user"]["username"]
+    ):
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    db_session = DBSession()
+    try:
+        analysis.refresh(db_session)
+    finally:
+        db_session.close()
+    return {"experiments": analysis.report(experiment_id)}
+
+
 @app.get("/api/analytics/performance")
 async def get_performance_metrics(request: Request):
     if "user" not in request.session or not is_admin(
@@ -931,6 +1715,8 @@ async def get_performance_metrics(request: Request):
                 "Database": "base",
                 # etc
             },
+            "speculative_decoding": speculative_stats(),
+            "queue_wait": {**queue_wait_stats(), **fair_share.status()},
         }
     }
 
@@ -951,61 +1737,119 @@ async def generate_review(request: Request, code: str = Form(...)):
     return {"base_review": base_review[0], "finetuned_review": finetuned_review[0]}
 
 
-@app.get("/api/admin/export")
-async def export_results(request: Request, format: str = "csv"):
-    if "user" not in request.session or not is_admin(
-        request.session["user"]["username"]
-    ):
-        raise HTTPException(status_code=403, detail="Not authorized")
+# Comparison results loaded per round trip when exporting, with the blobs they
+# reference (up to 3 per result, within SQLite's limit of bound parameters)
+EXPORT_BATCH_SIZE = 250
 
-    db_session = DBSession()
-    results = db_session.query(ComparisonResult).all()
 
-    if format == "csv":
-        output = io.StringIO()
-        writer = csv.writer(output)
+def export_rows(db_session):
+    """
+    Comparison results as dicts with their texts, loaded EXPORT_BATCH_SIZE at a
+    time instead of all at once. Closes db_session when done.
+    """
+    query = select(
+        ComparisonResult.id,
+        ComparisonResult.github_username,
+        ComparisonResult.preferred_model,
+        ComparisonResult.code_prefix_hash,
+        ComparisonResult.base_completion_hash,
+        ComparisonResult.finetuned_completion_hash,
+        ComparisonResult.base_model_name,
+        ComparisonResult.finetuned_model_name,
+        ComparisonResult.created_at,
+    ).order_by(ComparisonResult.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+    try:
+        for rows in db_session.execute(query).partitions():
+            texts = Blob.texts(db_session, [
+                row_hash
+                for row in rows
+                for row_hash in (row.code_prefix_hash, row.base_completion_hash, row.finetuned_completion_hash)
+            ])
+            for row in rows:
+                yield {
+                    "id": row.id,
+                    "github_username": row.github_username,
+                    "preferred_model": row.preferred_model,
+                    "code_prefix": texts[row.code_prefix_hash],
+                    "base_completion": texts[row.base_completion_hash],
+                    "finetuned_completion": texts[row.finetuned_completion_hash],
+                    "base_model_name": row.base_model_name,
+                    "finetuned_model_name": row.finetuned_model_name,
+                    "created_at": row.created_at.isoformat(),
+                }
+    finally:
+        db_session.close()
+
+
+def export_csv(rows):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(
+        [
+            "ID",
+            "Username",
+            "Preferred Model",
+            "Original Prompt",
+            "Selected Completion",
+            "Rejected Completion",
+            "Created At",
+        ]
+    )
+
+    for r in rows:
+        # Determine which completion was selected/rejected
+        base_selected = r["preferred_model"] == "base"
         writer.writerow(
             [
-                "ID",
-                "Username",
-                "Preferred Model",
-                "Original Prompt",
-                "Selected Completion",
-                "Rejected Completion",
-                "Created At",
+                r["id"],
+                r["github_username"],
+                r["preferred_model"],
+                r["code_prefix"],
+                r["base_completion"] if base_selected else r["finetuned_completion"],
+                r["finetuned_completion"] if base_selected else r["base_completion"],
+                r["created_at"],
             ]
         )
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+    yield output.getvalue()
 
-        for result in results:
-            # Determine which completion was selected/rejected
-            selected_completion = (
-                result.base_completion
-                if result.preferred_model == "base"
-                else result.finetuned_completion
-            )
-            rejected_completion = (
-                result.finetuned_completion
-                if result.preferred_model == "base"
-                else result.base_completion
-            )
 
-            writer.writerow(
-                [
-                    result.id,
-                    result.github_username,
-                    result.preferred_model,
-                    result.code_prefix,
-                    selected_completion,
-                    rejected_completion,
-                    result.created_at.isoformat(),
-                ]
-            )
+def export_json(rows):
+    yield "["
+    separator = "\n"
+    for r in rows:
+        r["completions"] = [
+            {
+                "model": "base",
+                "completion": r["base_completion"],
+                "is_selected": r["preferred_model"] == "base",
+            },
+            {
+                "model": "finetuned",
+                "completion": r["finetuned_completion"],
+                "is_selected": r["preferred_model"] == "finetuned",
+            },
+        ]
+        # Same layout as json.dumps(results, indent=2), one result at a time
+        yield separator + textwrap.indent(json.dumps(r, indent=2, ensure_ascii=False), "  ")
+        separator = ",\n"
+    yield "\n]" if separator != "\n" else "]"
 
-        output.seek(0)
-        db_session.close()
 
+@app.get("/api/admin/export")
+async def export_results(request: Request, format: str = "csv"):
+    """Stream all comparison results as CSV or JSON, without loading them all in memory"""
+    if "user" not in request.session or not is_admin(
+        request.session["user"]["username"]
+    ):
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    if format == "csv":
         return StreamingResponse(
-            iter([output.getvalue()]),
+            export_csv(export_rows(DBSession())),
             media_type="text/csv",
             headers={
                 "Content-Disposition": "attachment; filename=comparison-results.csv"
@@ -1013,40 +1857,8 @@ async def export_results(request: Request, format: str = "csv"):
         )
 
     elif format == "json":
-        data = [
-            {
-                "id": r.id,
-                "github_username": r.github_username,
-                "preferred_model": r.preferred_model,
-                "code_prefix": r.code_prefix,
-                "base_completion": r.base_completion,
-                "finetuned_completion": r.finetuned_completion,
-                "base_model_name": r.base_model_name,
-                "finetuned_model_name": r.finetuned_model_name,
-                "created_at": r.created_at.isoformat(),
-                "completions": [
-                    {
-                        "model": "base",
-                        "completion": r.base_completion,
-                        "is_selected": r.preferred_model == "base",
-                    },
-                    {
-                        "model": "finetuned",
-                        "completion": r.finetuned_completion,
-                        "is_selected": r.preferred_model == "finetuned",
-                    },
-                ],
-            }
-            for r in results
-        ]
-
-        db_session.close()
-
-        # Use json.dumps with proper formatting
-        json_str = json.dumps(data, indent=2, ensure_ascii=False)
-
         return StreamingResponse(
-            iter([json_str]),
+            export_json(export_rows(DBSession())),
             media_type="application/json",
             headers={
                 "Content-Disposition": "attachment; filename=comparison-results.json"
@@ -1056,18 +1868,84 @@ async def export_results(request: Request, format: str = "csv"):
 
 @app.post("/api/collaborate")
 async def start_collaboration(request: Request):
-    """Allow multiple users to review the same completion"""
+    """
+    Allow multiple users to review the same completion: the comparison is
+    generated once and streamed to every participant of the session
+    """
+    if "user" not in request.session:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+
+    data = await request.json()
+    try:
+        mode = Mode(data.get("mode", Mode.FIM.value))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid mode. Use 'fim' or 'chat'.")
+    if mode == Mode.FIM and data.get("prefix") is None:
+        raise HTTPException(status_code=400, detail="Prefix is required for FIM mode")
+    if mode == Mode.CHAT and not (data.get("prompt") or "").strip():
+        raise HTTPException(status_code=400, detail="Prompt is required for CHAT mode")
 
-    session_id = secrets.token_urlsafe(16)
+    username = request.session["user"]["username"]
+    session = collaborations.create(username, MODE_EXPERIMENTS[mode])
+    session.model_a_is_base, used_prompt = await start_comparison(
+        session.stream, username, mode,
+        prefix=data.get("prefix"), suffix=data.get("suffix"), prompt=data.get("prompt"),
+        reveal_arms=False,
+    )
+    # The prompt the models actually got, trimmed to the context budget
+    session.code_prefix = used_prompt["prefix"]
+    return {"session_id": session.session_id}
 
-    # Store collaboration session
-    collaboration_sessions[session_id] = {
-        "code_prefix": request.json["prefix"],
-        "participants": [request.session["user"]["username"]],
-        "votes": {"base": 0, "finetuned": 0},
-    }
 
-    return {"session_id": session_id}
+def get_collaboration(request, session_id):
+    if "user" not in request.session:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    session = collaborations.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Collaboration session not found")
+    return session
+
+
+@app.get("/api/collaborate/{session_id}/stream")
+async def follow_collaboration(request: Request, session_id: str):
+    """Stream the comparison of a session, from the start or after Last-Event-ID"""
+    session = get_collaboration(request, session_id)
+    collaborations.join(session, request.session["user"]["username"])
+
+    _, _, seq = (request.headers.get("last-event-id") or "").partition(":")
+    return stream_response(session.stream, int(seq) if seq.isdigit() else 0)
+
+
+@app.post("/api/collaborate/{session_id}/vote")
+async def vote_collaboration(request: Request, session_id: str):
+    """Vote for model A or B, once per participant. Votes are stored in batches"""
+    session = get_collaboration(request, session_id)
+    data = await request.json()
+    if data.get("preferredModel") not in MODEL_LETTERS:
+        raise HTTPException(status_code=400, detail="preferredModel must be 'A' or 'B'")
+
+    try:
+        collaborations.vote(session, request.session["user"]["username"], data["preferredModel"])
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"success": True, **session.tally()}
+
+
+@app.get("/api/collaborate/{session_id}")
+async def get_collaboration_tally(request: Request, session_id: str):
+    """Participants and votes of a session so far"""
+    session = get_collaboration(request, session_id)
+    return {"session_id": session.session_id, **session.tally()}
+
+
+def flush_collaboration_votes():
+    db_session = DBSession()
+    try:
+        collaborations.flush(db_session)
+    except Exception as e:
+        logger.error(f"Error storing collaboration votes: {e}")
+    finally:
+        db_session.close()
 
 
 @app.post("/api/explain")
@@ -1087,49 +1965,93 @@ async def explain_completion(request: Request, completion_id: int):
 
 
 @app.get("/api/user/stats")
-async def get_user_stats(request: Request):
+async def get_user_stats(request: Request, by_experiment: bool = False):
+    """
+    Voting statistics of the current user.
+
+    Served from aggregate queries on the (github_username, created_at) index,
+    so the cost doesn't grow with the number of votes.
+
+    Args:
+        by_experiment: Also break the preferences down per experiment
+    """
     if "user" not in request.session:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
     username = request.session["user"]["username"]
     db_session = DBSession()
 
-    # Get user's comparison history
-    user_comparisons = (
-        db_session.query(ComparisonResult)
+    # Count preferences in the database
+    preference_counts = dict(
+        db_session.query(ComparisonResult.preferred_model, func.count(ComparisonResult.id))
         .filter(ComparisonResult.github_username == username)
-        .order_by(ComparisonResult.created_at.desc())
+        .group_by(ComparisonResult.preferred_model)
         .all()
     )
-
-    # Calculate statistics
-    total_comparisons = len(user_comparisons)
-    base_preferred = sum(1 for c in user_comparisons if c.preferred_model == "base")
+    total_comparisons = sum(preference_counts.values())
+    base_preferred = preference_counts.get("base", 0)
     finetuned_preferred = total_comparisons - base_preferred
 
-    # Get recent comparisons
+    # Get recent comparisons, one character past the preview to know if it was cut
+    recent = (
+        db_session.query(
+            ComparisonResult.id,
+            func.substr(Blob.text, 1, 101).label("code_prefix"),
+            ComparisonResult.preferred_model,
+            ComparisonResult.created_at,
+        )
+        .outerjoin(Blob, ComparisonResult.code_prefix_hash == Blob.hash)
+        .filter(ComparisonResult.github_username == username)
+        .order_by(ComparisonResult.created_at.desc())
+        .limit(5)  # Last 5 comparisons
+        .all()
+    )
     recent_comparisons = [
         {
             "id": c.id,
             "code_prefix": (
                 c.code_prefix[:100] + "..."
-                if len(c.code_prefix) > 100
-                else c.code_prefix
+                if len(c.code_prefix or "") > 100
+                else c.code_prefix or ""
             ),
             "preferred_model": c.preferred_model,
             "created_at": c.created_at.isoformat(),
         }
-        for c in user_comparisons[:5]  # Last 5 comparisons
+        for c in recent
     ]
 
-    db_session.close()
-
-    return {
+    stats = {
         "total_comparisons": total_comparisons,
         "preferences": {"base": base_preferred, "finetuned": finetuned_preferred},
         "recent_comparisons": recent_comparisons,
     }
 
+    if by_experiment:
+        experiments = {}
+        rows = (
+            db_session.query(
+                Experiment.experiment_id,
+                ComparisonResult.preferred_model,
+                func.count(ComparisonResult.id),
+            )
+            .outerjoin(Experiment, ComparisonResult.experiment_id == Experiment.id)
+            .filter(ComparisonResult.github_username == username)
+            .group_by(Experiment.experiment_id, ComparisonResult.preferred_model)
+            .all()
+        )
+        for experiment_id, preferred_model, count in rows:
+            experiment_stats = experiments.setdefault(
+                experiment_id, {"total_comparisons": 0, "preferences": {"base": 0, "finetuned": 0}}
+            )
+            experiment_stats["total_comparisons"] += count
+            key = "base" if preferred_model == "base" else "finetuned"
+            experiment_stats["preferences"][key] += count
+        stats["experiments"] = experiments
+
+    db_session.close()
+
+    return stats
+
 
 @app.post("/api/admin/users")
 async def post_users(request: Request):
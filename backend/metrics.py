@@ -0,0 +1,48 @@
+import threading
+from collections import defaultdict
+from typing import Dict
+
+
+class Metrics:
+    """Thread-safe in-process counters and summaries for the generation path."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._summaries = {}
+
+    def incr(self, name: str, value: float = 1) -> None:
+        """Add value to the counter called name."""
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name: str, value: float) -> None:
+        """Record a single observation (e.g. a latency) under name."""
+        with self._lock:
+            summary = self._summaries.setdefault(
+                name, {"count": 0, "sum": 0.0, "max": 0.0}
+            )
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["max"] = max(summary["max"], value)
+
+    def counter(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Return a copy of all counters and summaries."""
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "summaries": {
+                    name: {
+                        **summary,
+                        "avg": summary["sum"] / summary["count"] if summary["count"] else 0,
+                    }
+                    for name, summary in self._summaries.items()
+                },
+            }
+
+
+metrics = Metrics()
@@ -1,17 +1,20 @@
-from venv import logger
-from sqlalchemy import inspect, MetaData, Table, Column, Integer, String, DateTime, create_engine, text
+import logging
+from sqlalchemy import inspect, MetaData, Table, Column, Integer, String, DateTime, text
 from datetime import datetime
+from models import Base, Blob, PoolAssignment, PoolItem, PreferenceRollup, engine as db_engine
 
-def migrate_database():
-    
-    """Runtime migration to add experiment_id column if it doesn't exist, ensure FIM_LEGACY_CODEGATE entry exists,
+logger = logging.getLogger(__name__)
+
+# Rows backfilled per batch when moving texts to the blobs table
+BLOB_BACKFILL_BATCH_SIZE = 500
+
+
+def add_experiments(engine):
+    """Add the experiments table and experiment_id column, ensure the FIM_LEGACY_CODEGATE entry exists,
     and associate all existing comparison results with this experiment"""
-    logger.info("Starting database migration...")
-    engine = create_engine('sqlite:///comparisons.db')
-    
     inspector = inspect(engine)
     fim_legacy_id = None
-    
+
     with engine.connect() as conn:
         try:
             # Create experiments table if it doesn't exist
@@ -19,7 +22,7 @@ def migrate_database():
                 logger.info("Creating experiments table")
                 metadata = MetaData()
                 experiments = Table(
-                    'experiments', 
+                    'experiments',
                     metadata,
                     Column('id', Integer, primary_key=True),
                     Column('experiment_id', String, nullable=False),
@@ -27,10 +30,10 @@ def migrate_database():
                 )
                 metadata.create_all(engine)
                 logger.info("Created experiments table successfully")
-            
+
             # Check if the FIM_LEGACY_CODEGATE entry exists in experiments table
             result = conn.execute(text("SELECT id FROM experiments WHERE experiment_id = 'FIM_LEGACY_CODEGATE'")).fetchone()
-            
+
             # If FIM_LEGACY_CODEGATE entry doesn't exist, create it
             if not result:
                 logger.info("Adding FIM_LEGACY_CODEGATE entry to experiments table")
@@ -44,33 +47,208 @@ def migrate_database():
             else:
                 fim_legacy_id = result[0]
                 logger.info(f"FIM_LEGACY_CODEGATE entry already exists with id: {fim_legacy_id}")
-            
+
             # Add experiment_id column to comparison_results if it doesn't exist
             columns = [column['name'] for column in inspector.get_columns('comparison_results')]
-            
+
             if 'experiment_id' not in columns:
                 logger.info("Adding experiment_id column to comparison_results table")
                 conn.execute(text("PRAGMA foreign_keys=off"))
                 conn.execute(text("ALTER TABLE comparison_results ADD COLUMN experiment_id INTEGER REFERENCES experiments(id)"))
-                
-                # Update all existing records to use the FIM_LEGACY_CODEGATE experiment
-                logger.info(f"Updating all existing comparison results to use FIM_LEGACY_CODEGATE (id: {fim_legacy_id})")
-                conn.execute(
-                    text(f"UPDATE comparison_results SET experiment_id = {fim_legacy_id} WHERE experiment_id IS NULL")
-                )
-                
                 conn.execute(text("PRAGMA foreign_keys=on"))
-                conn.commit()
-                logger.info("Added experiment_id column and updated all records successfully")
-            else:
-                # If column already exists, still make sure all records are associated with FIM_LEGACY_CODEGATE
-                logger.info(f"experiment_id column already exists, updating any NULL values to FIM_LEGACY_CODEGATE (id: {fim_legacy_id})")
+
+            # Associate all comparison results from before experiments with FIM_LEGACY_CODEGATE
+            logger.info(f"Updating comparison results without experiment to FIM_LEGACY_CODEGATE (id: {fim_legacy_id})")
+            conn.execute(
+                text("UPDATE comparison_results SET experiment_id = :experiment_id WHERE experiment_id IS NULL"),
+                {"experiment_id": fim_legacy_id}
+            )
+            conn.commit()
+            logger.info("Updated all NULL experiment_id records successfully")
+
+        except Exception as e:
+            logger.error(f"Error during migration: {str(e)}")
+            raise
+
+
+def migrate_content_blobs(engine):
+    """Move the prompt and completion texts of comparison_results into the content-addressed
+    blobs table, reference them by hash and drop the old text columns"""
+    inspector = inspect(engine)
+    columns = [column['name'] for column in inspector.get_columns('comparison_results')]
+    if 'code_prefix' not in columns:
+        return
+
+    logger.info("Moving comparison texts to the blobs table")
+    Blob.__table__.create(engine, checkfirst=True)
+
+    with engine.connect() as conn:
+        try:
+            for column in ('code_prefix_hash', 'base_completion_hash', 'finetuned_completion_hash'):
+                if column not in columns:
+                    conn.execute(text(f"ALTER TABLE comparison_results ADD COLUMN {column} VARCHAR REFERENCES blobs(hash)"))
+
+            last_id = 0
+            while True:
+                rows = conn.execute(
+                    text("SELECT id, code_prefix, base_completion, finetuned_completion FROM comparison_results "
+                         "WHERE id > :last_id ORDER BY id LIMIT :batch_size"),
+                    {"last_id": last_id, "batch_size": BLOB_BACKFILL_BATCH_SIZE}
+                ).fetchall()
+                if not rows:
+                    break
+
+                blobs = {}
+                updates = []
+                for row in rows:
+                    prefix = Blob.row(row.code_prefix)
+                    base = Blob.row(row.base_completion, compress=True)
+                    finetuned = Blob.row(row.finetuned_completion, compress=True)
+                    for blob in (prefix, base, finetuned):
+                        Blob.add_row(blobs, blob)
+                    updates.append({
+                        "id": row.id,
+                        "code_prefix_hash": prefix["hash"],
+                        "base_completion_hash": base["hash"],
+                        "finetuned_completion_hash": finetuned["hash"],
+                    })
+
+                conn.execute(Blob.insert_rows(), list(blobs.values()))
                 conn.execute(
-                    text(f"UPDATE comparison_results SET experiment_id = {fim_legacy_id} WHERE experiment_id IS NULL")
+                    text("UPDATE comparison_results SET code_prefix_hash = :code_prefix_hash, "
+                         "base_completion_hash = :base_completion_hash, "
+                         "finetuned_completion_hash = :finetuned_completion_hash WHERE id = :id"),
+                    updates
                 )
-                conn.commit()
-                logger.info("Updated all NULL experiment_id records successfully")
-                
+                last_id = rows[-1].id
+                logger.info(f"Moved texts of comparison results up to id {last_id}")
+
+            for column in ('code_prefix', 'base_completion', 'finetuned_completion'):
+                conn.execute(text(f"ALTER TABLE comparison_results DROP COLUMN {column}"))
+            conn.commit()
+            logger.info("Moved comparison texts to the blobs table successfully")
         except Exception as e:
-            logger.error(f"Error during migration: {str(e)}")
+            conn.rollback()
+            logger.error(f"Error moving comparison texts to the blobs table: {str(e)}")
             raise
+
+    # Reclaim the space of the dropped columns
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM"))
+
+
+def index_comparison_results(engine):
+    """Index the columns the admin listing sorts and the stats filter on"""
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_comparison_results_created_at ON comparison_results (created_at)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_comparison_results_experiment_id ON comparison_results (experiment_id)"))
+
+
+def index_user_comparisons(engine):
+    """Index comparison results per user and creation time, for the user stats"""
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_comparison_results_user_created_at "
+            "ON comparison_results (github_username, created_at)"
+        ))
+
+
+def backfill_preference_rollups(engine):
+    """Build the hourly and daily preference rollups from the existing comparison results"""
+    PreferenceRollup.__table__.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM preference_rollups"))
+        for granularity, bucket_format in (("hour", "%Y-%m-%d %H:00:00.000000"), ("day", "%Y-%m-%d 00:00:00.000000")):
+            conn.execute(
+                text("INSERT INTO preference_rollups (granularity, bucket_start, experiment, preferred_model, count) "
+                     "SELECT :granularity, strftime(:bucket_format, c.created_at), COALESCE(e.experiment_id, ''), "
+                     "c.preferred_model, COUNT(*) "
+                     "FROM comparison_results c LEFT JOIN experiments e ON c.experiment_id = e.id "
+                     "WHERE c.created_at IS NOT NULL "
+                     "GROUP BY 2, 3, 4"),
+                {"granularity": granularity, "bucket_format": bucket_format}
+            )
+
+
+def index_pool_tables(engine):
+    """
+    Index the pool items per experiment and prompt, as fill_pool and next_pool_item look them up.
+    Pool assignments are looked up per item and user, through the index of their unique constraint.
+    """
+    PoolItem.__table__.create(engine, checkfirst=True)
+    PoolAssignment.__table__.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_pool_items_experiment_id ON pool_items (experiment_id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_pool_items_prompt_hash ON pool_items (prompt_hash)"))
+
+
+def uncompress_prompt_blobs(engine):
+    """Store prompts that were first stored as a compressed completion uncompressed"""
+    with engine.begin() as conn:
+        rows = conn.execute(text(
+            "SELECT hash, encoding, text, data FROM blobs WHERE encoding != 'text' "
+            "AND hash IN (SELECT code_prefix_hash FROM comparison_results)"
+        )).fetchall()
+        for row in rows:
+            conn.execute(
+                text("UPDATE blobs SET encoding = 'text', text = :text, data = NULL WHERE hash = :hash"),
+                {"hash": row.hash, "text": Blob(encoding=row.encoding, data=row.data).get_text()}
+            )
+        if rows:
+            logger.info(f"Uncompressed {len(rows)} prompt blobs")
+
+
+def add_pool_assignment_count(engine):
+    """Count the raters of each pool item on the item, so it can be claimed with one UPDATE"""
+    columns = [column['name'] for column in inspect(engine).get_columns('pool_items')]
+    with engine.begin() as conn:
+        if 'assignment_count' not in columns:
+            conn.execute(text("ALTER TABLE pool_items ADD COLUMN assignment_count INTEGER NOT NULL DEFAULT 0"))
+        conn.execute(text(
+            "UPDATE pool_items SET assignment_count = "
+            "(SELECT COUNT(*) FROM pool_assignments WHERE pool_assignments.pool_item_id = pool_items.id)"
+        ))
+
+
+# Schema migrations in the order they are applied. Each one runs once per
+# database and is recorded in schema_version. Migrations must be idempotent,
+# since databases from before schema_version existed run all of them once.
+# Never reorder or renumber them, only append.
+MIGRATIONS = [
+    (1, "add_experiments", add_experiments),
+    (2, "migrate_content_blobs", migrate_content_blobs),
+    (3, "index_comparison_results", index_comparison_results),
+    (4, "index_user_comparisons", index_user_comparisons),
+    (5, "backfill_preference_rollups", backfill_preference_rollups),
+    (6, "index_pool_tables", index_pool_tables),
+    (7, "uncompress_prompt_blobs", uncompress_prompt_blobs),
+    (8, "add_pool_assignment_count", add_pool_assignment_count),
+]
+
+
+def run_migrations(engine=db_engine):
+    """
+    Create the tables a fresh database lacks, then apply the migrations that
+    haven't been applied to it yet. Indexes are only created by migrations.
+    """
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at DATETIME NOT NULL)"
+        ))
+        applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+
+    pending = [migration for migration in MIGRATIONS if migration[0] not in applied]
+    if not pending:
+        return
+
+    for version, name, migrate in pending:
+        logger.info(f"Applying database migration {version}: {name}")
+        migrate(engine)
+        with engine.begin() as conn:
+            conn.execute(
+                text("INSERT INTO schema_version (version, name, applied_at) VALUES (:version, :name, :applied_at)"),
+                {"version": version, "name": name, "applied_at": datetime.utcnow()}
+            )
+    logger.info(f"Database schema is at version {pending[-1][0]}")
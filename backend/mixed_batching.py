@@ -0,0 +1,58 @@
+import logging
+
+from peft import PeftModel
+
+from model_loader import load_peft_model
+
+logger = logging.getLogger(__name__)
+
+# Name PEFT uses in adapter_names for rows that get no adapter
+BASE_ADAPTER = "__base__"
+
+
+class AdapterView:
+    """
+    One arm of a PeftModel that serves both arms of an experiment.
+
+    generate() applies the view's adapter to every row, unless adapter_names
+    is passed to mix arms within a batch. Everything else is the shared model.
+    """
+
+    def __init__(self, peft_model, adapter_name):
+        self.peft_model = peft_model
+        self.adapter_name = adapter_name
+
+    def generate(self, *args, **kwargs):
+        batch_size = kwargs["input_ids"].shape[0]
+        kwargs.setdefault("adapter_names", [self.adapter_name] * batch_size)
+        return self.peft_model.generate(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.peft_model, name)
+
+
+def load_mixed_model(base_model, peft_model):
+    """
+    Load an adapter unmerged over its base model, so both arms share the base
+    weights and the LoRA delta can be applied per row of a batch.
+
+    Returns:
+        Tuple of (base arm view, finetuned arm view, tokenizer), or None when the
+        model can't apply adapters per row (merged, or loaded through unsloth)
+    """
+    model, tokenizer = load_peft_model(base_model, peft_model, merge="never")
+    if not isinstance(model, PeftModel) or getattr(model, "loaded_with_unsloth", False):
+        logger.warning(f"{peft_model} can't be batched per row, serving the arms separately")
+        return None
+
+    logger.info(f"Serving {base_model} and {peft_model} from one model with mixed-adapter batches")
+    return AdapterView(model, BASE_ADAPTER), AdapterView(model, model.active_adapter), tokenizer
+
+
+def is_mixed_pair(base_model, finetuned_model):
+    """Whether two arms are served by the same model and can be decoded as one batch"""
+    return (
+        isinstance(base_model, AdapterView)
+        and isinstance(finetuned_model, AdapterView)
+        and base_model.peft_model is finetuned_model.peft_model
+    )
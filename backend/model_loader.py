@@ -0,0 +1,230 @@
+import logging
+import platform
+
+import torch
+from peft import PeftModel
+
+import weights_cache
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def get_device():
+    if torch.cuda.is_available():
+        return "cuda"
+    elif torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+device = get_device()
+IS_MACOS = platform.system() == "Darwin"
+
+max_seq_length = 2048
+
+
+def default_load_profile():
+    """Load profile used for models without an entry in Config.MODEL_LOAD_PROFILES"""
+    if IS_MACOS:
+        return "fp32" if device == "mps" else "fp16"
+    if device == "cuda":
+        return "4bit"
+    return "fp32"
+
+
+def resolve_load_profile(model_name, profile_name=None):
+    """
+    Resolve the load profile for a model.
+
+    Args:
+        model_name: Name of the model (or adapter) to load
+        profile_name: Explicit profile name, overrides Config.MODEL_LOAD_PROFILES
+
+    Returns:
+        Tuple of (profile name, profile settings)
+    """
+    profile_name = (
+        profile_name
+        or Config.MODEL_LOAD_PROFILES.get(model_name)
+        or default_load_profile()
+    )
+    if profile_name not in Config.LOAD_PROFILES:
+        raise ValueError(
+            f"Unknown load profile '{profile_name}' for {model_name}. "
+            f"Use one of: {', '.join(Config.LOAD_PROFILES)}"
+        )
+    return profile_name, Config.LOAD_PROFILES[profile_name]
+
+
+def use_unsloth(profile):
+    """unsloth only runs on CUDA and can't produce dynamically quantized models"""
+    return not IS_MACOS and device == "cuda" and not profile.get("dynamic_quantization")
+
+
+def _unsloth_kwargs(profile):
+    return {
+        "max_seq_length": max_seq_length,
+        "dtype": getattr(torch, profile["dtype"]) if "dtype" in profile else None,
+        "load_in_4bit": profile.get("load_in_4bit", False),
+        "load_in_8bit": profile.get("load_in_8bit", False),
+    }
+
+
+def _transformers_kwargs(profile):
+    kwargs = {
+        "device_map": "cpu" if profile.get("dynamic_quantization") else "auto",
+        "torch_dtype": getattr(torch, profile.get("dtype", "float16")),
+    }
+    if profile.get("load_in_4bit") or profile.get("load_in_8bit"):
+        from transformers import BitsAndBytesConfig
+
+        kwargs["quantization_config"] = BitsAndBytesConfig(
+            load_in_4bit=profile.get("load_in_4bit", False),
+            load_in_8bit=profile.get("load_in_8bit", False),
+        )
+    return kwargs
+
+
+def apply_dynamic_quantization(model, profile):
+    """Quantize Linear layers to int8 at runtime when the profile asks for it (CPU only)"""
+    if not profile.get("dynamic_quantization"):
+        return model
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def _load_pretrained(source, profile):
+    if use_unsloth(profile):
+        from unsloth import FastLanguageModel
+
+        model, tokenizer = FastLanguageModel.from_pretrained(
+            model_name=source, **_unsloth_kwargs(profile)
+        )
+        model.loaded_with_unsloth = True
+        return model, tokenizer
+
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    model = AutoModelForCausalLM.from_pretrained(source, **_transformers_kwargs(profile))
+    tokenizer = AutoTokenizer.from_pretrained(source)
+    return model, tokenizer
+
+
+def _load_cached(model_name, profile_name, profile, base_model=None):
+    """
+    Load prepared weights from the local cache, storing them on a cache miss.
+    base_model is the model finetuned weights were merged into.
+    """
+    path = weights_cache.cache_path(model_name, profile_name)
+    quantized = profile.get("load_in_4bit") or profile.get("load_in_8bit")
+
+    if weights_cache.is_cached(model_name, profile_name, base_model):
+        logger.info(f"Loading prepared weights of {model_name} from {path}")
+        if device == "cpu" and not quantized and not use_unsloth(profile):
+            from transformers import AutoTokenizer
+
+            model = weights_cache.load_mmap(path, getattr(torch, profile.get("dtype", "float32")))
+            return model, AutoTokenizer.from_pretrained(path)
+        return _load_pretrained(path, profile)
+
+    model, tokenizer = _load_pretrained(model_name, profile)
+    weights_cache.save_prepared(model, tokenizer, model_name, profile_name)
+    return model, tokenizer
+
+
+def load_base_model(model_name, profile_name=None):
+    profile_name, profile = resolve_load_profile(model_name, profile_name)
+    logger.info(f"Loading {model_name} with load profile '{profile_name}'")
+
+    # Dynamic quantization is applied after loading, the cache holds the float weights
+    model, tokenizer = _load_cached(model_name, profile_name, profile)
+    model = apply_dynamic_quantization(model, profile)
+    return model, tokenizer
+
+
+def _merged_profile_name(profile_name, profile):
+    """Profile of the merged copy: LoRA can't be folded into 4/8-bit weights without rounding"""
+    if not (profile.get("load_in_4bit") or profile.get("load_in_8bit")):
+        return profile_name
+    if device == "cuda" and torch.cuda.is_bf16_supported():
+        return "bf16"
+    return "fp16"
+
+
+def _load_unmerged(base_model, peft_model, profile_name, profile):
+    if use_unsloth(profile):
+        # unsloth resolves and patches the adapter itself and pulls pre-quantized
+        # base weights, so there is little left to cache on this path
+        return _load_pretrained(peft_model, profile)
+
+    # The base weights come from the cache, the adapter is small enough to load as is
+    model, tokenizer = load_base_model(base_model, profile_name=profile_name)
+    return PeftModel.from_pretrained(model, peft_model), tokenizer
+
+
+def load_peft_model(base_model, peft_model, profile_name=None, merge=None):
+    """
+    Load a finetuned model from its LoRA adapter.
+
+    Merging folds the adapter into a dedicated copy of the base weights, so
+    generation doesn't pay the LoRA overhead on every forward pass. Merged
+    weights are cached under the adapter name.
+
+    Args:
+        base_model: Name of the model the adapter was trained on
+        peft_model: Name of the LoRA adapter
+        profile_name: Explicit load profile, overrides Config.MODEL_LOAD_PROFILES
+        merge: "always", "never" or "auto" (merge only when the merged model keeps
+            the precision of the load profile), defaults to Config.MERGE_ADAPTERS
+
+    Returns:
+        Tuple of (model, tokenizer)
+    """
+    profile_name, profile = resolve_load_profile(peft_model, profile_name)
+    merge = merge or Config.MERGE_ADAPTERS
+    logger.info(f"Loading {peft_model} with load profile '{profile_name}', merge: {merge}")
+
+    if profile.get("dynamic_quantization"):
+        # quantize_dynamic swaps out the Linear layers LoRA wraps, so the
+        # adapter always has to be folded into the base weights first
+        if weights_cache.is_cached(peft_model, profile_name, base_model):
+            model, tokenizer = _load_cached(peft_model, profile_name, profile, base_model)
+        else:
+            model, tokenizer = load_base_model(base_model, profile_name="fp32")
+            model = PeftModel.from_pretrained(model, peft_model).merge_and_unload()
+            weights_cache.save_prepared(model, tokenizer, peft_model, profile_name, base_model)
+        return apply_dynamic_quantization(model, profile), tokenizer
+
+    merged_profile_name = _merged_profile_name(profile_name, profile)
+    merged_profile = Config.LOAD_PROFILES[merged_profile_name]
+    needs_copy = merged_profile_name != profile_name
+    # A half precision copy of a quantized arm would be compared against a
+    # base arm that stays quantized, so "auto" leaves those adapters unmerged
+    if merge == "never" or (merge == "auto" and needs_copy):
+        return _load_unmerged(base_model, peft_model, profile_name, profile)
+
+    if weights_cache.is_cached(peft_model, merged_profile_name, base_model):
+        return _load_cached(peft_model, merged_profile_name, merged_profile, base_model)
+
+    if needs_copy:
+        model, tokenizer = load_base_model(base_model, profile_name=merged_profile_name)
+        model = PeftModel.from_pretrained(model, peft_model)
+    else:
+        model, tokenizer = _load_unmerged(base_model, peft_model, profile_name, profile)
+
+    # The unmerged model holds its own copy of the base weights, so merging
+    # in place doesn't touch the base arm
+    model = model.merge_and_unload()
+    logger.info(f"Merged {peft_model} into {base_model} with load profile '{merged_profile_name}'")
+    weights_cache.save_prepared(model, tokenizer, peft_model, merged_profile_name, base_model)
+    return model, tokenizer
+
+
+def prepare_for_inference(model):
+    """Switch models loaded through unsloth to its fast inference path"""
+    if getattr(model, "loaded_with_unsloth", False):
+        from unsloth import FastLanguageModel
+
+        FastLanguageModel.for_inference(model)
@@ -0,0 +1,204 @@
+import gc
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import torch
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+ARMS = ("base", "fineTuned")
+
+
+class ModelVersion:
+    """
+    A loaded model serving one arm of an experiment, with its in-flight
+    generations and the draft model it is paired with for assisted generation.
+    """
+
+    def __init__(self, name, model, tokenizer, draft_model=None, version=1, draft_tokenizer=None):
+        self.name = name
+        self.model = model
+        self.tokenizer = tokenizer
+        self.draft_model = draft_model
+        self.draft_tokenizer = draft_tokenizer
+        self.version = version
+        self.loaded_at = datetime.utcnow()
+        self._in_flight = 0
+        self._drained = threading.Condition()
+
+    def acquire(self):
+        with self._drained:
+            self._in_flight += 1
+
+    def release(self):
+        with self._drained:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._drained.notify_all()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def wait_drained(self, timeout):
+        """Wait until no generation uses the model, returns False on timeout"""
+        with self._drained:
+            return self._drained.wait_for(lambda: self._in_flight == 0, timeout=timeout)
+
+    def unload(self):
+        # Models running outside this process (CPU replicas) are stopped explicitly
+        close = getattr(self.model, "close", None)
+        if close is not None:
+            close()
+        self.model = None
+        self.draft_model = None
+        self.draft_tokenizer = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def info(self):
+        return {
+            "name": self.name,
+            "version": self.version,
+            "loaded_at": self.loaded_at.isoformat(),
+            "in_flight": self._in_flight,
+            "replicas": self.model.replicas() if hasattr(self.model, "replicas") else None,
+        }
+
+
+class ModelSlots:
+    """
+    The model serving each arm of each experiment, swappable at runtime.
+
+    Generations lease the current version of a slot for as long as they run.
+    A reload loads and warms up the new version in a background thread, swaps
+    it in atomically, then waits for the leases on the old version to be
+    released before unloading it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._reloads = {}
+        self._swap_hooks = []
+
+    def register(self, experiment_id, arm, version):
+        with self._lock:
+            self._slots[(experiment_id, arm)] = version
+
+    def on_swap(self, hook):
+        """
+        Call hook(old, new, versions) whenever a reload swaps a new version in,
+        before the old one is drained. versions are all current versions. It
+        runs under the slots lock, so no generation leases a version meanwhile.
+        """
+        self._swap_hooks.append(hook)
+
+    def experiments(self):
+        return sorted({experiment_id for experiment_id, _ in self._slots})
+
+    def current(self, experiment_id, arm):
+        """Current version of a slot, without leasing it (e.g. to read its tokenizer)"""
+        return self._slots[(experiment_id, arm)]
+
+    def acquire(self, experiment_id, arm):
+        """Lease the current version of a slot, the caller must release() it"""
+        with self._lock:
+            version = self._slots[(experiment_id, arm)]
+            version.acquire()
+        return version
+
+    @contextmanager
+    def lease(self, experiment_id, arm):
+        version = self.acquire(experiment_id, arm)
+        try:
+            yield version
+        finally:
+            version.release()
+
+    def reload(self, experiment_id, arm, model_name, load):
+        """
+        Start loading model_name into a slot in the background.
+
+        Args:
+            experiment_id: Experiment of the slot
+            arm: "base" or "fineTuned"
+            model_name: Model (base arm) or adapter (finetuned arm) to load
+            load: Callable (experiment_id, arm, model_name) -> (model, tokenizer),
+                returns once the model is warmed up
+
+        Raises:
+            KeyError: If the slot doesn't exist
+            RuntimeError: If a reload of the slot is already running
+        """
+        key = (experiment_id, arm)
+        with self._lock:
+            if key not in self._slots:
+                raise KeyError(f"No {arm} model is served for {experiment_id}")
+            status = self._reloads.get(key)
+            if status and status["state"] in ("loading", "draining"):
+                raise RuntimeError(f"A reload of the {arm} model of {experiment_id} is already running")
+            self._reloads[key] = {
+                "model_name": model_name,
+                "state": "loading",
+                "started_at": datetime.utcnow().isoformat(),
+            }
+
+        thread = threading.Thread(
+            target=self._reload, args=(key, model_name, load), daemon=True
+        )
+        thread.start()
+
+    def _reload(self, key, model_name, load):
+        experiment_id, arm = key
+        status = self._reloads[key]
+        try:
+            started = time.monotonic()
+            model, tokenizer = load(experiment_id, arm, model_name)
+            status["load_seconds"] = round(time.monotonic() - started, 1)
+
+            with self._lock:
+                old = self._slots[key]
+                new = ModelVersion(model_name, model, tokenizer, version=old.version + 1)
+                self._slots[key] = new
+                Config.EXPERIMENTS[experiment_id][arm] = model_name
+                for hook in self._swap_hooks:
+                    try:
+                        hook(old, new, list(self._slots.values()))
+                    except Exception as e:
+                        logger.error(f"Error in model swap hook for the {arm} model of {experiment_id}: {e}")
+            logger.info(f"Swapped {old.name} for {model_name} as {arm} model of {experiment_id}")
+
+            status["state"] = "draining"
+            if not old.wait_drained(Config.MODEL_DRAIN_TIMEOUT_SECONDS):
+                logger.warning(
+                    f"{old.name} still had {old.in_flight} generations after "
+                    f"{Config.MODEL_DRAIN_TIMEOUT_SECONDS}s, unloading it anyway"
+                )
+            old.unload()
+            status["state"] = "done"
+        except Exception as e:
+            logger.error(f"Error reloading the {arm} model of {experiment_id}: {e}")
+            status["state"] = "failed"
+            status["error"] = str(e)
+        finally:
+            status["finished_at"] = datetime.utcnow().isoformat()
+
+    def status(self):
+        """Served versions and the last reload of every slot"""
+        slots = {}
+        for (experiment_id, arm), version in sorted(self._slots.items()):
+            slots.setdefault(experiment_id, {})[arm] = {
+                **version.info(),
+                "reload": self._reloads.get((experiment_id, arm)),
+            }
+        return slots
+
+
+model_slots = ModelSlots()
@@ -1,8 +1,21 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, ForeignKey, UniqueConstraint, LargeBinary
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
 from enum import Enum
+import hashlib
+
+from config import Config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Checked at startup, not when the first completion is stored
+if Config.BLOB_COMPRESSION == 'zstd' and zstandard is None:
+    raise ImportError("BLOB_COMPRESSION=zstd requires the zstandard package")
 
 Base = declarative_base()
 
@@ -20,6 +33,77 @@ class Experiment(Base):
     def __repr__(self):
         return f"<Experiment {self.experiment_id}>"
 
+# Content-addressed storage for prompts and completions, so identical texts are stored once
+class Blob(Base):
+    __tablename__ = 'blobs'
+
+    hash = Column(String, primary_key=True)  # sha256 of the text
+    encoding = Column(String, nullable=False, default='text')  # 'text' or 'zstd'
+    text = Column(Text, nullable=True)
+    data = Column(LargeBinary, nullable=True)
+
+    def get_text(self):
+        if self.encoding == 'zstd':
+            if zstandard is None:
+                raise ImportError("Compressed blobs require the zstandard package")
+            return zstandard.ZstdDecompressor().decompress(self.data).decode('utf-8')
+        return self.text
+
+    @staticmethod
+    def row(text, compress=False):
+        """Column values of the blob holding text"""
+        text = text or ""
+        row = {
+            "hash": hashlib.sha256(text.encode('utf-8')).hexdigest(),
+            "encoding": "text",
+            "text": text,
+            "data": None,
+        }
+        if compress and Config.BLOB_COMPRESSION == 'zstd' and len(text) >= Config.BLOB_COMPRESSION_MIN_SIZE:
+            row.update({
+                "encoding": "zstd",
+                "text": None,
+                "data": zstandard.ZstdCompressor().compress(text.encode('utf-8')),
+            })
+        return row
+
+    @classmethod
+    def texts(cls, session, hashes):
+        """Texts of the blobs with the given hashes, by hash, loaded in one query"""
+        blobs = session.query(cls).filter(cls.hash.in_(set(hashes))).all()
+        return {blob.hash: blob.get_text() for blob in blobs}
+
+    @staticmethod
+    def add_row(rows, row):
+        """Add a row to the rows of a batch insert, by hash. The uncompressed copy of a text wins"""
+        if row["encoding"] == "text" or row["hash"] not in rows:
+            rows[row["hash"]] = row
+
+    @classmethod
+    def insert_rows(cls):
+        """
+        Insert of blob rows that keeps the stored blobs, except that an uncompressed
+        copy replaces a compressed one: a prompt may have been stored as a compressed
+        completion before, and prompts must stay searchable in SQL.
+        """
+        statement = insert(cls)
+        return statement.on_conflict_do_update(
+            index_elements=['hash'],
+            set_={
+                "encoding": statement.excluded.encoding,
+                "text": statement.excluded.text,
+                "data": statement.excluded.data,
+            },
+            where=(statement.excluded.encoding == 'text') & (cls.encoding != 'text'),
+        )
+
+    @classmethod
+    def put(cls, session, text, compress=False):
+        """Store text unless it is already stored and return its hash"""
+        row = cls.row(text, compress)
+        session.execute(cls.insert_rows().values(**row))
+        return row["hash"]
+
 # Existing ComparisonResult table with a link to experiments
 class ComparisonResult(Base):
     __tablename__ = 'comparison_results'
@@ -29,15 +113,33 @@ class ComparisonResult(Base):
     base_model_name = Column(String, nullable=False)
     finetuned_model_name = Column(String, nullable=False)
     preferred_model = Column(String, nullable=False)  # 'base' or 'finetuned'
-    code_prefix = Column(Text, nullable=False)
-    base_completion = Column(Text, nullable=False)
-    finetuned_completion = Column(Text, nullable=False)
+    # Prompt and completions are stored once in the blobs table, keyed by hash.
+    # Prompts are never compressed so they can still be searched in SQL.
+    code_prefix_hash = Column(String, ForeignKey('blobs.hash'), nullable=False)
+    base_completion_hash = Column(String, ForeignKey('blobs.hash'), nullable=False)
+    finetuned_completion_hash = Column(String, ForeignKey('blobs.hash'), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Foreign key to experiments table
     experiment_id = Column(Integer, ForeignKey('experiments.id'), nullable=True)
     experiment = relationship("Experiment", back_populates="comparisons")
 
+    code_prefix_blob = relationship("Blob", foreign_keys=[code_prefix_hash], lazy="joined")
+    base_completion_blob = relationship("Blob", foreign_keys=[base_completion_hash], lazy="joined")
+    finetuned_completion_blob = relationship("Blob", foreign_keys=[finetuned_completion_hash], lazy="joined")
+
+    @property
+    def code_prefix(self):
+        return self.code_prefix_blob.get_text()
+
+    @property
+    def base_completion(self):
+        return self.base_completion_blob.get_text()
+
+    @property
+    def finetuned_completion(self):
+        return self.finetuned_completion_blob.get_text()
+
     @classmethod
     def get_preference_stats(cls, session):
         """Get statistics about model preferences"""
@@ -59,9 +161,53 @@ class ComparisonResult(Base):
             "finetuned_percentage": (finetuned_count / total * 100) if total > 0 else 0
         }
                 
-# Create database and tables
-engine = create_engine('sqlite:///comparisons.db')
-Base.metadata.create_all(engine)
+# Pre-generated pairs of completions handed out to raters in pool mode
+class PoolItem(Base):
+    __tablename__ = 'pool_items'
+
+    id = Column(Integer, primary_key=True)
+    experiment_id = Column(Integer, ForeignKey('experiments.id'), nullable=False)
+    prompt_hash = Column(String, nullable=False)
+    code_prefix = Column(Text, nullable=False)  # FIM prefix or chat prompt
+    code_suffix = Column(Text, nullable=False, default="")
+    base_model_name = Column(String, nullable=False)
+    finetuned_model_name = Column(String, nullable=False)
+    base_completion = Column(Text, nullable=False)
+    finetuned_completion = Column(Text, nullable=False)
+    # Raters the item was handed out to, claimed with a conditional UPDATE
+    assignment_count = Column(Integer, nullable=False, default=0, server_default='0')
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    experiment = relationship("Experiment")
+
+    def __repr__(self):
+        return f"<PoolItem {self.id}>"
+
+# Pool items already handed out to a rater, so nobody gets the same pair twice
+class PoolAssignment(Base):
+    __tablename__ = 'pool_assignments'
+    __table_args__ = (UniqueConstraint('pool_item_id', 'github_username'),)
+
+    id = Column(Integer, primary_key=True)
+    pool_item_id = Column(Integer, ForeignKey('pool_items.id'), nullable=False)
+    github_username = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Vote counts per time bucket, experiment and preferred model, for trend charts.
+# Kept up to date by the submit path, hourly buckets are pruned after a retention period.
+class PreferenceRollup(Base):
+    __tablename__ = 'preference_rollups'
+    __table_args__ = (UniqueConstraint('granularity', 'bucket_start', 'experiment', 'preferred_model'),)
+
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String, nullable=False)  # 'hour' or 'day'
+    bucket_start = Column(DateTime, nullable=False)
+    experiment = Column(String, nullable=False, default='')  # experiment_id string, '' if none
+    preferred_model = Column(String, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+# Tables are created and their indexes added by migration.run_migrations()
+engine = create_engine(f'sqlite:///{Config.SQLITE_DB_PATH}')
 
 # Create session factory
 Session = sessionmaker(bind=engine)
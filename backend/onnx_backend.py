@@ -0,0 +1,211 @@
+import glob
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+import weights_cache
+from config import Config
+from inference_backends import sample_token
+
+logger = logging.getLogger(__name__)
+
+PROFILE_NAME = "onnx_int8"
+MODEL_FILE = "model.onnx"
+
+# Prompts are prefilled in chunks, the exported graph returns the logits of
+# every position and a whole prompt's worth would take hundreds of MB
+PREFILL_CHUNK_TOKENS = 256
+
+ONNX_DTYPES = {"tensor(float)": np.float32, "tensor(float16)": np.float16}
+
+
+def export_onnx(model_name, base_model=None):
+    """
+    Export a model to ONNX with its KV cache as inputs and outputs, and
+    quantize its weights to int8. Finetunes (base_model given) are exported
+    with their LoRA adapter merged.
+
+    Exports are stored next to the prepared weights, and reused by later starts
+    until the model (or its base model) gets a new revision on the hub.
+
+    Returns:
+        Directory of the quantized model, its config and tokenizer
+    """
+    if Config.MODEL_CACHE_DIR:
+        target = weights_cache.cache_path(model_name, PROFILE_NAME)
+        if weights_cache.is_cached(model_name, PROFILE_NAME, base_model):
+            return target
+        os.makedirs(Config.MODEL_CACHE_DIR, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=Config.MODEL_CACHE_DIR, prefix=".tmp-")
+    else:
+        logger.warning(f"MODEL_CACHE_DIR is disabled, {model_name} is exported again on every start")
+        target = tempfile.mkdtemp(prefix="onnx-")
+        tmp_dir = tempfile.mkdtemp()
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from optimum.exporters.onnx import main_export
+
+    logger.info(f"Exporting {model_name} to ONNX")
+    try:
+        source = model_name
+        if base_model:
+            from model_loader import load_peft_model
+
+            model, tokenizer = load_peft_model(base_model, model_name, profile_name="fp32", merge="always")
+            source = os.path.join(tmp_dir, "merged")
+            model.save_pretrained(source, safe_serialization=True)
+            tokenizer.save_pretrained(source)
+            del model
+
+        exported = os.path.join(tmp_dir, "fp32")
+        main_export(source, output=exported, task="text-generation-with-past", device="cpu")
+
+        quantized = os.path.join(tmp_dir, "int8")
+        os.makedirs(quantized)
+        quantize_dynamic(
+            os.path.join(exported, MODEL_FILE),
+            os.path.join(quantized, MODEL_FILE),
+            weight_type=QuantType.QInt8,
+        )
+        # Config, generation config and tokenizer files
+        for path in glob.glob(os.path.join(exported, "*")):
+            if not path.endswith((".onnx", ".onnx_data")):
+                shutil.copy(path, quantized)
+
+        if Config.MODEL_CACHE_DIR:
+            weights_cache.write_metadata(quantized, model_name, PROFILE_NAME, base_model)
+            weights_cache.install(quantized, target)
+        else:
+            os.rmdir(target)
+            os.rename(quantized, target)
+        logger.info(f"Stored the int8 ONNX export of {model_name} in {target}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return target
+
+
+class OnnxCausalLM:
+    """
+    An exported causal LM run with ONNX Runtime on CPU, generating like
+    model.generate().
+
+    The KV cache stays in ONNX Runtime: through IO binding the present
+    key/values of one step are bound as the past inputs of the next as they
+    are, never copied into numpy or torch.
+    """
+
+    def __init__(self, path):
+        import onnxruntime
+        from transformers import AutoConfig, GenerationConfig
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if Config.ONNX_NUM_THREADS:
+            options.intra_op_num_threads = Config.ONNX_NUM_THREADS
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(path, MODEL_FILE), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.output_names = [o.name for o in self.session.get_outputs()]
+        self.past_names = {
+            o.replace("present", "past_key_values"): o for o in self.output_names if o.startswith("present")
+        }
+
+        config = AutoConfig.from_pretrained(path)
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        past_type = next(i.type for i in self.session.get_inputs() if i.name in self.past_names)
+        self.empty_past = np.zeros((1, config.num_key_value_heads, 0, head_dim), dtype=ONNX_DTYPES[past_type])
+
+        try:
+            self.generation_config = GenerationConfig.from_pretrained(path)
+        except OSError:
+            self.generation_config = GenerationConfig.from_model_config(config)
+        eos = self.generation_config.eos_token_id
+        self.eos_token_ids = set(eos if isinstance(eos, list) else [eos]) - {None}
+        self.pad_token_id = self.generation_config.pad_token_id or min(self.eos_token_ids, default=0)
+        self.device = torch.device("cpu")
+
+    def _run(self, input_ids, position, past):
+        """One forward pass over input_ids, returns the logits of the last one and the new past"""
+        binding = self.session.io_binding()
+        length = len(input_ids)
+        binding.bind_cpu_input("input_ids", np.asarray(input_ids, dtype=np.int64)[None])
+        binding.bind_cpu_input("attention_mask", np.ones((1, position + length), dtype=np.int64))
+        if "position_ids" in self.input_names:
+            binding.bind_cpu_input("position_ids", np.arange(position, position + length, dtype=np.int64)[None])
+        for name in self.past_names:
+            if past is None:
+                binding.bind_cpu_input(name, self.empty_past)
+            else:
+                binding.bind_ortvalue_input(name, past[name])
+        for name in self.output_names:
+            binding.bind_output(name, "cpu")
+
+        self.session.run_with_iobinding(binding)
+        outputs = dict(zip(self.output_names, binding.get_outputs()))
+        logits = torch.from_numpy(outputs["logits"].numpy()[:, -1, :])
+        return logits, {name: outputs[present] for name, present in self.past_names.items()}
+
+    def _generate_row(self, input_ids, max_new_tokens, min_new_tokens, temperature, do_sample, streamer):
+        past, logits = None, None
+        for start in range(0, len(input_ids), PREFILL_CHUNK_TOKENS):
+            logits, past = self._run(input_ids[start:start + PREFILL_CHUNK_TOKENS], start, past)
+
+        generated = []
+        position = len(input_ids)
+        for step in range(max_new_tokens):
+            token = sample_token(logits, self.generation_config, temperature, do_sample)
+            generated.append(token.item())
+            if streamer is not None:
+                streamer.put(token)
+            if step + 1 >= min_new_tokens and generated[-1] in self.eos_token_ids:
+                break
+            logits, past = self._run(generated[-1:], position, past)
+            position += 1
+        return generated
+
+    def generate(self, input_ids, attention_mask=None, max_new_tokens=20, min_new_tokens=0,
+                 temperature=1.0, do_sample=False, streamer=None, use_cache=True):
+        """
+        Generate completions for a batch of prompts, one row at a time.
+
+        Returns:
+            Tensor of the prompts and generated ids, rows padded to the same length
+        """
+        if streamer is not None:
+            if input_ids.shape[0] > 1:
+                raise ValueError("Streaming supports a batch size of 1")
+            streamer.put(input_ids.cpu())
+
+        rows = []
+        try:
+            for i, row in enumerate(input_ids.cpu().tolist()):
+                if attention_mask is not None:
+                    row = [t for t, m in zip(row, attention_mask[i].tolist()) if m]
+                rows.append(
+                    row + self._generate_row(row, max_new_tokens, min_new_tokens, temperature, do_sample, streamer)
+                )
+        finally:
+            if streamer is not None:
+                streamer.end()
+
+        width = max(len(row) for row in rows)
+        return torch.tensor([row + [self.pad_token_id] * (width - len(row)) for row in rows])
+
+
+def load_onnx_model(model_name, base_model=None):
+    """
+    Load the int8 ONNX export of a model, exporting it first if needed.
+
+    Returns:
+        Tuple of (model, tokenizer)
+    """
+    from transformers import AutoTokenizer
+
+    path = export_onnx(model_name, base_model=base_model)
+    logger.info(f"Loading {model_name} with ONNX Runtime from {path}")
+    return OnnxCausalLM(path), AutoTokenizer.from_pretrained(path)
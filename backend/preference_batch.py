@@ -0,0 +1,159 @@
+import json
+import re
+from collections import Counter
+from datetime import datetime, timezone
+
+from sqlalchemy import insert
+
+from experiment_registry import registry
+from models import Blob, ComparisonResult
+from rollups import PREFERRED_MODELS, bucket_start, record_preference
+
+
+def parse_batch(body, content_type=""):
+    """
+    Split a request body into items, from a JSON array or NDJSON.
+
+    Returns:
+        List of (item, error) tuples, error is None for lines that parsed
+
+    Raises:
+        ValueError: If the body is neither a JSON array nor NDJSON
+    """
+    text = body.decode("utf-8")
+    if "ndjson" not in content_type and text.lstrip().startswith("["):
+        try:
+            items = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON array: {e}")
+        if not isinstance(items, list):
+            raise ValueError("Expected a JSON array")
+        return [(item, None) for item in items]
+
+    parsed = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            parsed.append((json.loads(line), None))
+        except json.JSONDecodeError as e:
+            parsed.append((None, f"Invalid JSON: {e}"))
+    return parsed
+
+
+def validate_item(item, username, allow_username):
+    """
+    Check one submitted preference and turn it into column values.
+
+    Items carry the fields of /api/submit-preference, plus optionally
+    "createdAt" (ISO 8601) and, for admins, "githubUsername".
+
+    Returns:
+        Tuple of (values, error), exactly one of them is None
+    """
+    if not isinstance(item, dict):
+        return None, "Expected a JSON object"
+
+    preferred_model = item.get("preferredModel")
+    if preferred_model not in PREFERRED_MODELS:
+        return None, "preferredModel must be 'base' or 'finetuned'"
+    for field in ("baseCompletion", "finetunedCompletion"):
+        if not isinstance(item.get(field), str):
+            return None, f"{field} is required"
+    if not isinstance(item.get("codePrefix", ""), str):
+        return None, "codePrefix must be a string"
+
+    now = datetime.utcnow()
+    created_at = now
+    if item.get("createdAt"):
+        try:
+            # fromisoformat() only takes the "Z" of Date.toISOString() from Python 3.11 on
+            created_at = datetime.fromisoformat(re.sub(r"[Zz]$", "+00:00", item["createdAt"]))
+        except (TypeError, ValueError):
+            return None, "createdAt must be an ISO 8601 timestamp"
+        # Stored as naive UTC like the rest of the table, naive timestamps are taken as UTC
+        if created_at.tzinfo is not None:
+            created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+        if created_at > now:
+            return None, "createdAt can't be in the future"
+
+    if item.get("githubUsername") and not allow_username:
+        return None, "Only admins can submit on behalf of other users"
+
+    return {
+        "github_username": item.get("githubUsername") or username,
+        "preferred_model": preferred_model,
+        "code_prefix": item.get("codePrefix", ""),
+        "base_completion": item["baseCompletion"],
+        "finetuned_completion": item["finetunedCompletion"],
+        "experiment": item.get("experimentId"),
+        "created_at": created_at,
+    }, None
+
+
+def insert_batch(db_session, parsed, username, allow_username=False):
+    """
+    Validate parsed items and insert the valid ones in one transaction.
+
+    Blobs, comparison results and rollups are each written with a single
+    executemany, instead of a round trip per vote.
+
+    Returns:
+        Tuple of (number inserted, list of {"index", "error"} for rejected items)
+    """
+    errors = []
+    valid = []
+    for index, (item, error) in enumerate(parsed):
+        if error is None:
+            values, error = validate_item(item, username, allow_username)
+        if error is not None:
+            errors.append({"index": index, "error": error})
+        else:
+            valid.append((index, values))
+
+    experiments = {}
+    for _, values in valid:
+        experiment = values["experiment"]
+        if experiment not in experiments:
+            try:
+                experiments[experiment] = registry.resolve(experiment)
+            except ValueError:
+                experiments[experiment] = None
+
+    blobs = {}
+    results = []
+    rollups = Counter()
+    for index, values in valid:
+        experiment = values["experiment"]
+        if experiments[experiment] is None:
+            errors.append({"index": index, "error": f"Unknown experiment: {experiment}"})
+            continue
+        experiment_id, base_model_name, finetuned_model_name = experiments[experiment]
+
+        prefix = Blob.row(values["code_prefix"])
+        base = Blob.row(values["base_completion"], compress=True)
+        finetuned = Blob.row(values["finetuned_completion"], compress=True)
+        for blob in (prefix, base, finetuned):
+            Blob.add_row(blobs, blob)
+
+        results.append({
+            "github_username": values["github_username"],
+            "base_model_name": base_model_name,
+            "finetuned_model_name": finetuned_model_name,
+            "preferred_model": values["preferred_model"],
+            "code_prefix_hash": prefix["hash"],
+            "base_completion_hash": base["hash"],
+            "finetuned_completion_hash": finetuned["hash"],
+            "experiment_id": experiment_id,
+            "created_at": values["created_at"],
+        })
+        rollups[(experiment, values["preferred_model"], bucket_start(values["created_at"], "hour"))] += 1
+
+    if results:
+        db_session.execute(Blob.insert_rows(), list(blobs.values()))
+        db_session.execute(insert(ComparisonResult), results)
+        for (experiment, preferred_model, hour), count in rollups.items():
+            record_preference(db_session, experiment, preferred_model, hour, count)
+
+    errors.sort(key=lambda error: error["index"])
+    return len(results), errors
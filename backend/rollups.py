@@ -0,0 +1,109 @@
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects.sqlite import insert
+
+from config import Config
+from models import PreferenceRollup, Session as DBSession
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = ("hour", "day")
+PREFERRED_MODELS = ("base", "finetuned")
+
+
+def bucket_start(created_at, granularity):
+    """Start of the hour or day created_at falls in"""
+    if granularity == "hour":
+        return created_at.replace(minute=0, second=0, microsecond=0)
+    return created_at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def record_preference(db_session, experiment, preferred_model, created_at, count=1):
+    """
+    Add votes to the hourly and daily rollups, in the caller's transaction.
+
+    Args:
+        db_session: Session the vote is being stored with
+        experiment: experiment_id string of the vote, None if it has none
+        preferred_model: 'base' or 'finetuned'
+        created_at: Time of the vote
+        count: Number of votes to add
+
+    Raises:
+        ValueError: If preferred_model isn't 'base' or 'finetuned'
+    """
+    if preferred_model not in PREFERRED_MODELS:
+        raise ValueError(f"Invalid preferred model: {preferred_model}")
+    for granularity in GRANULARITIES:
+        statement = insert(PreferenceRollup).values(
+            granularity=granularity,
+            bucket_start=bucket_start(created_at, granularity),
+            experiment=experiment or "",
+            preferred_model=preferred_model,
+            count=count,
+        )
+        db_session.execute(
+            statement.on_conflict_do_update(
+                index_elements=["granularity", "bucket_start", "experiment", "preferred_model"],
+                set_={"count": PreferenceRollup.count + statement.excluded.count},
+            )
+        )
+
+
+def prune_rollups():
+    """Drop hourly buckets older than the retention period"""
+    cutoff = datetime.utcnow() - timedelta(days=Config.ROLLUP_HOURLY_RETENTION_DAYS)
+    db_session = DBSession()
+    try:
+        deleted = (
+            db_session.query(PreferenceRollup)
+            .filter(PreferenceRollup.granularity == "hour")
+            .filter(PreferenceRollup.bucket_start < cutoff)
+            .delete(synchronize_session=False)
+        )
+        db_session.commit()
+        if deleted:
+            logger.info(f"Pruned {deleted} hourly preference rollups")
+    except Exception as e:
+        db_session.rollback()
+        logger.error(f"Error pruning preference rollups: {e}")
+    finally:
+        db_session.close()
+
+
+def get_trends(db_session, granularity, since, experiment=None):
+    """
+    Preference counts and finetuned win rate per bucket and experiment.
+
+    Returns:
+        Dict of experiment -> list of buckets, oldest first
+    """
+    query = (
+        db_session.query(PreferenceRollup)
+        .filter(PreferenceRollup.granularity == granularity)
+        .filter(PreferenceRollup.bucket_start >= bucket_start(since, granularity))
+    )
+    if experiment:
+        query = query.filter(PreferenceRollup.experiment == experiment)
+
+    series = {}
+    for rollup in query.order_by(PreferenceRollup.bucket_start):
+        buckets = series.setdefault(rollup.experiment or "none", {})
+        bucket = buckets.setdefault(
+            rollup.bucket_start,
+            {"bucket_start": rollup.bucket_start.isoformat(), "base": 0, "finetuned": 0},
+        )
+        # Votes stored before preferred models were validated may hold anything else
+        if rollup.preferred_model in PREFERRED_MODELS:
+            bucket[rollup.preferred_model] += rollup.count
+
+    trends = {}
+    for name, buckets in series.items():
+        trends[name] = []
+        for bucket in buckets.values():
+            total = bucket["base"] + bucket["finetuned"]
+            bucket["total"] = total
+            bucket["finetuned_win_rate"] = round(bucket["finetuned"] / total, 3) if total else 0
+            trends[name].append(bucket)
+    return trends
@@ -0,0 +1,160 @@
+import threading
+import logging
+
+import torch
+from peft import PeftModel
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Forward hooks only act inside a thread that is running an assisted generation,
+# and only on the target and draft of that generation, so a model that is the
+# draft of one experiment and the target of another (e.g. the FIM base model)
+# is counted in the right role.
+_assisted_state = threading.local()
+
+
+def _unwrap(model):
+    """Return the module whose forward is called by generate()."""
+    if isinstance(model, PeftModel):
+        return model.get_base_model()
+    return model
+
+
+def _assisted_hook(module, args, output):
+    counts = getattr(_assisted_state, "counts", None)
+    if counts is None:
+        return output
+
+    if module is _assisted_state.target:
+        counts["target"] += 1
+    elif module is _assisted_state.draft:
+        counts["draft"] += 1
+        # Small Qwen checkpoints ship a narrower lm_head than the 7B ones even
+        # though the tokenizer is identical. Pad the draft logits with -inf so
+        # speculative sampling can compare both distributions token by token;
+        # the padded ids are never proposed.
+        missing = _assisted_state.vocab_size - output.logits.shape[-1]
+        if missing > 0:
+            output.logits = torch.nn.functional.pad(
+                output.logits, (0, missing), value=float("-inf")
+            )
+    return output
+
+
+def _hook(model):
+    module = _unwrap(model)
+    if not getattr(module, "_pepsi_hooked", False):
+        module.register_forward_hook(_assisted_hook)
+        module._pepsi_hooked = True
+    return module
+
+
+def _count_lookup_candidates():
+    """Count the tokens prompt lookup proposes, as the draft model's are counted"""
+    from transformers.generation.candidate_generator import PromptLookupCandidateGenerator
+
+    if getattr(PromptLookupCandidateGenerator, "_pepsi_counted", False):
+        return
+    get_candidates = PromptLookupCandidateGenerator.get_candidates
+
+    def counted_get_candidates(self, input_ids):
+        candidate_ids, candidate_logits = get_candidates(self, input_ids)
+        counts = getattr(_assisted_state, "counts", None)
+        if counts is not None:
+            counts["draft"] += candidate_ids.shape[-1] - input_ids.shape[-1]
+        return candidate_ids, candidate_logits
+
+    PromptLookupCandidateGenerator.get_candidates = counted_get_candidates
+    PromptLookupCandidateGenerator._pepsi_counted = True
+
+
+def attach_draft_model(model, tokenizer, draft_model, draft_tokenizer):
+    """
+    Prepare a draft model for assisted generation against model.
+
+    Args:
+        model: The target model the completions are sampled from
+        tokenizer: The target model's tokenizer
+        draft_model: The smaller model proposing candidate tokens
+        draft_tokenizer: The draft model's tokenizer
+
+    Returns:
+        The draft model, or None if it can't be used with the target model
+    """
+    if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+        logger.warning(
+            "Draft model tokenizer differs from the target model, disabling assisted generation"
+        )
+        return None
+
+    _hook(model)
+    _hook(draft_model)
+    return draft_model
+
+
+def _generate_counted(model, draft_model, experiment_id, **kwargs):
+    """
+    Run model.generate() counting target forward passes and proposed tokens,
+    and record how many of the proposed tokens were accepted.
+
+    Each target forward pass verifies one batch of proposed tokens and emits
+    one token of its own, so the accepted count is the number of new tokens
+    minus the number of target passes.
+    """
+    _assisted_state.counts = {"target": 0, "draft": 0}
+    _assisted_state.target = _hook(model)
+    _assisted_state.draft = _unwrap(draft_model) if draft_model is not None else None
+    _assisted_state.vocab_size = _assisted_state.target.config.vocab_size
+    try:
+        outputs = model.generate(**kwargs)
+    finally:
+        counts = _assisted_state.counts
+        _assisted_state.counts = None
+
+    new_tokens = outputs.shape[-1] - kwargs["input_ids"].shape[-1]
+    accepted = max(new_tokens - counts["target"], 0)
+
+    metrics.incr(f"speculative.{experiment_id}.generated_tokens", new_tokens)
+    metrics.incr(f"speculative.{experiment_id}.proposed_tokens", counts["draft"])
+    metrics.incr(f"speculative.{experiment_id}.accepted_tokens", accepted)
+    return outputs
+
+
+def generate_with_draft(model, draft_model, experiment_id, **kwargs):
+    """
+    Run model.generate() with draft_model as assistant and record how many of
+    the drafted tokens were accepted. Every draft forward pass proposes one token.
+    """
+    return _generate_counted(model, draft_model, experiment_id, assistant_model=draft_model, **kwargs)
+
+
+def generate_with_prompt_lookup(model, num_tokens, experiment_id, **kwargs):
+    """
+    Run model.generate() with prompt lookup decoding: up to num_tokens candidate
+    tokens are proposed by matching the last generated n-gram against the prompt
+    (e.g. identifiers and lines FIM completions copy from the surrounding code)
+    and verified in one forward pass. Needs no draft model, batch size 1 only.
+    """
+    _count_lookup_candidates()
+    return _generate_counted(model, None, experiment_id, prompt_lookup_num_tokens=num_tokens, **kwargs)
+
+
+def speculative_stats():
+    """Per-experiment acceptance rate of drafted tokens."""
+    counters = metrics.snapshot()["counters"]
+    stats = {}
+    for name, value in counters.items():
+        if not name.startswith("speculative."):
+            continue
+        _, experiment_id, key = name.split(".", 2)
+        stats.setdefault(experiment_id, {})[key] = int(value)
+
+    for experiment_stats in stats.values():
+        proposed = experiment_stats.get("proposed_tokens", 0)
+        accepted = experiment_stats.get("accepted_tokens", 0)
+        experiment_stats["acceptance_rate"] = (
+            round(accepted / proposed, 3) if proposed > 0 else 0
+        )
+    return stats
@@ -0,0 +1,141 @@
+import asyncio
+import secrets
+import time
+from collections import OrderedDict, deque
+
+from config import Config
+
+
+class StreamBuffer:
+    """
+    Events of one generation stream, numbered from 1 and kept in a ring buffer
+    so a client that lost its connection can replay the ones it missed and
+    follow the rest of the generation.
+
+    Runs on the event loop: the generation appends events from a task and
+    connected clients follow() them. With abandon_grace set, the task is
+    cancelled once no client has followed the stream for that many seconds.
+    """
+
+    def __init__(self, stream_id, username, max_events, abandon_grace=None):
+        self.stream_id = stream_id
+        self.username = username
+        self.events = deque(maxlen=max_events)
+        self.last_seq = 0
+        self.done = False
+        self.updated = time.monotonic()
+        self.task = None
+        self.abandon_grace = abandon_grace
+        self.followers = 0
+        self._abandon_check = None
+        self._waiters = []
+
+    def start(self, task):
+        """Set the task generating the events, it has until abandon_grace to get a follower"""
+        self.task = task
+        if not self.followers:
+            self._check_abandoned_later()
+
+    def _check_abandoned_later(self):
+        if self.abandon_grace is None or self.done:
+            return
+        self._cancel_abandon_check()
+        self._abandon_check = asyncio.get_running_loop().call_later(
+            self.abandon_grace, self._cancel_if_abandoned
+        )
+
+    def _cancel_abandon_check(self):
+        if self._abandon_check is not None:
+            self._abandon_check.cancel()
+            self._abandon_check = None
+
+    def _cancel_if_abandoned(self):
+        self._abandon_check = None
+        if not self.followers and not self.done and self.task is not None:
+            self.task.cancel()
+
+    def _notify(self):
+        self.updated = time.monotonic()
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    def append(self, event):
+        self.last_seq += 1
+        self.events.append((self.last_seq, event))
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self._cancel_abandon_check()
+        self._notify()
+
+    def can_resume(self, after_seq):
+        """Whether every event after after_seq is still in the buffer"""
+        first_seq = self.events[0][0] if self.events else self.last_seq + 1
+        return first_seq <= after_seq + 1 <= self.last_seq + 1
+
+    async def follow(self, after_seq=0):
+        """Yield (seq, event) for the events after after_seq, until the stream is done"""
+        self.followers += 1
+        self._cancel_abandon_check()
+        try:
+            while True:
+                if not self.can_resume(after_seq):
+                    # Fell behind the ring buffer, the client has to reconnect
+                    return
+                for seq, event in list(self.events):
+                    if seq > after_seq:
+                        yield seq, event
+                        after_seq = seq
+                if self.done and after_seq == self.last_seq:
+                    return
+                if after_seq == self.last_seq:
+                    waiter = asyncio.get_running_loop().create_future()
+                    self._waiters.append(waiter)
+                    await waiter
+        finally:
+            self.followers -= 1
+            if not self.followers:
+                self._check_abandoned_later()
+
+
+class StreamRegistry:
+    """
+    Generation streams by id. Finished streams are dropped STREAM_RESUME_TTL_SECONDS
+    after their last event, and the oldest finished ones once there are more
+    than MAX_RESUMABLE_STREAMS.
+    """
+
+    def __init__(self, ttl, max_streams, max_events):
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self.max_events = max_events
+        self._streams = OrderedDict()
+
+    def _prune(self):
+        now = time.monotonic()
+        finished = [s for s in self._streams.values() if s.done]
+        excess = len(self._streams) - self.max_streams
+        for stream in finished:
+            if now - stream.updated > self.ttl or excess > 0:
+                del self._streams[stream.stream_id]
+                excess -= 1
+
+    def create(self, username):
+        self._prune()
+        stream = StreamBuffer(
+            secrets.token_urlsafe(12), username, self.max_events, Config.STREAM_ABANDON_GRACE_SECONDS
+        )
+        self._streams[stream.stream_id] = stream
+        return stream
+
+    def get(self, stream_id):
+        self._prune()
+        return self._streams.get(stream_id)
+
+
+stream_registry = StreamRegistry(
+    Config.STREAM_RESUME_TTL_SECONDS, Config.MAX_RESUMABLE_STREAMS, Config.STREAM_BUFFER_EVENTS
+)
@@ -0,0 +1,180 @@
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+
+import torch
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+METADATA_FILE = "prepared.json"
+
+
+def cache_path(model_name, profile_name):
+    """Directory holding the prepared weights of a model for a load profile"""
+    key = re.sub(r"[^A-Za-z0-9._-]", "--", model_name)
+    return os.path.join(Config.MODEL_CACHE_DIR, f"{key}__{profile_name}")
+
+
+# Revisions resolved so far, each model is looked up once per process
+_revisions = {}
+_revisions_lock = threading.Lock()
+
+
+def _local_revision(model_name):
+    """Commit sha of the local hub cache snapshot of a model, None if there is none"""
+    from huggingface_hub import constants
+
+    ref = os.path.join(constants.HF_HUB_CACHE, f"models--{model_name.replace('/', '--')}", "refs", "main")
+    if not os.path.exists(ref):
+        return None
+    with open(ref) as f:
+        return f.read().strip()
+
+
+def _resolve_revision(model_name):
+    if os.path.isdir(model_name):
+        return None
+    from huggingface_hub import constants, model_info
+
+    if constants.HF_HUB_OFFLINE:
+        return _local_revision(model_name)
+    try:
+        return model_info(model_name).sha
+    except Exception as e:
+        logger.warning(f"Could not resolve the revision of {model_name}: {e}")
+        return None
+
+
+def source_revision(model_name):
+    """
+    Commit sha of a hub model, or of its local snapshot with HF_HUB_OFFLINE set.
+    None for local paths or when it can't be resolved. Resolved once per process,
+    until forget_revisions().
+    """
+    with _revisions_lock:
+        if model_name not in _revisions:
+            _revisions[model_name] = _resolve_revision(model_name)
+        return _revisions[model_name]
+
+
+def forget_revisions():
+    """Resolve revisions from the hub again, e.g. before a hot reload"""
+    with _revisions_lock:
+        _revisions.clear()
+
+
+def source_revisions(model_name, base_model=None):
+    """Revisions an entry is built from: the model's, and its base model's for finetunes"""
+    names = [model_name] + ([base_model] if base_model else [])
+    return {name: source_revision(name) for name in names}
+
+
+def is_cached(model_name, profile_name, base_model=None):
+    """
+    Whether there is an entry for the model that is still current: entries built
+    from an older revision of the model (or of base_model) than the hub's are stale.
+    When the revision can't be resolved the entry is used as is.
+    """
+    if not Config.MODEL_CACHE_DIR:
+        return False
+    path = os.path.join(cache_path(model_name, profile_name), METADATA_FILE)
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        stored = json.load(f).get("revisions", {})
+
+    for name, revision in source_revisions(model_name, base_model).items():
+        if revision is not None and stored.get(name) != revision:
+            logger.info(f"Prepared weights of {model_name} are stale, {name} is now at {revision}")
+            return False
+    return True
+
+
+def write_metadata(path, model_name, profile_name, base_model=None):
+    with open(os.path.join(path, METADATA_FILE), "w") as f:
+        json.dump(
+            {
+                "model_name": model_name,
+                "profile": profile_name,
+                "revisions": source_revisions(model_name, base_model),
+                "created_at": datetime.utcnow().isoformat(),
+            },
+            f,
+        )
+
+
+def install(tmp_dir, target):
+    """Move a complete entry into place, replacing a stale one"""
+    if os.path.exists(target):
+        # Renamed away first so readers never see a half deleted entry; files
+        # still mapped by a running process stay valid until it unmaps them
+        stale = tempfile.mkdtemp(dir=os.path.dirname(target), prefix=".stale-")
+        os.rename(target, os.path.join(stale, "entry"))
+        shutil.rmtree(stale, ignore_errors=True)
+    os.rename(tmp_dir, target)
+
+
+def save_prepared(model, tokenizer, model_name, profile_name, base_model=None):
+    """
+    Store a prepared model as safetensors so later starts can skip loading it from the hub.
+
+    The weights are written to a temporary directory first and moved into place
+    once complete, so a crash or a concurrent process never sees a partial entry.
+    The entry records the revisions it was built from (see is_cached).
+    """
+    if not Config.MODEL_CACHE_DIR or is_cached(model_name, profile_name, base_model):
+        return
+
+    target = cache_path(model_name, profile_name)
+    os.makedirs(Config.MODEL_CACHE_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=Config.MODEL_CACHE_DIR, prefix=".tmp-")
+    try:
+        model.save_pretrained(tmp_dir, safe_serialization=True)
+        tokenizer.save_pretrained(tmp_dir)
+        write_metadata(tmp_dir, model_name, profile_name, base_model)
+        install(tmp_dir, target)
+        logger.info(f"Stored prepared weights of {model_name} in {target}")
+    except OSError as e:
+        # Another process stored the same entry first, or the disk is full
+        logger.warning(f"Could not store prepared weights of {model_name}: {e}")
+    except Exception as e:
+        logger.warning(f"Model {model_name} can't be stored as prepared weights: {e}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_mmap(path, torch_dtype):
+    """
+    Load a prepared model on CPU with its parameters backed by the memory-mapped
+    safetensors files, so the weights are paged in lazily and processes loading
+    the same entry share the page cache instead of holding private copies.
+    """
+    from accelerate import init_empty_weights
+    from safetensors.torch import load_file
+    from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+    config = AutoConfig.from_pretrained(path)
+    with init_empty_weights(include_buffers=False):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=torch_dtype)
+
+    state_dict = {}
+    for shard in sorted(glob.glob(os.path.join(path, "*.safetensors"))):
+        state_dict.update(load_file(shard, device="cpu"))
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise ValueError(f"Prepared weights in {path} are missing {', '.join(missing[:5])}")
+
+    if os.path.exists(os.path.join(path, "generation_config.json")):
+        model.generation_config = GenerationConfig.from_pretrained(path)
+    return model.eval()
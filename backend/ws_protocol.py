@@ -0,0 +1,105 @@
+from typing import Optional, Union
+
+import msgspec
+
+# Frames of the /api/ws WebSocket, msgpack encoded as arrays whose first item
+# is the frame tag and second the client-chosen id of the stream it belongs to.
+# Generations on one connection are multiplexed by stream id.
+
+
+# Client to server
+
+class Generate(msgspec.Struct, tag="g", array_like=True):
+    """Start a comparison, as /api/generate-stream"""
+    stream: int
+    mode: str
+    prefix: Optional[str] = None
+    suffix: Optional[str] = None
+    prompt: Optional[str] = None
+
+
+class Cancel(msgspec.Struct, tag="c", array_like=True):
+    """Stop a running comparison, its generation thread included"""
+    stream: int
+
+
+ClientFrame = Union[Generate, Cancel]
+
+
+# Server to client. Text frames carry no model: it's the one of the last
+# model_start frame of the stream
+
+class Header(msgspec.Struct, tag="h", array_like=True):
+    stream: int
+    model_a_is_base: bool
+    prompt_tokens: dict
+
+
+class ModelStart(msgspec.Struct, tag="s", array_like=True):
+    stream: int
+    model: str
+
+
+class Text(msgspec.Struct, tag="t", array_like=True):
+    stream: int
+    text: str
+
+
+class CodeBlock(msgspec.Struct, tag="b", array_like=True):
+    """A whole fenced code block, sent at once"""
+    stream: int
+    text: str
+
+
+class ModelEnd(msgspec.Struct, tag="e", array_like=True):
+    stream: int
+    model: str
+
+
+class Complete(msgspec.Struct, tag="d", array_like=True):
+    stream: int
+
+
+class Cancelled(msgspec.Struct, tag="x", array_like=True):
+    stream: int
+
+
+class Error(msgspec.Struct, tag="r", array_like=True):
+    """The comparison couldn't start (status as the HTTP endpoint's) or failed"""
+    stream: int
+    status: int
+    detail: str
+
+
+_encoder = msgspec.msgpack.Encoder()
+_decoder = msgspec.msgpack.Decoder(ClientFrame)
+
+
+def encode_frame(frame):
+    return _encoder.encode(frame)
+
+
+def decode_frame(data):
+    """
+    Raises:
+        msgspec.DecodeError: If data isn't a valid client frame
+    """
+    return _decoder.decode(data)
+
+
+def event_frame(stream, event):
+    """Frame of a generation stream event, as appended by start_comparison()"""
+    kind = event["type"]
+    if kind == "token":
+        if event.get("is_code_block"):
+            return CodeBlock(stream, event["text"])
+        return Text(stream, event["text"])
+    if kind == "header":
+        return Header(stream, event["modelAIsBase"], event["promptTokens"])
+    if kind == "model_start":
+        return ModelStart(stream, event["model"])
+    if kind == "model_end":
+        return ModelEnd(stream, event["model"])
+    if kind == "complete":
+        return Complete(stream)
+    raise ValueError(f"Unknown stream event: {kind}")
@@ -3,6 +3,9 @@ import { usePrevious } from './usePrevious';
 
 export type SubmissionState = 'idle' | 'submitting' | 'success';
 
+// Reconnects to a dropped stream before giving up
+const MAX_STREAM_RETRIES = 3;
+
 export const useModels = ({
   prompt,
   prefix,
@@ -114,8 +117,9 @@ export const useModels = ({
   }, [modelAIsBase, streamingResults]);
 
   // Process a single SSE message with optimized handling for different token types
+  // Returns the event type, or undefined for invalid events
   const processEventData = useCallback(
-    (data: string) => {
+    (data: string): string | undefined => {
       try {
         // Check if the data is valid JSON
         if (!data.trim()) return;
@@ -174,6 +178,7 @@ export const useModels = ({
           default:
             console.log('Unknown event type:', parsedData.type);
         }
+        return parsedData.type;
       } catch (error) {
         console.error('Error parsing event data:', error, data);
       }
@@ -202,92 +207,142 @@ export const useModels = ({
       body += `&experiment_id=${encodeURIComponent(experimentId)}`;
     }
 
-    // Make the POST request
-    fetch('/api/generate-stream', {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/x-www-form-urlencoded',
-        Accept: 'text/event-stream',
-      },
-      credentials: 'include',
-      body,
-      signal: controller.signal,
-    })
-      .then((response) => {
-        if (!response.ok) {
-          throw new Error(`HTTP error! Status: ${response.status}`);
-        }
+    // Id of the last event received, to resume the stream if the connection drops
+    let lastEventId: string | null = null;
+    let completed = false;
+    let retries = 0;
+
+    const finishStreaming = () => {
+      setIsStreaming(false);
+      setCurrentStreamingModel(null);
+    };
 
-        if (!response.body) {
-          throw new Error('ReadableStream not supported');
+    // Events carry an id line and a data line
+    const handleEvent = (event: string) => {
+      let data = '';
+      for (const line of event.split('\n')) {
+        if (line.startsWith('id: ')) {
+          lastEventId = line.slice('id: '.length);
+        } else if (line.startsWith('data: ')) {
+          data += line.slice('data: '.length);
         }
+      }
+      if (data && processEventData(data) === 'complete') {
+        completed = true;
+      }
+    };
 
-        // Set up a reader for the stream
-        const reader = response.body.getReader();
-        const decoder = new TextDecoder();
-        let buffer = '';
-
-        // Optimized stream processing function with lower latency
-        function processStream() {
-          reader
-            .read()
-            .then(({ done, value }) => {
-              if (done) {
-                // Process any remaining data in the buffer
-                if (buffer.trim()) {
-                  const events = buffer.split('\n\n');
-                  events.forEach((event) => {
-                    if (event.trim() && event.startsWith('data: ')) {
-                      const data = event.replace('data: ', '');
-                      processEventData(data);
-                    }
-                  });
+    // Pick up a dropped stream where it left off, the generation keeps running server side
+    const reconnect = () => {
+      if (
+        completed ||
+        !lastEventId ||
+        retries >= MAX_STREAM_RETRIES ||
+        controller.signal.aborted
+      ) {
+        finishStreaming();
+        return;
+      }
+      retries += 1;
+      const resumeFrom = lastEventId;
+      setTimeout(() => openStream({ 'Last-Event-ID': resumeFrom }), 500 * retries);
+    };
+
+    // Make the POST request
+    function openStream(extraHeaders: Record<string, string> = {}) {
+      fetch('/api/generate-stream', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/x-www-form-urlencoded',
+          Accept: 'text/event-stream',
+          ...extraHeaders,
+        },
+        credentials: 'include',
+        body,
+        signal: controller.signal,
+      })
+        .then((response) => {
+          if (response.status === 410) {
+            // The stream expired, it can't be resumed
+            finishStreaming();
+            return;
+          }
+
+          if (!response.ok) {
+            throw new Error(`HTTP error! Status: ${response.status}`);
+          }
+
+          if (!response.body) {
+            throw new Error('ReadableStream not supported');
+          }
+
+          // Set up a reader for the stream
+          const reader = response.body.getReader();
+          const decoder = new TextDecoder();
+          let buffer = '';
+
+          // Optimized stream processing function with lower latency
+          function processStream() {
+            reader
+              .read()
+              .then(({ done, value }) => {
+                if (done) {
+                  // Process any remaining data in the buffer
+                  if (buffer.trim()) {
+                    buffer.split('\n\n').forEach((event) => {
+                      if (event.trim()) {
+                        handleEvent(event);
+                      }
+                    });
+                  }
+                  // Closed before the end of the generation, e.g. by a proxy
+                  reconnect();
+                  return;
                 }
-                setIsStreaming(false);
-                setCurrentStreamingModel(null);
-                return;
-              }
-
-              // Decode the chunk and add it to our buffer
-              const chunk = decoder.decode(value, { stream: true });
-              buffer += chunk;
-
-              // Process complete events in the buffer as soon as they arrive
-              const events = buffer.split('\n\n');
-              // Keep the last part that might be incomplete
-              buffer = events.pop() || '';
-
-              // Process each complete event immediately
-              for (const event of events) {
-                if (event.trim() && event.startsWith('data: ')) {
-                  const data = event.replace('data: ', '');
-                  // Process each event as soon as it's available
-                  processEventData(data);
+
+                // Decode the chunk and add it to our buffer
+                const chunk = decoder.decode(value, { stream: true });
+                buffer += chunk;
+
+                // Process complete events in the buffer as soon as they arrive
+                const events = buffer.split('\n\n');
+                // Keep the last part that might be incomplete
+                buffer = events.pop() || '';
+
+                // Process each complete event immediately
+                for (const event of events) {
+                  if (event.trim()) {
+                    handleEvent(event);
+                  }
                 }
-              }
 
-              // Continue reading the stream with minimal delay
-              requestAnimationFrame(() => processStream());
-            })
-            .catch((error) => {
-              if (error.name !== 'AbortError') {
+                // Continue reading the stream with minimal delay
+                requestAnimationFrame(() => processStream());
+              })
+              .catch((error) => {
+                if (error.name === 'AbortError') {
+                  finishStreaming();
+                  return;
+                }
                 console.error('Stream reading error:', error);
-              }
-              setIsStreaming(false);
-              setCurrentStreamingModel(null);
-            });
-        }
+                reconnect();
+              });
+          }
 
-        // Start processing the stream
-        processStream();
-      })
-      .catch((error) => {
-        if (error.name !== 'AbortError') {
+          // Start processing the stream
+          processStream();
+        })
+        .catch((error) => {
+          if (error.name === 'AbortError') {
+            finishStreaming();
+            return;
+          }
           console.error('Fetch error:', error);
-        }
-        setIsStreaming(false);
-        setCurrentStreamingModel(null);
-      });
+          reconnect();
+        });
+    }
+
+    openStream();
 
     return () => {
       controller.abort();